@@ -0,0 +1,266 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Set, Tuple
+
+from fastapi import Request, Response
+
+from proxy import route_class
+from settings import (
+    GATEWAY_CACHE_ENABLED,
+    GATEWAY_CACHE_TTL,
+    GATEWAY_CACHE_STALE_TTL,
+    GATEWAY_CACHE_MAX_BYTES,
+    GATEWAY_CACHE_MAX_ENTRY_BYTES,
+)
+
+# Условные заголовки клиента не уходят в апстрим: кэш хранит полный 200-ответ
+# и сам отвечает 304 по ETag (кроме маршрутов с store=False, см. MicroCache.get)
+CONDITIONAL_HEADERS = {"if-none-match", "if-modified-since", "if-match", "if-unmodified-since"}
+# Заголовки, которые участвуют в ключе кэша
+VARY_HEADERS = ("accept-encoding", "authorization")
+# Директивы Cache-Control, при которых общий кэш не хранит ответ
+# (no-cache потребовал бы ревалидации при каждом обращении)
+UNCACHEABLE_DIRECTIVES = {"no-store", "no-cache", "private"}
+
+
+def is_storable(cache_control: str) -> bool:
+    """Можно ли хранить ответ в кэше гейтвея по его Cache-Control"""
+    directives = {
+        directive.split("=", 1)[0].strip().lower()
+        for directive in cache_control.split(",")
+    }
+    return not directives & UNCACHEABLE_DIRECTIVES
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Слабое сравнение ETag для If-None-Match"""
+    etag = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class CacheEntry:
+    __slots__ = ("status_code", "headers", "body", "tags", "stored_at")
+
+    def __init__(self, status_code: int, headers: dict, body: bytes, tags: frozenset):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.tags = tags
+        self.stored_at = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers.items())
+
+
+class MicroCache:
+    """
+    Короткоживущий кэш GET-ответов апстрима в памяти гейтвея:
+    - одинаковые одновременные запросы склеиваются в один поход в апстрим;
+    - после TTL запись ещё STALE_TTL секунд отдаётся, пока в фоне идёт обновление;
+    - размер ограничен суммарным числом байт, вытеснение LRU;
+    - записи помечены тегами (doc:<id>, lists) и инвалидируются по ним;
+    - ответы с Cache-Control: no-store / no-cache / private не сохраняются
+      (одновременные запросы по ним всё равно склеиваются);
+    - маршруты, которые заведомо отвечают без права хранения, вызываются с store=False:
+      условные заголовки уходят в апстрим и его 304 отдаётся клиенту как есть.
+    """
+
+    def __init__(
+        self,
+        upstream,
+        ttl: float = GATEWAY_CACHE_TTL,
+        stale_ttl: float = GATEWAY_CACHE_STALE_TTL,
+        max_bytes: int = GATEWAY_CACHE_MAX_BYTES,
+        max_entry_bytes: int = GATEWAY_CACHE_MAX_ENTRY_BYTES,
+        enabled: bool = GATEWAY_CACHE_ENABLED,
+    ):
+        self.upstream = upstream
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.enabled = enabled
+
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._by_tag: Dict[str, Set[str]] = {}
+        self._bytes = 0
+        self._inflight: Dict[str, Tuple[asyncio.Task, frozenset]] = {}
+        # Ключи, инвалидированные во время загрузки: их результат не сохраняется
+        self._discard_on_load: Set[str] = set()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _key(self, request: Request, path: str, store: bool = True) -> str:
+        names = VARY_HEADERS if store else VARY_HEADERS + tuple(sorted(CONDITIONAL_HEADERS))
+        vary = "|".join(request.headers.get(name, "") for name in names)
+        return f"{path}?{request.url.query}|{vary}"
+
+    async def get(self, request: Request, path: str, tags: Iterable[str], store: bool = True) -> Response:
+        """
+        Ответ на GET из кэша или из апстрима (с сохранением в кэш).
+        store=False — ответ не сохраняется, а условный запрос (If-None-Match) ревалидируется
+        самим апстримом: например, GET /documents/{id} отвечает 304 без чтения content.
+        """
+        if not self.enabled:
+            return await self.upstream.forward(request, path)
+
+        tags = frozenset(tags)
+        key = self._key(request, path, store)
+        headers = [
+            (name, value)
+            for name, value in request.headers.items()
+            if not store or name.lower() not in CONDITIONAL_HEADERS
+        ]
+
+        entry = self._entries.get(key)
+        state = "MISS"
+        if entry is not None:
+            age = time.monotonic() - entry.stored_at
+            if age < self.ttl:
+                state = "HIT"
+                self.hits += 1
+                self._entries.move_to_end(key)
+            elif age < self.ttl + self.stale_ttl:
+                state = "STALE"
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._load(key, path, request.url.query, headers, tags, store, route_class(request))
+            else:
+                self._remove(key)
+                entry = None
+
+        if entry is None:
+            self.misses += 1
+            status_code, response_headers, body = await asyncio.shield(
+                self._load(key, path, request.url.query, headers, tags, store, route_class(request))
+            )
+        else:
+            status_code, response_headers, body = entry.status_code, entry.headers, entry.body
+
+        return self._response(request, status_code, response_headers, body, state)
+
+    def _load(
+        self,
+        key: str,
+        path: str,
+        query: str,
+        headers: list,
+        tags: frozenset,
+        store: bool = True,
+        route: str | None = None,
+    ) -> asyncio.Task:
+        """Загрузка из апстрима; параллельные запросы по тому же ключу ждут одну задачу."""
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return inflight[0]
+
+        self._discard_on_load.discard(key)
+        task = asyncio.create_task(self._fetch_and_store(key, path, query, headers, tags, store, route))
+        self._inflight[key] = (task, tags)
+        # Ошибка фоновой ревалидации не должна всплывать как "never retrieved"
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _fetch_and_store(
+        self,
+        key: str,
+        path: str,
+        query: str,
+        headers: list,
+        tags: frozenset,
+        store: bool = True,
+        route: str | None = None,
+    ):
+        try:
+            status_code, response_headers, body = await self.upstream.fetch(path, query, headers, route)
+        finally:
+            self._inflight.pop(key, None)
+
+        cacheable = (
+            store
+            and status_code == 200
+            and len(body) <= self.max_entry_bytes
+            and is_storable(response_headers.get("cache-control", ""))
+            and key not in self._discard_on_load
+        )
+        self._discard_on_load.discard(key)
+        if cacheable:
+            self._store(key, CacheEntry(status_code, response_headers, body, tags))
+        return status_code, response_headers, body
+
+    def _store(self, key: str, entry: CacheEntry):
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        for tag in entry.tags:
+            self._by_tag.setdefault(tag, set()).add(key)
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    def invalidate(self, *tags: str):
+        """Удалить записи с любым из тегов; идущие загрузки по ним не попадут в кэш."""
+        tags = set(tags)
+        for tag in tags:
+            for key in list(self._by_tag.get(tag, ())):
+                self._remove(key)
+                self.invalidations += 1
+        for key, (_, load_tags) in self._inflight.items():
+            if load_tags & tags:
+                self._discard_on_load.add(key)
+
+    def _response(self, request: Request, status_code: int, headers: dict, body: bytes, state: str) -> Response:
+        response_headers = {
+            name: value for name, value in headers.items() if name.lower() != "content-length"
+        }
+        response_headers["X-Cache"] = state
+
+        etag = headers.get("etag")
+        if_none_match = request.headers.get("if-none-match")
+        if status_code == 200 and etag and if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=response_headers)
+        return Response(content=body, status_code=status_code, headers=response_headers)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
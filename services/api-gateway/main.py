@@ -1,13 +1,18 @@
-import httpx
 import asyncio
 import websockets
+from typing import Optional
 from starlette.websockets import WebSocketState
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Request
-from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 
-from settings import DOC_SERVICE_URL, COLLAB_HUB_URL
+from settings import DOC_SERVICE_URL, DOC_SERVICE_URLS, COLLAB_HUB_URL, HUB_WS_MULTIPLEX
+from proxy import Upstream
+from cache import MicroCache
+from ws_mux import HubMultiplexer, hub_ws_base
+from tracing import init_tracing, TracingMiddleware, exporter, TRACE_DEBUG_ENDPOINT
+from authz import Authorizer, AuthUnavailable, can_write
+from internal_api import internal_headers, require_internal
 
 app = FastAPI(
     title="Conspektor API Gateway",
@@ -23,91 +28,231 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"],
 )
+app.add_middleware(TracingMiddleware, name="gateway.http")
+init_tracing("api-gateway")
+
+doc_service = Upstream("Document Service", DOC_SERVICE_URLS)
+doc_cache = MicroCache(doc_service)
+hub_mux = HubMultiplexer(COLLAB_HUB_URL)
+hub_service = Upstream("Collaboration Hub", COLLAB_HUB_URL)
+# Права пользователя на документ (тот же кэш, что и в хабе; имя — из заголовка X-User)
+authorizer = Authorizer(base_url=DOC_SERVICE_URL)
+
+# Теги кэша: doc:<id> — документ и его версии, lists — списки/поиск/дашборды
+LISTS_TAG = "lists"
+USERS_TAG = "users"
+
+
+@app.on_event("startup")
+async def startup():
+    """Открытие пулов соединений к Document Service и Collaboration Hub"""
+    await doc_service.start()
+    await hub_service.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Закрытие пула соединений и соединений с Collaboration Hub"""
+    await doc_service.close()
+    await hub_service.close()
+    await hub_mux.close()
+
+
+async def forward_request_to_doc_service(request: Request, path: str, invalidate: tuple = ()):
+    """
+    Проброс запроса в Document Service (потоком, через общий пул соединений).
+    invalidate — теги кэша, которые сбрасываются после записи.
+    """
+    response = await doc_service.forward(request, path)
+    if invalidate:
+        doc_cache.invalidate(*invalidate)
+    return response
+
+
+async def cached_get_from_doc_service(request: Request, path: str, *tags: str, store: bool = True):
+    """GET в Document Service через микро-кэш гейтвея (store=False — без хранения, см. MicroCache.get)."""
+    return await doc_cache.get(request, path, tags, store=store)
+
+
+def doc_tag(doc_id: str) -> str:
+    return f"doc:{doc_id}"
+
+
+def request_user(request: Request) -> str:
+    """Имя пользователя из заголовка X-User (401, если его нет)"""
+    username = request.headers.get("X-User")
+    if not username:
+        raise HTTPException(status_code=401, detail="X-User header is required")
+    return username
+
+
+async def require_permission(request: Request, doc_id: str, level: str = "view"):
+    """
+    Проверка прав на документ по кэшу Authorizer:
+    view — любой доступ, write — owner/edit, owner — только владелец.
+    Нет доступа -> 404 (существование чужого документа не раскрывается), мало прав -> 403.
+    """
+    if not authorizer.enabled:
+        return
+    username = request_user(request)
+    try:
+        permission = await authorizer.permission(username, doc_id)
+    except AuthUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"Authorization unavailable: {e}")
+    if permission is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if level == "write" and not can_write(permission) or level == "owner" and permission != "owner":
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
 
-async def forward_request_to_doc_service(method: str, path: str, json: dict | None = None):
-    """Проброс запроса в Document Service."""
-    url = f"{DOC_SERVICE_URL}{path}"
-    async with httpx.AsyncClient() as client:
-        try:
-            if method.upper() == "DELETE" and json is None:
-                resp = await client.request(method, url, timeout=30.0)
-            else:
-                resp = await client.request(method, url, json=json, timeout=30.0)
-            
-        except httpx.RequestError as e:
-            print(f"[gateway] Document Service unavailable: {e}")
-            raise HTTPException(status_code=502, detail=f"Document Service unavailable: {e}") from e
-
-    return JSONResponse(
-        status_code=resp.status_code,
-        content=resp.json() if resp.content else None,
-        headers={
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-            "Access-Control-Allow-Headers": "*",
-        }
-    )
+
+@app.get("/gateway/metrics")
+async def gateway_metrics():
+    """Метрики гейтвея: кэш, состояние breaker-ов, задержки и hedging по репликам, WS-соединения с хабом"""
+    return {
+        "cache": doc_cache.stats(),
+        "upstreams": [doc_service.stats(), hub_service.stats()],
+        "websockets": hub_mux.stats(),
+    }
+
+@app.get("/debug/traces")
+async def debug_traces(trace_id: Optional[str] = None, limit: int = 1000):
+    """Последние сэмплированные спаны гейтвея (для tools/trace_report.py; только при TRACE_DEBUG_ENDPOINT)"""
+    if not TRACE_DEBUG_ENDPOINT:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return exporter.spans(trace_id, limit)
 
 # Endpoints
 
 @app.get("/documents")
-async def get_documents():
+async def get_documents(request: Request):
     """
     Получить список документов.
     Проксируется в Document Service: GET /documents
     """
-    return await forward_request_to_doc_service("GET", "/documents")
+    return await cached_get_from_doc_service(request, "/documents", LISTS_TAG)
+
+
+@app.get("/documents/list")
+async def list_documents(request: Request):
+    """
+    Лёгкий список документов с keyset-пагинацией
+    (owner_id, shared_with, cursor, limit передаются как есть).
+    Проксируется в Document Service: GET /documents/list
+    """
+    return await cached_get_from_doc_service(request, "/documents/list", LISTS_TAG)
+
+
+@app.get("/documents/search")
+async def search_documents(request: Request):
+    """
+    Поиск по документам пользователя (user_id, q, limit, offset).
+    Проксируется в Document Service: GET /documents/search
+    """
+    return await cached_get_from_doc_service(request, "/documents/search", LISTS_TAG)
 
 
 @app.get("/documents/{doc_id}")
-async def get_document(doc_id: str):
+async def get_document(doc_id: str, request: Request):
     """
     Получить один документ.
     Проксируется в Document Service: GET /documents/{doc_id}
+    (If-None-Match -> 304 Not Modified без тела)
     """
-    return await forward_request_to_doc_service("GET", f"/documents/{doc_id}")
+    await require_permission(request, doc_id)
+    # Ответ private, no-cache: гейтвей его не хранит, а If-None-Match проверяет Document Service
+    # по updated_at, не читая content (одновременные одинаковые запросы склеиваются)
+    return await cached_get_from_doc_service(request, f"/documents/{doc_id}", doc_tag(doc_id), store=False)
+
+@app.get("/documents/{doc_id}/versions")
+async def list_document_versions(doc_id: str, request: Request):
+    """
+    Список версий документа (before, limit).
+    Проксируется в Document Service: GET /documents/{doc_id}/versions
+    """
+    await require_permission(request, doc_id)
+    return await cached_get_from_doc_service(request, f"/documents/{doc_id}/versions", doc_tag(doc_id))
+
+@app.get("/documents/{doc_id}/versions/{version_number}")
+async def get_document_version(doc_id: str, version_number: int, request: Request):
+    """
+    Содержимое версии документа.
+    Проксируется в Document Service: GET /documents/{doc_id}/versions/{version_number}
+    """
+    await require_permission(request, doc_id)
+    return await cached_get_from_doc_service(
+        request, f"/documents/{doc_id}/versions/{version_number}", doc_tag(doc_id)
+    )
+
+@app.get("/documents/{doc_id}/versions/{from_version}/diff/{to_version}")
+async def diff_document_versions(doc_id: str, from_version: int, to_version: int, request: Request):
+    """
+    Дельта между двумя версиями документа.
+    Проксируется в Document Service: GET /documents/{doc_id}/versions/{from_version}/diff/{to_version}
+    """
+    await require_permission(request, doc_id)
+    return await cached_get_from_doc_service(
+        request, f"/documents/{doc_id}/versions/{from_version}/diff/{to_version}", doc_tag(doc_id)
+    )
 
 @app.get("/users/username/{username}")
-async def get_user_by_username(username: str):
+async def get_user_by_username(username: str, request: Request):
     """Получить пользователя по username"""
-    return await forward_request_to_doc_service("GET", f"/users/username/{username}")
+    return await cached_get_from_doc_service(request, f"/users/username/{username}", USERS_TAG)
+
+@app.get("/users/{username}/dashboard")
+async def get_user_dashboard(username: str, request: Request):
+    """
+    Пользователь, его документы и общие документы одним запросом
+    (my_cursor, shared_cursor, limit, include).
+    Проксируется в Document Service: GET /users/{username}/dashboard
+    """
+    return await cached_get_from_doc_service(request, f"/users/{username}/dashboard", LISTS_TAG)
 
 @app.get("/documents/user/{user_id}")
-async def get_user_documents(user_id: str):
+async def get_user_documents(user_id: str, request: Request):
     """Получить документы пользователя по user_id"""
-    return await forward_request_to_doc_service("GET", f"/documents/user/{user_id}")
+    return await cached_get_from_doc_service(request, f"/documents/user/{user_id}", LISTS_TAG)
 
 @app.get("/documents/shared/{user_id}")
-async def get_shared_documents(user_id: str):
+async def get_shared_documents(user_id: str, request: Request):
     """
     Получить shared документы пользователя.
     Проксируется в Document Service: GET /documents/shared/{user_id}
     """
-    return await forward_request_to_doc_service("GET", f"/documents/shared/{user_id}")
+    return await cached_get_from_doc_service(request, f"/documents/shared/{user_id}", LISTS_TAG)
 
 @app.put("/documents/{doc_id}")
-async def update_document(doc_id: str, body: dict):
+async def update_document(doc_id: str, request: Request):
     """
     Обновить документ целиком (content, title, ...).
     Проксируется в Document Service: PUT /documents/{doc_id}
+    (If-Match -> 412, если документ изменился)
     """
-    return await forward_request_to_doc_service("PUT", f"/documents/{doc_id}", json=body)
+    await require_permission(request, doc_id, "write")
+    return await forward_request_to_doc_service(
+        request, f"/documents/{doc_id}", invalidate=(doc_tag(doc_id), LISTS_TAG)
+    )
 
 @app.delete("/documents/{doc_id}")
-async def delete_document(doc_id: str):
+async def delete_document(doc_id: str, request: Request):
     """
     Удалить документ.
     Проксируется в Document Service: DELETE /documents/{doc_id}
     """
-    return await forward_request_to_doc_service("DELETE", f"/documents/{doc_id}")
+    await require_permission(request, doc_id, "owner")
+    response = await forward_request_to_doc_service(
+        request, f"/documents/{doc_id}", invalidate=(doc_tag(doc_id), LISTS_TAG)
+    )
+    authorizer.invalidate(doc_id)
+    return response
 
 @app.post("/documents")
-async def create_document(body: dict):
+async def create_document(request: Request):
     """
     Создать новый документ.
     Проксируется в Document Service: POST /documents
     """
-    return await forward_request_to_doc_service("POST", "/documents", json=body)
+    return await forward_request_to_doc_service(request, "/documents", invalidate=(LISTS_TAG,))
 
 @app.websocket("/ws/documents/{doc_id}")
 async def ws_docs(websocket: WebSocket, doc_id: str):
@@ -122,14 +267,42 @@ async def ws_docs(websocket: WebSocket, doc_id: str):
         await websocket.close()
         return
 
-    if COLLAB_HUB_URL.startswith("http://"):
-        hub_ws_url = COLLAB_HUB_URL.replace("http://", "ws://", 1)
-    elif COLLAB_HUB_URL.startswith("https://"):
-        hub_ws_url = COLLAB_HUB_URL.replace("https://", "wss://", 1)
+    # Query string клиента (token, resume) уходит в хаб без изменений
+    query = websocket.url.query
+    if HUB_WS_MULTIPLEX:
+        await relay_multiplexed(websocket, doc_id, query)
     else:
-        hub_ws_url = COLLAB_HUB_URL
+        await relay_direct(websocket, doc_id, query)
+
 
-    hub_url = f"{hub_ws_url.rstrip('/')}/ws/documents/{doc_id}?token={token}"
+async def relay_multiplexed(websocket: WebSocket, doc_id: str, query: str):
+    """Сессия клиента поверх общего соединения документа с хабом"""
+    try:
+        channel = await hub_mux.channel(doc_id)
+        session_id = await channel.open_session(websocket, query)
+    except Exception as e:
+        print(f"[gateway ws mux error] {e}")
+        if websocket.application_state != WebSocketState.DISCONNECTED:
+            await websocket.close()
+        return
+
+    try:
+        while True:
+            msg = await websocket.receive_text()
+            await channel.send(session_id, msg)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"[gateway ws mux error] {e}")
+        if websocket.application_state != WebSocketState.DISCONNECTED:
+            await websocket.close()
+    finally:
+        await channel.close_session(session_id)
+
+
+async def relay_direct(websocket: WebSocket, doc_id: str, query: str):
+    """Отдельное соединение с хабом на каждого клиента (HUB_WS_MULTIPLEX=false)"""
+    hub_url = f"{hub_ws_base(COLLAB_HUB_URL)}/ws/documents/{doc_id}?{query}"
 
     try:
         async with websockets.connect(hub_url) as hub_ws:
@@ -148,8 +321,10 @@ async def ws_docs(websocket: WebSocket, doc_id: str):
                     async for msg in hub_ws:
                         await websocket.send_text(msg)
                 except Exception:
-                    if websocket.application_state != WebSocketState.DISCONNECTED:
-                        await websocket.close()
+                    pass
+                # Код закрытия хаба (1012 при рестарте, 1008 при отказе) уходит клиенту
+                if websocket.application_state != WebSocketState.DISCONNECTED:
+                    await websocket.close(code=hub_ws.close_code or 1000)
 
             await asyncio.gather(client_to_hub(), hub_to_client())
 
@@ -158,10 +333,84 @@ async def ws_docs(websocket: WebSocket, doc_id: str):
         if websocket.application_state != WebSocketState.DISCONNECTED:
             await websocket.close()
 
+
+@app.get("/documents/{doc_id}/presence")
+async def get_document_presence(doc_id: str, request: Request):
+    """
+    Кто сейчас в документе (из памяти Collaboration Hub, без кэша гейтвея).
+    Проксируется в Collaboration Hub: GET /rooms/{doc_id}/presence
+    """
+    await require_permission(request, doc_id)
+    return await hub_service.forward(request, f"/rooms/{doc_id}/presence", extra_headers=internal_headers())
+
+
+@app.post("/authz/prefetch")
+async def prefetch_permissions(request: Request):
+    """
+    Подгрузить в кэш гейтвея и хаба права пользователя на документы из его списка.
+    Только для себя: user в теле должен совпадать с X-User.
+    Проксируется в Collaboration Hub: POST /authz/prefetch
+    """
+    username = request_user(request)
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    doc_ids = body.get("document_ids") if isinstance(body, dict) else None
+    if not isinstance(doc_ids, list):
+        raise HTTPException(status_code=400, detail="user and document_ids are required")
+    if body.get("user") != username:
+        raise HTTPException(status_code=403, detail="Prefetch is allowed only for the current user")
+    try:
+        await authorizer.prefetch(username, [str(doc_id) for doc_id in doc_ids])
+    except AuthUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"Authorization unavailable: {e}")
+    return await hub_service.forward(request, "/authz/prefetch", extra_headers=internal_headers())
+
+
+@app.post("/authz/invalidate")
+async def invalidate_permissions(request: Request, request_data: dict):
+    """
+    Сброс кэша прав гейтвея (Document Service вызывает после изменения соавторов
+    или удаления документа, как и у хаба). Тело: {"document_id": ...}; только с X-Internal-Token.
+    """
+    require_internal(request)
+    doc_id = request_data.get("document_id")
+    return {"invalidated": authorizer.invalidate(str(doc_id) if doc_id else None)}
+
+
 @app.post("/documents/{doc_id}/collaborators")
-async def add_collaborators(doc_id: str, body: dict):
-    return await forward_request_to_doc_service(
-        "POST", 
-        f"/documents/{doc_id}/collaborators", 
-        json=body
-    )
\ No newline at end of file
+async def add_collaborators(doc_id: str, request: Request):
+    """
+    Выдать доступ нескольким пользователям (user_ids, permission).
+    Проксируется в Document Service: POST /documents/{doc_id}/collaborators
+    """
+    return await forward_collaborators(doc_id, request)
+
+
+@app.patch("/documents/{doc_id}/collaborators")
+async def update_collaborators(doc_id: str, request: Request):
+    """
+    Изменить права нескольких соавторов одним запросом.
+    Проксируется в Document Service: PATCH /documents/{doc_id}/collaborators
+    """
+    return await forward_collaborators(doc_id, request)
+
+
+@app.delete("/documents/{doc_id}/collaborators")
+async def remove_collaborators(doc_id: str, request: Request):
+    """
+    Удалить нескольких соавторов одним запросом.
+    Проксируется в Document Service: DELETE /documents/{doc_id}/collaborators
+    """
+    return await forward_collaborators(doc_id, request)
+
+
+async def forward_collaborators(doc_id: str, request: Request):
+    """Изменение соавторов — только владельцем; кэш прав документа в гейтвее сбрасывается сразу"""
+    await require_permission(request, doc_id, "owner")
+    response = await forward_request_to_doc_service(
+        request, f"/documents/{doc_id}/collaborators", invalidate=(LISTS_TAG,)
+    )
+    authorizer.invalidate(doc_id)
+    return response
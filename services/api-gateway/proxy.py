@@ -0,0 +1,324 @@
+import asyncio
+import time
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from settings import (
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_READ_TIMEOUT,
+    UPSTREAM_POOL_TIMEOUT,
+    UPSTREAM_MAX_CONNECTIONS,
+    UPSTREAM_MAX_KEEPALIVE,
+    UPSTREAM_KEEPALIVE_EXPIRY,
+    UPSTREAM_HTTP2,
+    UPSTREAM_QUEUE_TIMEOUT,
+    HEDGE_ENABLED,
+)
+from resilience import Backend, BackendUnavailable, CircuitBreaker, UPSTREAM_FAILURE_STATUSES
+from tracing import span, TRACEPARENT_HEADER
+from internal_api import INTERNAL_TOKEN_HEADER
+
+# Hop-by-hop заголовки не передаются через прокси (RFC 9110, 7.6.1)
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+# Секрет служебных эндпоинтов от клиента не принимается: его добавляет только сам гейтвей
+EXCLUDED_REQUEST_HEADERS = HOP_BY_HOP_HEADERS | {"host", INTERNAL_TOKEN_HEADER.lower()}
+# date/server выставляет сам uvicorn, CORS — middleware гейтвея
+EXCLUDED_RESPONSE_HEADERS = HOP_BY_HOP_HEADERS | {"date", "server"}
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, PUT, PATCH, DELETE, OPTIONS",
+    "Access-Control-Allow-Headers": "*",
+}
+
+
+class Attempt:
+    """Ответ одной реплики; finish() закрывает ответ и освобождает слот бюджета."""
+
+    def __init__(self, backend: Backend, response: httpx.Response, hedged: bool = False):
+        self.backend = backend
+        self.response = response
+        self.hedged = hedged
+        self._finished = False
+
+    async def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            await self.response.aclose()
+        finally:
+            self.backend.inflight -= 1
+            self.backend.semaphore.release()
+
+
+class Upstream:
+    """
+    Долгоживущий пул keep-alive соединений к внутреннему сервису (одна или несколько реплик).
+    Тела запросов и ответов передаются потоком, без разбора JSON.
+    На каждую реплику: circuit breaker, адаптивный таймаут и бюджет конкурентности;
+    идемпотентные GET при медленном ответе дублируются на вторую реплику (hedging).
+    transport позволяет подставить фейковый апстрим (httpx.MockTransport / ASGITransport).
+    """
+
+    def __init__(self, name: str, base_urls, transport: httpx.AsyncBaseTransport | None = None):
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        self.name = name
+        self.backends = [Backend(url) for url in base_urls]
+        self.transport = transport
+        self.client: httpx.AsyncClient | None = None
+        self._next = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    async def start(self):
+        timeout = httpx.Timeout(
+            UPSTREAM_READ_TIMEOUT,
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        )
+        limits = httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        )
+        try:
+            self.client = httpx.AsyncClient(
+                timeout=timeout, limits=limits, http2=UPSTREAM_HTTP2, transport=self.transport
+            )
+        except ImportError:
+            print(f"[gateway] HTTP/2 requested for {self.name} but h2 is not installed, using HTTP/1.1")
+            self.client = httpx.AsyncClient(timeout=timeout, limits=limits, transport=self.transport)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _candidates(self) -> list:
+        """Доступные реплики: по кругу, закрытые breaker-ы раньше half_open."""
+        count = len(self.backends)
+        start = self._next % count
+        self._next += 1
+        ordered = self.backends[start:] + self.backends[:start]
+        available = [b for b in ordered if b.breaker.is_available()]
+        available.sort(key=lambda b: b.breaker.state != CircuitBreaker.CLOSED)
+        return available
+
+    async def _attempt(
+        self,
+        backend: Backend,
+        method: str,
+        path: str,
+        query: str,
+        headers: list,
+        content=None,
+        hedged: bool = False,
+        route: str | None = None,
+    ) -> Attempt:
+        try:
+            await asyncio.wait_for(backend.semaphore.acquire(), timeout=UPSTREAM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            backend.rejected += 1
+            raise BackendUnavailable(f"{backend.base_url}: concurrency budget exhausted")
+        if not backend.breaker.acquire():
+            backend.semaphore.release()
+            raise BackendUnavailable(f"{backend.base_url}: circuit open")
+
+        backend.inflight += 1
+        backend.requests += 1
+        # Адаптивный таймаут только для чтений: медленная запись не должна обрываться
+        read_timeout = backend.read_timeout(route) if method == "GET" else UPSTREAM_READ_TIMEOUT
+
+        started = time.monotonic()
+        try:
+            # Спан до получения заголовков ответа; тело стримится уже под спаном запроса гейтвея
+            with span("gateway.upstream", method=method, path=path, backend=backend.base_url, hedged=hedged) as current:
+                upstream_request = self.client.build_request(
+                    method,
+                    backend.url(path, query),
+                    headers=[
+                        (name, value) for name, value in headers if name.lower() != TRACEPARENT_HEADER
+                    ] + [(TRACEPARENT_HEADER, current.traceparent)],
+                    content=content,
+                    timeout=httpx.Timeout(read_timeout, connect=UPSTREAM_CONNECT_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT),
+                )
+                response = await self.client.send(upstream_request, stream=True)
+                current.set_attribute("status", response.status_code)
+        except BaseException as e:
+            backend.inflight -= 1
+            backend.semaphore.release()
+            if isinstance(e, httpx.TimeoutException):
+                # Таймаут тоже попадает в окно: иначе таймаут не вырастет при деградации
+                backend.observe(read_timeout, route)
+            if isinstance(e, httpx.RequestError):
+                backend.failures += 1
+                backend.breaker.record_failure()
+            else:
+                backend.breaker.release()
+            raise
+
+        backend.observe(time.monotonic() - started, route)
+        if response.status_code in UPSTREAM_FAILURE_STATUSES:
+            backend.failures += 1
+            backend.breaker.record_failure()
+        else:
+            backend.breaker.record_success()
+        return Attempt(backend, response, hedged=hedged)
+
+    async def _send(
+        self, method: str, path: str, query: str, headers: list, content=None, route: str | None = None
+    ) -> Attempt:
+        if self.client is None:
+            await self.start()
+
+        candidates = self._candidates()
+        if not candidates:
+            raise HTTPException(status_code=503, detail=f"{self.name} unavailable: circuit open")
+
+        try:
+            if method == "GET" and content is None:
+                return await self._send_idempotent(candidates, path, query, headers, route)
+            return await self._attempt(candidates[0], method, path, query, headers, content, route=route)
+        except BackendUnavailable as e:
+            print(f"[gateway] {self.name} rejected request: {e}")
+            raise HTTPException(status_code=503, detail=f"{self.name} unavailable: {e}") from e
+        except httpx.TimeoutException as e:
+            print(f"[gateway] {self.name} timeout: {e!r}")
+            raise HTTPException(status_code=504, detail=f"{self.name} timeout") from e
+        except httpx.RequestError as e:
+            print(f"[gateway] {self.name} unavailable: {e}")
+            raise HTTPException(status_code=502, detail=f"{self.name} unavailable: {e}") from e
+
+    async def _send_idempotent(
+        self, candidates: list, path: str, query: str, headers: list, route: str | None = None
+    ) -> Attempt:
+        """
+        GET с hedging: если основная реплика не ответила за её hedge_delay,
+        тот же запрос уходит на следующую; побеждает первый ответ, не означающий отказ реплики.
+        """
+        primary = candidates[0]
+        primary_task = asyncio.create_task(self._attempt(primary, "GET", path, query, headers, route=route))
+        tasks = {primary_task}
+        if len(candidates) > 1:
+            done, _ = await asyncio.wait(tasks, timeout=primary.hedge_delay(route) if HEDGE_ENABLED else None)
+            # Без ответа за hedge_delay — hedge; ошибка соединения/отказ основной — failover
+            if not done or primary_task.exception() is not None:
+                if not done:
+                    self.hedges += 1
+                tasks.add(asyncio.create_task(
+                    self._attempt(candidates[1], "GET", path, query, headers, hedged=True, route=route)
+                ))
+
+        winner: Attempt | None = None
+        fallback: Attempt | None = None
+        error: BaseException | None = None
+        pending = tasks
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    attempt = task.result()
+                    if winner is None and attempt.response.status_code not in UPSTREAM_FAILURE_STATUSES:
+                        winner = attempt
+                    elif fallback is None:
+                        fallback = attempt
+                    else:
+                        await attempt.finish()
+        finally:
+            for task in pending:
+                task.cancel()
+                # Ответ, успевший прийти до отмены, всё равно нужно закрыть
+                task.add_done_callback(_finish_abandoned)
+
+        result = winner or fallback
+        if result is not fallback and fallback is not None:
+            await fallback.finish()
+        if result is None:
+            raise error
+        if result.hedged:
+            self.hedge_wins += 1
+        return result
+
+    async def forward(self, request: Request, path: str, extra_headers: dict | None = None) -> StreamingResponse:
+        """
+        Проброс запроса клиента как есть: метод, query, заголовки и тело потоком.
+        extra_headers добавляются от имени гейтвея (например, X-Internal-Token).
+        """
+        has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+        attempt = await self._send(
+            request.method,
+            path,
+            request.url.query,
+            filter_request_headers(request.headers.items()) + list((extra_headers or {}).items()),
+            content=request.stream() if has_body else None,
+            route=route_class(request),
+        )
+        resp = attempt.response
+
+        # aiter_raw: без распаковки, Content-Encoding апстрима сохраняется
+        return StreamingResponse(
+            resp.aiter_raw(),
+            status_code=resp.status_code,
+            headers=filter_response_headers(resp.headers.items()),
+            background=BackgroundTask(attempt.finish),
+        )
+
+    async def fetch(self, path: str, query: str, headers: list, route: str | None = None) -> tuple:
+        """
+        Буферизованный GET (для кэша гейтвея).
+        Возвращает (status_code, заголовки ответа, сырое тело).
+        """
+        attempt = await self._send("GET", path, query, filter_request_headers(headers), route=route)
+        resp = attempt.response
+        try:
+            body = b"".join([chunk async for chunk in resp.aiter_raw()])
+        finally:
+            await attempt.finish()
+        return resp.status_code, filter_response_headers(resp.headers.items()), body
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "backends": [backend.stats() for backend in self.backends],
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+def route_class(request: Request) -> str | None:
+    """Шаблон пути маршрута гейтвея (/documents/{doc_id}/versions): ключ окна задержек"""
+    route = request.scope.get("route")
+    return getattr(route, "path", None)
+
+
+def _finish_abandoned(task: asyncio.Task):
+    if task.cancelled() or task.exception() is not None:
+        return
+    asyncio.create_task(task.result().finish())
+
+
+def filter_request_headers(headers) -> list:
+    return [(name, value) for name, value in headers if name.lower() not in EXCLUDED_REQUEST_HEADERS]
+
+
+def filter_response_headers(headers) -> dict:
+    filtered = {name: value for name, value in headers if name.lower() not in EXCLUDED_RESPONSE_HEADERS}
+    filtered.update(CORS_HEADERS)
+    return filtered
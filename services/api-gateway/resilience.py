@@ -0,0 +1,187 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from settings import (
+    UPSTREAM_READ_TIMEOUT,
+    UPSTREAM_MAX_CONCURRENCY,
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_TIMEOUT,
+    BREAKER_HALF_OPEN_MAX,
+    ADAPTIVE_TIMEOUT_ENABLED,
+    ADAPTIVE_TIMEOUT_MULTIPLIER,
+    ADAPTIVE_TIMEOUT_MIN,
+    ADAPTIVE_TIMEOUT_MIN_SAMPLES,
+    HEDGE_PERCENTILE,
+    HEDGE_MIN_DELAY,
+    LATENCY_WINDOW_SIZE,
+)
+
+# Ответы, которые считаются отказом реплики. 500 — ошибка конкретного запроса
+# (например, некорректный ввод), а не недоступность: breaker из-за неё не открывается
+UPSTREAM_FAILURE_STATUSES = (502, 503, 504)
+
+
+class BackendUnavailable(Exception):
+    """Реплика не принимает запрос: открыт breaker или исчерпан бюджет конкурентности."""
+
+
+class LatencyWindow:
+    """Скользящее окно последних задержек (секунды) для перцентилей."""
+
+    def __init__(self, size: int = LATENCY_WINDOW_SIZE):
+        self._samples: deque = deque(maxlen=size)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(p * len(ordered)))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """
+    closed -> open после BREAKER_FAILURE_THRESHOLD ошибок подряд;
+    open -> half_open через BREAKER_RESET_TIMEOUT секунд;
+    half_open пропускает до BREAKER_HALF_OPEN_MAX пробных запросов:
+    успех закрывает breaker, ошибка снова открывает.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+        half_open_max: int = BREAKER_HALF_OPEN_MAX,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self.opened_count = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def is_available(self) -> bool:
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and self._probes < self.half_open_max)
+
+    def acquire(self) -> bool:
+        """Разрешить запрос (в half_open — занять слот пробного запроса)."""
+        if not self.is_available():
+            return False
+        if self._state == self.HALF_OPEN:
+            self._probes += 1
+        return True
+
+    def release(self):
+        """Запрос отменён без результата (например, проигравший hedge)."""
+        if self._state == self.HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def record_success(self):
+        self.release()
+        self._failures = 0
+        self._state = self.CLOSED
+
+    def record_failure(self):
+        self.release()
+        self._failures += 1
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                self.opened_count += 1
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class Backend:
+    """Одна реплика апстрима: breaker, окно задержек и бюджет конкурентности."""
+
+    def __init__(self, base_url: str, max_concurrency: int = UPSTREAM_MAX_CONCURRENCY):
+        self.base_url = base_url.rstrip("/")
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyWindow()
+        # Окна по классу маршрута (шаблон пути гейтвея): поиск и сборка версий медленнее
+        # чтения документа, и общий p99 обрывал бы их по таймауту
+        self.route_latency: Dict[str, LatencyWindow] = {}
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def url(self, path: str, query: str = "") -> str:
+        url = f"{self.base_url}{path}"
+        return f"{url}?{query}" if query else url
+
+    def window(self, route: Optional[str] = None) -> LatencyWindow:
+        """Окно задержек класса маршрута (без маршрута — общее окно реплики)."""
+        if route is None:
+            return self.latency
+        window = self.route_latency.get(route)
+        if window is None:
+            window = self.route_latency[route] = LatencyWindow()
+        return window
+
+    def observe(self, seconds: float, route: Optional[str] = None):
+        self.latency.observe(seconds)
+        if route is not None:
+            self.window(route).observe(seconds)
+
+    def read_timeout(self, route: Optional[str] = None) -> float:
+        """Адаптивный таймаут: p99 маршрута * множитель в пределах [MIN, UPSTREAM_READ_TIMEOUT]."""
+        window = self.window(route)
+        if not ADAPTIVE_TIMEOUT_ENABLED or len(window) < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            return UPSTREAM_READ_TIMEOUT
+        p99 = window.percentile(0.99)
+        return min(max(p99 * ADAPTIVE_TIMEOUT_MULTIPLIER, ADAPTIVE_TIMEOUT_MIN), UPSTREAM_READ_TIMEOUT)
+
+    def hedge_delay(self, route: Optional[str] = None) -> float:
+        """Через сколько секунд без ответа отправлять дублирующий запрос."""
+        p = self.window(route).percentile(HEDGE_PERCENTILE)
+        return max(p if p is not None else UPSTREAM_READ_TIMEOUT, HEDGE_MIN_DELAY)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.base_url,
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened_count,
+            "inflight": self.inflight,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "p50": self.latency.percentile(0.5),
+            "p95": self.latency.percentile(0.95),
+            "p99": self.latency.percentile(0.99),
+            "read_timeout": self.read_timeout(),
+            "hedge_delay": self.hedge_delay(),
+            "routes": {
+                route: {
+                    "p99": window.percentile(0.99),
+                    "read_timeout": self.read_timeout(route),
+                    "hedge_delay": self.hedge_delay(route),
+                }
+                for route, window in self.route_latency.items()
+            },
+        }
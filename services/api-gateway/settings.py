@@ -1,4 +1,59 @@
 import os
 
 DOC_SERVICE_URL = os.getenv("DOC_SERVICE_URL", "http://localhost:8001")
-COLLAB_HUB_URL = os.getenv("COLLAB_HUB_URL", "http://localhost:8002")
\ No newline at end of file
+# Реплики Document Service через запятую (для hedged-чтений); по умолчанию одна
+DOC_SERVICE_URLS = [
+    url.strip()
+    for url in os.getenv("DOC_SERVICE_URLS", DOC_SERVICE_URL).split(",")
+    if url.strip()
+]
+COLLAB_HUB_URL = os.getenv("COLLAB_HUB_URL", "http://localhost:8002")
+
+# Пул соединений к Document Service
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.0"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30.0"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5.0"))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30.0"))
+# Бюджет одновременных запросов на реплику и ожидание свободного слота
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "64"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "1.0"))
+# HTTP/2 требует пакет h2 и используется только для https-апстримов (ALPN)
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Микро-кэш GET-ответов Document Service в гейтвее.
+# Записи через гейтвей инвалидируют кэш сразу; автосохранения Collaboration Hub
+# идут в Document Service напрямую, поэтому их видно не позже чем через TTL.
+GATEWAY_CACHE_ENABLED = os.getenv("GATEWAY_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+GATEWAY_CACHE_TTL = float(os.getenv("GATEWAY_CACHE_TTL", "1.0"))
+GATEWAY_CACHE_STALE_TTL = float(os.getenv("GATEWAY_CACHE_STALE_TTL", "5.0"))
+GATEWAY_CACHE_MAX_BYTES = int(os.getenv("GATEWAY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+GATEWAY_CACHE_MAX_ENTRY_BYTES = int(os.getenv("GATEWAY_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+
+# Circuit breaker на реплику
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "10.0"))
+BREAKER_HALF_OPEN_MAX = int(os.getenv("BREAKER_HALF_OPEN_MAX", "1"))
+
+# Адаптивный таймаут чтения для GET: p99 * множитель, но не больше UPSTREAM_READ_TIMEOUT
+LATENCY_WINDOW_SIZE = int(os.getenv("LATENCY_WINDOW_SIZE", "200"))
+ADAPTIVE_TIMEOUT_ENABLED = os.getenv("ADAPTIVE_TIMEOUT_ENABLED", "true").lower() in ("1", "true", "yes")
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.getenv("ADAPTIVE_TIMEOUT_MULTIPLIER", "3.0"))
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv("ADAPTIVE_TIMEOUT_MIN", "0.5"))
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(os.getenv("ADAPTIVE_TIMEOUT_MIN_SAMPLES", "20"))
+
+# Hedged GET: дубль на вторую реплику, если ответа нет дольше перцентиля задержки
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+
+# WebSocket к Collaboration Hub: одно мультиплексированное соединение на документ
+# вместо отдельного соединения на каждого клиента
+HUB_WS_MULTIPLEX = os.getenv("HUB_WS_MULTIPLEX", "true").lower() in ("1", "true", "yes")
+# Сколько секунд держать соединение документа открытым после ухода последнего клиента
+HUB_MUX_IDLE_SECONDS = float(os.getenv("HUB_MUX_IDLE_SECONDS", "5.0"))
+# Клиент, не принявший кадр за это время, отключается, чтобы не тормозить рассылку остальным
+HUB_MUX_SEND_TIMEOUT = float(os.getenv("HUB_MUX_SEND_TIMEOUT", "5.0"))
+# Очередь кадров на клиента; переполнение означает, что клиент не успевает, и он отключается
+HUB_MUX_SESSION_QUEUE = int(os.getenv("HUB_MUX_SESSION_QUEUE", "256"))
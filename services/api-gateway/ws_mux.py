@@ -0,0 +1,259 @@
+import asyncio
+import uuid
+from typing import Dict, Optional
+
+import websockets
+from fastapi import WebSocket, status
+from starlette.websockets import WebSocketState
+
+from settings import HUB_MUX_IDLE_SECONDS, HUB_MUX_SEND_TIMEOUT, HUB_MUX_SESSION_QUEUE
+from tracing import span
+
+
+def hub_ws_base(url: str) -> str:
+    """http(s)://host -> ws(s)://host"""
+    if url.startswith("http://"):
+        url = url.replace("http://", "ws://", 1)
+    elif url.startswith("https://"):
+        url = url.replace("https://", "wss://", 1)
+    return url.rstrip("/")
+
+
+class ClientSession:
+    """
+    Клиент гейтвея в общем соединении с хабом. Кадры клиенту уходят через
+    собственную ограниченную очередь и задачу-писатель, поэтому медленный клиент
+    не задерживает чтение соединения и рассылку остальным.
+    """
+
+    def __init__(self, channel: "HubChannel", session_id: str, websocket: WebSocket):
+        self.channel = channel
+        self.session_id = session_id
+        self.websocket = websocket
+        # До ack хаба (клиент авторизован и вошёл в комнату) рассылки bcast сессии не достаются
+        self.joined = False
+        self.queue: asyncio.Queue = asyncio.Queue(HUB_MUX_SESSION_QUEUE)
+        self.writer = asyncio.create_task(self._write())
+
+    def deliver(self, message: str) -> bool:
+        """Поставить кадр в очередь клиента; False, если очередь переполнена"""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def finish(self, code: int):
+        """Закрыть клиента с кодом после уже поставленных в очередь кадров"""
+        try:
+            self.queue.put_nowait(code)
+        except asyncio.QueueFull:
+            self.writer.cancel()
+            asyncio.create_task(_close_client(self.websocket, code))
+
+    async def _write(self):
+        try:
+            while True:
+                item = await self.queue.get()
+                if isinstance(item, int):
+                    await _close_client(self.websocket, item)
+                    return
+                await asyncio.wait_for(self.websocket.send_text(item), HUB_MUX_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Клиент не принял кадр за HUB_MUX_SEND_TIMEOUT или отключился
+            await self.channel.evict(self)
+
+
+class HubChannel:
+    """
+    Одно соединение с Collaboration Hub (/ws/documents/{doc_id}/mux) для всех
+    клиентов документа на этом гейтвее.
+
+    Кадры: строка заголовка, перевод строки, полезная нагрузка.
+      gateway -> hub:  "open <sid>\\n<query>", "data <sid>\\n<msg>", "close <sid>\\n"
+      hub -> gateway:  "ack <sid>\\n", "data <sid>\\n<msg>",
+                       "bcast <exclude_sid|-> [traceparent]\\n<msg>", "close <sid> <code>\\n"
+    <query> — query string клиента (token, resume), как при прямом подключении.
+    ack — хаб авторизовал сессию и загрузил комнату; до него сессия получает
+    только адресные кадры data/close. Рассылка хаба приходит одним кадром bcast
+    и раздаётся здесь локальным клиентам, вошедшим в комнату.
+    """
+
+    def __init__(self, mux: "HubMultiplexer", doc_id: str):
+        self.mux = mux
+        self.doc_id = doc_id
+        self.sessions: Dict[str, ClientSession] = {}
+        self.connection = None
+        self._reader: Optional[asyncio.Task] = None
+        self._idle_close: Optional[asyncio.Task] = None
+
+        self.broadcasts = 0
+        self.fanout = 0
+        self.dropped = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.connection is not None and self._reader is not None and not self._reader.done()
+
+    async def connect(self):
+        url = f"{self.mux.hub_url}/ws/documents/{self.doc_id}/mux"
+        self.connection = await websockets.connect(url)
+        self._reader = asyncio.create_task(self._read())
+
+    async def open_session(self, websocket: WebSocket, query: str) -> str:
+        session_id = uuid.uuid4().hex
+        if self._idle_close is not None:
+            self._idle_close.cancel()
+            self._idle_close = None
+        # Регистрируем до отправки open: ответ хаба (ack, sync) может прийти сразу
+        self.sessions[session_id] = ClientSession(self, session_id, websocket)
+        await self.connection.send(f"open {session_id}\n{query}")
+        return session_id
+
+    async def send(self, session_id: str, message: str):
+        await self.connection.send(f"data {session_id}\n{message}")
+
+    async def close_session(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            if session.writer is not asyncio.current_task():
+                session.writer.cancel()
+            if self.is_open:
+                try:
+                    await self.connection.send(f"close {session_id}\n")
+                except Exception as e:
+                    print(f"[ws mux] close session error doc={self.doc_id}: {e}")
+        if not self.sessions and self._idle_close is None and self.is_open:
+            self._idle_close = asyncio.create_task(self._close_when_idle())
+
+    async def evict(self, session: ClientSession):
+        """Отключить медленного клиента: он переподключится и догонит состояние по state vector"""
+        self.dropped += 1
+        await self.close_session(session.session_id)
+        await _close_client(session.websocket, status.WS_1011_INTERNAL_ERROR)
+
+    async def _close_when_idle(self):
+        await asyncio.sleep(HUB_MUX_IDLE_SECONDS)
+        self._idle_close = None
+        if not self.sessions:
+            await self.close()
+
+    async def close(self):
+        self.mux.discard(self)
+        if self.connection is not None:
+            await self.connection.close()
+        if self._reader is not None:
+            await asyncio.gather(self._reader, return_exceptions=True)
+
+    def _fanout(self, targets: list, payload: str):
+        for session in targets:
+            if not session.deliver(payload):
+                asyncio.create_task(self.evict(session))
+
+    async def _read(self):
+        try:
+            async for frame in self.connection:
+                header, _, payload = frame.partition("\n")
+                kind, _, rest = header.partition(" ")
+                if kind == "bcast":
+                    excluded, _, traceparent = rest.partition(" ")
+                    targets = [
+                        session for sid, session in self.sessions.items()
+                        if session.joined and sid != excluded
+                    ]
+                    self.broadcasts += 1
+                    self.fanout += len(targets)
+                    if traceparent:
+                        with span("gateway.ws.fanout", parent=traceparent, doc_id=self.doc_id, sessions=len(targets)):
+                            self._fanout(targets, payload)
+                    else:
+                        self._fanout(targets, payload)
+                elif kind == "data":
+                    session = self.sessions.get(rest)
+                    if session is not None:
+                        self._fanout([session], payload)
+                elif kind == "ack":
+                    session = self.sessions.get(rest)
+                    if session is not None:
+                        session.joined = True
+                elif kind == "close":
+                    session_id, _, code = rest.partition(" ")
+                    session = self.sessions.pop(session_id, None)
+                    if session is not None:
+                        session.finish(int(code or status.WS_1000_NORMAL_CLOSURE))
+                else:
+                    print(f"[ws mux] unknown frame kind={kind!r} doc={self.doc_id}")
+        except Exception as e:
+            print(f"[ws mux] hub connection error doc={self.doc_id}: {e}")
+        finally:
+            self.mux.discard(self)
+            # Хаб недоступен или перезапускается: клиенты переподключатся
+            sessions, self.sessions = self.sessions, {}
+            for session in sessions.values():
+                session.finish(status.WS_1012_SERVICE_RESTART)
+
+    def stats(self) -> dict:
+        return {
+            "doc_id": self.doc_id,
+            "sessions": len(self.sessions),
+            "pending": sum(1 for session in self.sessions.values() if not session.joined),
+            "broadcasts": self.broadcasts,
+            "fanout": self.fanout,
+            "dropped": self.dropped,
+        }
+
+
+async def _close_client(websocket: WebSocket, code: int):
+    if websocket.application_state != WebSocketState.DISCONNECTED:
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class HubMultiplexer:
+    """Реестр соединений с хабом: не больше одного на документ."""
+
+    def __init__(self, hub_url: str):
+        self.hub_url = hub_ws_base(hub_url)
+        self._channels: Dict[str, HubChannel] = {}
+        self._connecting: Dict[str, asyncio.Task] = {}
+
+    async def channel(self, doc_id: str) -> HubChannel:
+        channel = self._channels.get(doc_id)
+        if channel is not None and channel.is_open:
+            return channel
+
+        # Одновременные подключения к новому документу ждут одно соединение
+        task = self._connecting.get(doc_id)
+        if task is None:
+            task = asyncio.create_task(self._connect(doc_id))
+            self._connecting[doc_id] = task
+        return await asyncio.shield(task)
+
+    async def _connect(self, doc_id: str) -> HubChannel:
+        try:
+            channel = HubChannel(self, doc_id)
+            await channel.connect()
+            self._channels[doc_id] = channel
+            return channel
+        finally:
+            self._connecting.pop(doc_id, None)
+
+    def discard(self, channel: HubChannel):
+        if self._channels.get(channel.doc_id) is channel:
+            del self._channels[channel.doc_id]
+
+    async def close(self):
+        for channel in list(self._channels.values()):
+            await channel.close()
+
+    def stats(self) -> dict:
+        channels = [channel.stats() for channel in self._channels.values()]
+        return {
+            "hub_connections": len(channels),
+            "sessions": sum(channel["sessions"] for channel in channels),
+            "documents": channels,
+        }
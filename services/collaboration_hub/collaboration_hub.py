@@ -1,21 +1,145 @@
 import os
 import asyncio
 import json
-from typing import Dict, Set, Optional, Any
+import signal
+from typing import Dict, Set, Optional, Any, List
 import httpx
-from datetime import datetime
+from datetime import datetime, timezone
 import time
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, status
+import uuid
+from urllib.parse import parse_qs
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, Request, status
 from fastapi.websockets import WebSocketState
 from fastapi.responses import JSONResponse
+from starlette.background import BackgroundTask
 import y_py as Y
 
+from tracing import init_tracing, span, inject_headers, exporter, TRACE_DEBUG_ENDPOINT
+from authz import authorizer, can_write, AuthUnavailable
+from internal_api import require_internal
+
 DOCUMENT_SERVICE_URL = os.getenv("DOCUMENT_SERVICE_URL", "http://localhost:8001")
 AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://localhost:8003")
 MESSAGE_BROKER_URL = os.getenv("MESSAGE_BROKER_URL", "http://message-broker:8003")
 SAVE_DEBOUNCE_SECONDS = float(os.getenv("SAVE_DEBOUNCE_SECONDS", "2.0"))
+# Сколько секунд комната живёт в памяти после ухода последнего клиента:
+# переподключение в это окно получает только недостающий diff
+ROOM_IDLE_SECONDS = float(os.getenv("ROOM_IDLE_SECONDS", "60.0"))
+# Сессии редактирования копятся в памяти и пишутся в editing_sessions пакетом раз в период
+SESSION_FLUSH_SECONDS = float(os.getenv("SESSION_FLUSH_SECONDS", "10.0"))
+# Присутствие рассылается не чаще раза в период, изменения за период склеиваются
+PRESENCE_BROADCAST_SECONDS = float(os.getenv("PRESENCE_BROADCAST_SECONDS", "1.0"))
+# Пользователь без правок дольше этого считается неактивным (active: false)
+PRESENCE_IDLE_SECONDS = float(os.getenv("PRESENCE_IDLE_SECONDS", "30.0"))
+# Остановка (drain): изменённые комнаты сохраняются параллельно не дольше DRAIN_TIMEOUT_SECONDS,
+# затем клиенты получают 1012 и переподключаются
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "10.0"))
+DRAIN_CONCURRENCY = int(os.getenv("DRAIN_CONCURRENCY", "20"))
+# Прогрев при запуске: последние редактировавшиеся документы загружаются до готовности /health
+PREWARM_DOCUMENTS = int(os.getenv("PREWARM_DOCUMENTS", "20"))
+PREWARM_WINDOW_HOURS = float(os.getenv("PREWARM_WINDOW_HOURS", "24.0"))
+PREWARM_TIMEOUT_SECONDS = float(os.getenv("PREWARM_TIMEOUT_SECONDS", "10.0"))
+# Сколько прогретая комната ждёт первого клиента
+PREWARM_IDLE_SECONDS = float(os.getenv("PREWARM_IDLE_SECONDS", "300.0"))
+# Кадры мультиплексированной сессии, пришедшие до завершения входа в комнату;
+# при переполнении сессия закрывается и клиент переподключается
+MUX_JOIN_BACKLOG = int(os.getenv("MUX_JOIN_BACKLOG", "256"))
 
 app = FastAPI(title="Collaboration Hub with CRDT")
+init_tracing("collaboration-hub")
+
+
+def _isoformat(ts: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts is not None else None
+
+
+class EditingSession:
+    """Сессия редактирования одного подключения (строка editing_sessions)"""
+
+    __slots__ = ("id", "doc_id", "user", "started_at", "last_activity", "ended_at")
+
+    def __init__(self, doc_id: str, user: str):
+        self.id = str(uuid.uuid4())
+        self.doc_id = doc_id
+        self.user = user
+        self.started_at = self.last_activity = time.time()
+        self.ended_at: Optional[float] = None
+
+    def is_active(self, now: float) -> bool:
+        return now - self.last_activity < PRESENCE_IDLE_SECONDS
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "document_id": self.doc_id,
+            "username": self.user,
+            "started_at": _isoformat(self.started_at),
+            "last_activity": _isoformat(self.last_activity),
+            "ended_at": _isoformat(self.ended_at),
+        }
+
+
+class SessionWriter:
+    """
+    Write-behind для editing_sessions: правка только обновляет last_activity в памяти
+    и помечает сессию изменённой, а раз в SESSION_FLUSH_SECONDS все изменённые сессии
+    уходят в Document Service одним запросом (один upsert в БД).
+    Если запись не удалась, сессии остаются в очереди до следующего периода.
+    """
+
+    def __init__(self):
+        self._dirty: Dict[str, EditingSession] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+
+    def mark(self, session: EditingSession):
+        self._dirty[session.id] = session
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(SESSION_FLUSH_SECONDS)
+            await self.flush()
+            # Переходы в неактивность не порождают событий: проверяем их здесь же
+            for room in list(rooms.values()):
+                if room.sessions:
+                    room.schedule_presence()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        with span("hub.flush_sessions", sessions=len(batch)):
+            written = await save_editing_sessions([s.to_record() for s in batch.values()])
+        if written is None:
+            self.failures += 1
+            for session_id, session in batch.items():
+                self._dirty.setdefault(session_id, session)
+            return
+        self.flushes += 1
+        self.rows_written += written
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._dirty),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "failures": self.failures,
+        }
+
+
+session_writer = SessionWriter()
 
 
 class DocumentRoom:
@@ -28,6 +152,23 @@ class DocumentRoom:
         self._save_task: Optional[asyncio.Task] = None
         self._last_change_ts: Optional[float] = None
         self._initialized = False
+        self._unload_task: Optional[asyncio.Task] = None
+        # Трасса последней правки: отложенное сохранение попадает в неё же
+        self._save_traceparent: Optional[str] = None
+        # Номер последней правки и последней сохранённой: комната "dirty", пока они различаются
+        self._change_seq = 0
+        self._saved_seq = 0
+        # CRDT-история комнаты строится заново при каждой загрузке из Document Service,
+        # поэтому state vector клиента имеет смысл только для той же эпохи
+        self.epoch = uuid.uuid4().hex
+        # Сессии редактирования по подключениям и состояние рассылки присутствия
+        self.sessions: Dict[Any, EditingSession] = {}
+        self._presence_task: Optional[asyncio.Task] = None
+        self._presence_sent_at = 0.0
+        self._presence_signature: Optional[tuple] = None
+        # Уровень доступа каждого подключения; update от подключений без права записи отбрасываются
+        self.permissions: Dict[Any, str] = {}
+        self.dropped_updates = 0
 
     async def initialize_from_document_service(self, initial_content: str):
         """Инициализация CRDT документа из Document Service"""
@@ -56,9 +197,11 @@ class DocumentRoom:
         """Получить полное обновление документа"""
         return Y.encode_state_as_update(self.ydoc)
 
-    async def schedule_save(self):
+    async def schedule_save(self, traceparent: Optional[str] = None):
         """Запускает отложенное сохранение"""
+        self._change_seq += 1
         self._last_change_ts = asyncio.get_event_loop().time()
+        self._save_traceparent = traceparent
         if self._save_task is None or self._save_task.done():
             self._save_task = asyncio.create_task(self._debounced_save_loop())
 
@@ -72,20 +215,124 @@ class DocumentRoom:
             elapsed = asyncio.get_event_loop().time() - (self._last_change_ts or 0)
             if elapsed >= SAVE_DEBOUNCE_SECONDS:
                 try:
-                    content = self.get_content()
-                    await save_document_to_document_service(self.doc_id, content)
-                    print(f"[save] doc={self.doc_id} saved successfully")
+                    with span("hub.save", parent=self._save_traceparent, doc_id=self.doc_id) as current:
+                        saved = await self.save()
+                        current.set_attribute("saved", saved)
+                    if saved:
+                        print(f"[save] doc={self.doc_id} saved successfully")
+                    else:
+                        print(f"[save error] doc={self.doc_id} Document Service rejected save")
                 except Exception as e:
                     print(f"[save error] doc={self.doc_id} err={e}")
                 break
 
+    @property
+    def dirty(self) -> bool:
+        return self._change_seq != self._saved_seq
+
+    async def save(self) -> bool:
+        """Сохранить текущее содержимое; правки, пришедшие во время сохранения, оставляют комнату dirty"""
+        seq = self._change_seq
+        saved = await save_document_to_document_service(self.doc_id, self.get_content())
+        if saved:
+            self._saved_seq = max(self._saved_seq, seq)
+        return saved
+
+    def touch(self, client):
+        """Правка клиента: обновить активность его сессии (только память)"""
+        session = self.sessions.get(client)
+        if session is None:
+            return
+        now = time.time()
+        was_idle = not session.is_active(now)
+        session.last_activity = now
+        session_writer.mark(session)
+        if was_idle:
+            self.schedule_presence()
+
+    def presence(self) -> List[Dict[str, Any]]:
+        """Кто сейчас в документе: по пользователю — число подключений и последняя активность"""
+        now = time.time()
+        users: Dict[str, Dict[str, Any]] = {}
+        for session in self.sessions.values():
+            entry = users.get(session.user)
+            if entry is None:
+                entry = users[session.user] = {
+                    "user": session.user,
+                    "connections": 0,
+                    "since": session.started_at,
+                    "last_activity": session.last_activity,
+                }
+            entry["connections"] += 1
+            entry["since"] = min(entry["since"], session.started_at)
+            entry["last_activity"] = max(entry["last_activity"], session.last_activity)
+        result = []
+        for user in sorted(users):
+            entry = users[user]
+            result.append({
+                "user": user,
+                "connections": entry["connections"],
+                "active": now - entry["last_activity"] < PRESENCE_IDLE_SECONDS,
+                "since": _isoformat(entry["since"]),
+                "lastActivity": _isoformat(entry["last_activity"]),
+            })
+        return result
+
+    def schedule_presence(self):
+        """Запланировать рассылку присутствия (не чаще PRESENCE_BROADCAST_SECONDS)"""
+        if self._presence_task is None or self._presence_task.done():
+            self._presence_task = asyncio.create_task(self._broadcast_presence())
+
+    async def _broadcast_presence(self):
+        loop = asyncio.get_event_loop()
+        delay = self._presence_sent_at + PRESENCE_BROADCAST_SECONDS - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Изменения во время рассылки запланируют следующую
+        self._presence_task = None
+
+        users = self.presence()
+        # Время активности в подпись не входит: рассылаем только смену состава и активности
+        signature = tuple((u["user"], u["connections"], u["active"]) for u in users)
+        if signature == self._presence_signature or not self.clients:
+            return
+        self._presence_signature = signature
+        self._presence_sent_at = loop.time()
+        try:
+            await broadcast_to_room(self, {"type": "presence", "users": users})
+        except Exception as e:
+            print(f"[presence error] doc={self.doc_id} err={e}")
+
 
 rooms: Dict[str, DocumentRoom] = {}
+# starting -> ready (после прогрева) -> draining (остановка: новые входы отклоняются)
+hub_status = "starting"
+_drain_task: Optional[asyncio.Task] = None
 
-async def verify_token_for_document(token: str, doc_id: str) -> bool:
-    """Проверка токена для доступа к документу"""
-    print(f"[auth] Skipping auth check for doc {doc_id} (MVP)")
-    return True
+async def recheck_room_permissions(room: DocumentRoom):
+    """
+    Перепроверка прав подключённых клиентов после изменения соавторов документа:
+    потерявшие доступ отключаются, у остальных обновляется уровень (например, edit -> view)
+    """
+    for client, session in list(room.sessions.items()):
+        try:
+            permission = await authorizer.permission(session.user, room.doc_id)
+        except AuthUnavailable as e:
+            print(f"[auth] Recheck failed doc={room.doc_id} user={session.user}: {e}")
+            continue
+        if client not in room.permissions:
+            continue
+        if permission is None:
+            print(f"[auth] Access revoked doc={room.doc_id} user={session.user}")
+            try:
+                await client.send_json({"type": "error", "message": "Access revoked"})
+                await client.close(code=status.WS_1008_POLICY_VIOLATION)
+            except Exception as e:
+                print(f"[auth] close error {e}")
+            await leave_room(room, client)
+        elif permission != room.permissions[client]:
+            room.permissions[client] = permission
+            await client.send_json({"type": "permission", "permission": permission})
 
 
 async def fetch_document_from_document_service(doc_id: str) -> Optional[dict]:
@@ -96,7 +343,7 @@ async def fetch_document_from_document_service(doc_id: str) -> Optional[dict]:
     url = f"{DOCUMENT_SERVICE_URL.rstrip('/')}/documents/{doc_id}"
     async with httpx.AsyncClient(timeout=5.0) as client:
         try:
-            r = await client.get(url)
+            r = await client.get(url, headers=inject_headers())
             if r.status_code == 200:
                 return r.json()
             else:
@@ -115,13 +362,47 @@ async def save_document_to_document_service(doc_id: str, content: str) -> bool:
             title = doc.get("title", "Untitled") if doc else "Untitled"
             
             payload = {"title": title, "content": content}
-            r = await client.put(url, json=payload)
+            r = await client.put(url, json=payload, headers=inject_headers())
             return r.status_code == 200
         except Exception as e:
             print(f"[save doc error] {e}")
             return False
 
 
+async def fetch_recent_documents(limit: int) -> List[dict]:
+    """Последние редактировавшиеся документы с содержимым (для прогрева комнат)"""
+    url = f"{DOCUMENT_SERVICE_URL.rstrip('/')}/editing-sessions/recent"
+    params = {"limit": limit, "hours": PREWARM_WINDOW_HOURS}
+    async with httpx.AsyncClient(timeout=PREWARM_TIMEOUT_SECONDS) as client:
+        try:
+            r = await client.get(url, params=params, headers=inject_headers())
+            if r.status_code == 200:
+                return r.json()
+            print(f"[prewarm] fetch failed status={r.status_code} body={r.text[:200]}")
+            return []
+        except Exception as e:
+            print(f"[prewarm error] {e}")
+            return []
+
+
+async def save_editing_sessions(records: List[Dict[str, Any]]) -> Optional[int]:
+    """
+    Пакетно записывает сессии редактирования в Document Service.
+    Возвращает число записанных строк или None при ошибке
+    """
+    url = f"{DOCUMENT_SERVICE_URL.rstrip('/')}/editing-sessions"
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        try:
+            r = await client.post(url, json={"sessions": records}, headers=inject_headers())
+            if r.status_code == 200:
+                return r.json().get("written", 0)
+            print(f"[sessions] write failed status={r.status_code} body={r.text[:200]}")
+            return None
+        except Exception as e:
+            print(f"[sessions error] {e}")
+            return None
+
+
 async def publish_event_to_broker(doc_id: str, event: Dict[str, Any], *, title: Optional[str] = None) -> None:
     """
     Публикует событие в Message Broker.
@@ -141,18 +422,23 @@ async def publish_event_to_broker(doc_id: str, event: Dict[str, Any], *, title:
     if not content_preview:
         content_preview = f"[{event_type}]"
 
-    payload = {
-        "document_id": doc_id,
-        "doc_id": doc_id,
-        "event_type": event_type,
-        "content": content_preview,
-        "timestamp": datetime.now().isoformat(),
-        "data": event,
-    }
+    with span("hub.publish_event_to_broker", doc_id=doc_id, event_type=event_type) as current:
+        payload = {
+            "document_id": doc_id,
+            "doc_id": doc_id,
+            "event_type": event_type,
+            "content": content_preview,
+            "timestamp": datetime.now().isoformat(),
+            "data": event,
+            "traceparent": current.traceparent,
+        }
+        await _post_event(url, payload, doc_id, event_type)
+
 
+async def _post_event(url: str, payload: Dict[str, Any], doc_id: str, event_type: str):
     try:
         async with httpx.AsyncClient(timeout=3.0) as client:
-            resp = await client.post(url, json=payload)
+            resp = await client.post(url, json=payload, headers=inject_headers())
             if 200 <= resp.status_code < 300:
                 print(f"[broker] published doc={doc_id} type={event_type}")
             else:
@@ -161,44 +447,89 @@ async def publish_event_to_broker(doc_id: str, event: Dict[str, Any], *, title:
         print(f"[broker publish error] {e}")
 
 
-@app.websocket("/ws/documents/{doc_id}")
-async def ws_document_endpoint(websocket: WebSocket, doc_id: str, token: Optional[str] = Query(None)):
+class MuxSession:
     """
-    WebSocket для работы с документом с CRDT-синхронизацией:
-    - Отправка initial state (state vector + full update)
-    - Получение CRDT updates от клиента
-    - Рассылка updates другим клиентам
-    - Автоматическое разрешение конфликтов через Yjs
-    - Отложенное сохранение (debounce)
+    Клиент, подключённый через мультиплексированное соединение API Gateway.
+    Снаружи ведёт себя как WebSocket (send_json/send_text/close), но пишет
+    кадры в общее соединение гейтвея с пометкой session id.
+    <query> в кадре open — query string клиента (token=...&resume=1).
+
+    Формат кадров (текст): строка заголовка, перевод строки, полезная нагрузка.
+      gateway -> hub:  "open <sid>\n<query>", "data <sid>\n<msg>", "close <sid>\n"
+      hub -> gateway:  "ack <sid>\n", "data <sid>\n<msg>",
+                       "bcast <exclude_sid|-> [traceparent]\n<msg>", "close <sid> <code>\n"
+    ack отправляется после авторизации и загрузки комнаты, перед initial sync:
+    гейтвей раздаёт рассылки bcast только сессиям, получившим ack.
     """
-    await websocket.accept()
+
+    def __init__(self, connection: WebSocket, session_id: str):
+        self.connection = connection
+        self.session_id = session_id
+        # Комната появляется после входа; до этого кадры data копятся в backlog
+        self.room: Optional["DocumentRoom"] = None
+        self.backlog: List[str] = []
+        # Гейтвей закрыл сессию, пока шёл вход в комнату
+        self.closed = False
+
+    @property
+    def application_state(self):
+        return self.connection.application_state
+
+    async def send_text(self, data: str):
+        await self.connection.send_text(f"data {self.session_id}\n{data}")
+
+    async def send_json(self, data: Any):
+        await self.send_text(json.dumps(data))
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        await self.connection.send_text(f"close {self.session_id} {code}\n")
+
+    async def ack(self):
+        await self.connection.send_text(f"ack {self.session_id}\n")
+
+
+async def join_room(client, doc_id: str, token: Optional[str], resume: bool = False) -> Optional[DocumentRoom]:
+    """
+    Авторизация, вход в комнату и initial sync.
+    При resume клиент уже хранит состояние документа: полный sync не отправляется,
+    клиент сам присылает sync_request со своим state vector и получает только diff.
+    Возвращает комнату или None, если клиент отклонён (клиенту уже отправлена ошибка).
+    """
+    if hub_status == "draining":
+        await client.send_json({"type": "error", "message": "Hub is restarting, reconnect"})
+        await client.close(code=status.WS_1012_SERVICE_RESTART)
+        return None
 
     if token is None:
-        await websocket.send_json({"type": "error", "message": "Missing token. Provide ?token=... in WS URL."})
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-        return
+        await client.send_json({"type": "error", "message": "Missing token. Provide ?token=... in WS URL."})
+        await client.close(code=status.WS_1008_POLICY_VIOLATION)
+        return None
 
-    authorized = await verify_token_for_document(token, doc_id)
-    if not authorized:
-        await websocket.send_json({"type": "error", "message": "Unauthorized"})
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-        return
-   
-    room = rooms.get(doc_id)
-    if room is None:
-        room = DocumentRoom(doc_id)
-        rooms[doc_id] = room
+    try:
+        permission = await authorizer.permission(token, doc_id)
+    except AuthUnavailable as e:
+        # Проверить права не удалось: клиент переподключится (1011), а не сдастся (1008)
+        print(f"[auth] Permission check failed doc={doc_id}: {e}")
+        await client.send_json({"type": "error", "message": "Authorization unavailable"})
+        await client.close(code=status.WS_1011_INTERNAL_ERROR)
+        return None
+    if permission is None:
+        await client.send_json({"type": "error", "message": "Unauthorized"})
+        await client.close(code=status.WS_1008_POLICY_VIOLATION)
+        return None
 
-    room.clients.add(websocket)
+    room = get_or_create_room(doc_id)
+    room.clients.add(client)
+    room.permissions[client] = permission
 
     async with room.lock:
         if not room._initialized:
             doc = await fetch_document_from_document_service(doc_id)
             if doc is None:
-                await websocket.send_json({"type": "error", "message": "Document not found"})
-                room.clients.discard(websocket)
-                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-                return
+                await client.send_json({"type": "error", "message": "Document not found"})
+                await leave_room(room, client)
+                await client.close(code=status.WS_1008_POLICY_VIOLATION)
+                return None
 
             if isinstance(doc, list) and len(doc) > 0:
                 doc = doc[0]
@@ -206,121 +537,441 @@ async def ws_document_endpoint(websocket: WebSocket, doc_id: str, token: Optiona
             await room.initialize_from_document_service(initial_content)
             print(f"[init] doc={doc_id} initialized with content length={len(initial_content)}")
 
+    if isinstance(client, MuxSession):
+        # Гейтвей раздаёт сессии рассылки комнаты только после ack. Sync считается
+        # после него, так что пропущенные до ack правки в него уже входят
+        await client.ack()
+
+    session = EditingSession(doc_id, token)
+    room.sessions[client] = session
+    session_writer.mark(session)
+    room.schedule_presence()
+
+    if resume:
+        return room
+
     try:
         state_vector = room.get_state_vector()
         full_update = room.get_full_update()
         
-        await websocket.send_json({
+        await client.send_json({
             "type": "sync",
             "stateVector": state_vector.hex(),
-            "update": full_update.hex()
+            "update": full_update.hex(),
+            "epoch": room.epoch,
+            "permission": permission
         })
         print(f"[sync] Sent initial sync to client for doc={doc_id}")
     except Exception as e:
         print(f"[sync error] {e}")
-        room.clients.discard(websocket)
-        return
+        await leave_room(room, client)
+        return None
+
+    return room
 
+
+async def handle_client_message(room: DocumentRoom, client, msg_text: str):
+    """Обработка одного сообщения клиента комнаты"""
+    doc_id = room.doc_id
     try:
-        while True:
-            msg_text = await websocket.receive_text()
-            try:
-                msg = json.loads(msg_text)
-            except json.JSONDecodeError:
-                await websocket.send_json({"type": "error", "message": "Invalid JSON"})
-                continue
-
-            if not isinstance(msg, dict) or "type" not in msg:
-                await websocket.send_json({"type": "error", "message": "Invalid message format"})
-                continue
-
-            mtype = msg["type"]
-            if mtype == "update":
-                # Получили CRDT update от клиента
-                update_hex = msg.get("update", "")
-                if not update_hex:
-                    await websocket.send_json({"type": "error", "message": "Missing update data"})
-                    continue
-                
-                try:
-                    update_bytes = bytes.fromhex(update_hex)
-                    
-                    async with room.lock:
-                        # Применяем update к CRDT документу
+        msg = json.loads(msg_text)
+    except json.JSONDecodeError:
+        await client.send_json({"type": "error", "message": "Invalid JSON"})
+        return
+
+    if not isinstance(msg, dict) or "type" not in msg:
+        await client.send_json({"type": "error", "message": "Invalid message format"})
+        return
+
+    mtype = msg["type"]
+    if client not in room.permissions:
+        # Клиент ещё не вошёл в комнату или уже исключён (отзыв доступа): ни правок, ни sync
+        await client.send_json({"type": "error", "message": "Unauthorized"})
+    elif mtype == "update" and not can_write(room.permissions.get(client)):
+        # Подключение только на чтение: правка не применяется и никуда не рассылается
+        room.dropped_updates += 1
+        await client.send_json({"type": "error", "message": "Read-only access"})
+    elif mtype == "update":
+        # Получили CRDT update от клиента
+        update_hex = msg.get("update", "")
+        if not update_hex:
+            await client.send_json({"type": "error", "message": "Missing update data"})
+            return
+        
+        try:
+            update_bytes = bytes.fromhex(update_hex)
+            
+            # traceparent от клиента связывает нажатие клавиши с обработкой во всех сервисах
+            with span("hub.update", parent=msg.get("traceparent"), doc_id=doc_id, bytes=len(update_bytes)) as current:
+                sent_at = msg.get("sentAt")
+                if isinstance(sent_at, (int, float)):
+                    current.set_attribute("client_to_hub_ms", round(time.time() * 1000 - sent_at, 3))
+                async with room.lock:
+                    # Применяем update к CRDT документу
+                    with span("hub.apply_update"):
                         room.apply_update(update_bytes)
-                        
-                        # Рассылаем update всем остальным клиентам
-                        payload = {
-                            "type": "update",
-                            "update": update_hex
-                        }
-                        await broadcast_to_room(room, payload, exclude=websocket)
-                        
-                        # Публикуем событие в Message Broker
-                        await publish_event_to_broker(doc_id, {
-                            "type": "crdt_update",
-                            "update": update_hex,
-                            "content_preview": room.get_content()[:100]
-                        })
-                        
-                        # Планируем сохранение
-                        await room.schedule_save()
-                        
-                    print(f"[update] Applied CRDT update for doc={doc_id}, content length={len(room.get_content())}")
-                    
-                except ValueError as e:
-                    await websocket.send_json({"type": "error", "message": f"Invalid update format: {e}"})
-                except Exception as e:
-                    print(f"[update error] {e}")
-                    await websocket.send_json({"type": "error", "message": f"Failed to apply update: {e}"})
+                    room.touch(client)
                     
-            elif mtype == "sync_request":
-                # Клиент запрашивает синхронизацию
-                try:
-                    state_vector_hex = msg.get("stateVector", "")
-                    if state_vector_hex:
-                        client_state = bytes.fromhex(state_vector_hex)
-                        # Вычисляем diff между состояниями
-                        diff_update = Y.encode_state_as_update(room.ydoc, client_state)
-                    else:
-                        # Если state vector не предоставлен, отправляем полное обновление
-                        diff_update = room.get_full_update()
+                    # Рассылаем update всем остальным клиентам
+                    payload = {
+                        "type": "update",
+                        "update": update_hex
+                    }
+                    await broadcast_to_room(room, payload, exclude=client)
                     
-                    await websocket.send_json({
-                        "type": "sync",
-                        "update": diff_update.hex()
+                    # Публикуем событие в Message Broker
+                    await publish_event_to_broker(doc_id, {
+                        "type": "crdt_update",
+                        "update": update_hex,
+                        "content_preview": room.get_content()[:100]
                     })
-                    print(f"[sync] Sent sync response for doc={doc_id}")
-                except Exception as e:
-                    print(f"[sync error] {e}")
-                    await websocket.send_json({"type": "error", "message": f"Sync failed: {e}"})
-            elif mtype == "ping":
-                await websocket.send_json({"type": "pong"})
+                    
+                    # Планируем сохранение
+                    await room.schedule_save(current.traceparent if current.context.sampled else None)
+                
+            print(f"[update] Applied CRDT update for doc={doc_id}, content length={len(room.get_content())}")
+            
+        except ValueError as e:
+            await client.send_json({"type": "error", "message": f"Invalid update format: {e}"})
+        except Exception as e:
+            print(f"[update error] {e}")
+            await client.send_json({"type": "error", "message": f"Failed to apply update: {e}"})
+            
+    elif mtype == "sync_request":
+        # Клиент запрашивает синхронизацию
+        try:
+            state_vector_hex = msg.get("stateVector", "")
+            client_epoch = msg.get("epoch")
+            reset = bool(client_epoch) and client_epoch != room.epoch
+            if state_vector_hex and not reset:
+                client_state = bytes.fromhex(state_vector_hex)
+                # Вычисляем diff между состояниями
+                diff_update = Y.encode_state_as_update(room.ydoc, client_state)
             else:
-                await websocket.send_json({"type": "error", "message": f"Unknown type {mtype}"})
+                # Если state vector не предоставлен или относится к другой эпохе,
+                # отправляем полное обновление
+                diff_update = room.get_full_update()
+            
+            await client.send_json({
+                "type": "sync",
+                "stateVector": room.get_state_vector().hex(),
+                "update": diff_update.hex(),
+                "epoch": room.epoch,
+                "reset": reset,
+                "permission": room.permissions.get(client)
+            })
+            print(f"[sync] Sent sync response for doc={doc_id}")
+        except Exception as e:
+            print(f"[sync error] {e}")
+            await client.send_json({"type": "error", "message": f"Sync failed: {e}"})
+    elif mtype == "ping":
+        await client.send_json({"type": "pong"})
+    else:
+        await client.send_json({"type": "error", "message": f"Unknown type {mtype}"})
+
+
+async def leave_room(room: DocumentRoom, client):
+    """
+    Выход клиента из комнаты. Уход последнего клиента сохраняет документ,
+    а комната выгружается через ROOM_IDLE_SECONDS, если никто не вернулся.
+    """
+    doc_id = room.doc_id
+    # Сессия закрывается и для клиента, уже выброшенного из комнаты неудачной рассылкой
+    room.permissions.pop(client, None)
+    session = room.sessions.pop(client, None)
+    if session is not None:
+        session.ended_at = time.time()
+        session_writer.mark(session)
+    if client not in room.clients:
+        return
+    room.clients.discard(client)
+    if room.clients:
+        room.schedule_presence()
+    elif hub_status == "draining":
+        # Комнату сохраняет drain, выгружать её до этого нельзя
+        return
+    else:
+        if room._initialized and room.dirty:
+            asyncio.create_task(room.save())
+            print(f"[cleanup] Saving doc={doc_id} before cleanup")
+        if room._initialized and ROOM_IDLE_SECONDS > 0:
+            if room._unload_task is None:
+                room._unload_task = asyncio.create_task(unload_room_when_idle(room))
+        else:
+            unload_room(room)
+
+
+def get_or_create_room(doc_id: str) -> DocumentRoom:
+    """Комната документа; отменяет запланированную выгрузку"""
+    room = rooms.get(doc_id)
+    if room is None:
+        room = DocumentRoom(doc_id)
+        rooms[doc_id] = room
+    elif room._unload_task is not None:
+        room._unload_task.cancel()
+        room._unload_task = None
+    return room
+
+
+async def unload_room_when_idle(room: DocumentRoom, delay: float = ROOM_IDLE_SECONDS):
+    await asyncio.sleep(delay)
+    room._unload_task = None
+    if not room.clients:
+        unload_room(room)
+
+
+def unload_room(room: DocumentRoom):
+    if rooms.get(room.doc_id) is room:
+        rooms.pop(room.doc_id, None)
+    print(f"[cleanup] Room for doc={room.doc_id} cleaned up")
+
+
+async def prewarm_rooms():
+    """
+    Загрузка последних редактировавшихся документов в память до готовности хаба:
+    клиенты, переподключающиеся после рестарта, не ждут холодной загрузки.
+    Ошибки прогрева не мешают запуску — комнаты тогда загружаются при первом входе.
+    """
+    global hub_status
+    try:
+        if PREWARM_DOCUMENTS > 0:
+            with span("hub.prewarm", limit=PREWARM_DOCUMENTS) as current:
+                docs = await fetch_recent_documents(PREWARM_DOCUMENTS)
+                for doc in docs:
+                    room = get_or_create_room(str(doc["id"]))
+                    async with room.lock:
+                        if not room._initialized:
+                            await room.initialize_from_document_service(doc.get("content") or "")
+                    if not room.clients and room._unload_task is None:
+                        room._unload_task = asyncio.create_task(unload_room_when_idle(room, PREWARM_IDLE_SECONDS))
+                current.set_attribute("rooms", len(docs))
+            print(f"[prewarm] {len(docs)} rooms loaded")
+    except Exception as e:
+        print(f"[prewarm error] {e}")
+    finally:
+        if hub_status == "starting":
+            hub_status = "ready"
+
+
+async def flush_dirty_rooms(deadline: float) -> List[str]:
+    """
+    Параллельно (не больше DRAIN_CONCURRENCY) сохраняет изменённые комнаты до deadline (loop.time()).
+    Возвращает doc_id комнат, которые сохранить не удалось.
+    """
+    dirty = [room for room in rooms.values() if room._initialized and room.dirty]
+    if not dirty:
+        return []
+
+    semaphore = asyncio.Semaphore(DRAIN_CONCURRENCY)
+
+    async def save(room: DocumentRoom) -> bool:
+        async with semaphore:
+            return await room.save()
+
+    tasks = {asyncio.create_task(save(room)): room for room in dirty}
+    timeout = max(0.0, deadline - asyncio.get_event_loop().time())
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    failed = [tasks[task].doc_id for task in pending]
+    failed += [tasks[task].doc_id for task in done if task.exception() is not None or not task.result()]
+    return failed
+
+
+async def drain(timeout: float = DRAIN_TIMEOUT_SECONDS) -> Dict[str, Any]:
+    """Остановка хаба без потери правок (повторные вызовы ждут уже идущий drain)"""
+    global _drain_task
+    if _drain_task is None:
+        _drain_task = asyncio.create_task(_drain(timeout))
+    return await asyncio.shield(_drain_task)
+
+
+async def _drain(timeout: float) -> Dict[str, Any]:
+    """
+    1. Новые входы отклоняются (1012), отложенные сохранения и выгрузки отменяются.
+    2. Изменённые комнаты сохраняются параллельно, пока клиенты ещё подключены.
+    3. Клиенты закрываются с 1012 (клиент переподключается к новому экземпляру).
+    4. Правки, успевшие прийти во время шага 2, сохраняются в пределах того же deadline,
+       сессии редактирования закрываются и записываются.
+    """
+    global hub_status
+    hub_status = "draining"
+    deadline = asyncio.get_event_loop().time() + timeout
+    with span("hub.drain", rooms=len(rooms)) as current:
+        for room in rooms.values():
+            for task in (room._save_task, room._unload_task):
+                if task is not None:
+                    task.cancel()
+            room._unload_task = None
+
+        failed = await flush_dirty_rooms(deadline)
+
+        clients_closed = 0
+        for room in list(rooms.values()):
+            for client in list(room.clients):
+                try:
+                    await client.close(code=status.WS_1012_SERVICE_RESTART)
+                    clients_closed += 1
+                except Exception as e:
+                    print(f"[drain] close error doc={room.doc_id} err={e}")
+
+        failed = await flush_dirty_rooms(deadline)
+
+        now = time.time()
+        for room in rooms.values():
+            for session in room.sessions.values():
+                session.ended_at = now
+                session_writer.mark(session)
+        await session_writer.close()
+
+        current.set_attribute("failed", len(failed))
+    summary = {"rooms": len(rooms), "clients_closed": clients_closed, "unsaved": failed}
+    print(f"[drain] {summary}")
+    return summary
+
+
+@app.websocket("/ws/documents/{doc_id}")
+async def ws_document_endpoint(
+    websocket: WebSocket,
+    doc_id: str,
+    token: Optional[str] = Query(None),
+    resume: bool = Query(False),
+):
+    """
+    WebSocket для работы с документом с CRDT-синхронизацией:
+    - Отправка initial state (state vector + full update);
+      с ?resume=1 — только diff по state vector из sync_request клиента
+    - Получение CRDT updates от клиента
+    - Рассылка updates другим клиентам
+    - Автоматическое разрешение конфликтов через Yjs
+    - Отложенное сохранение (debounce)
+    """
+    await websocket.accept()
+
+    room = await join_room(websocket, doc_id, token, resume)
+    if room is None:
+        return
+
+    try:
+        while True:
+            msg_text = await websocket.receive_text()
+            await handle_client_message(room, websocket, msg_text)
 
     except WebSocketDisconnect:
         print(f"[disconnect] Client disconnected from doc={doc_id}")
     except Exception as e:
         print(f"[ws error] {e}")
     finally:
-        room.clients.discard(websocket)
-        if not room.clients:
-            if room._initialized:
-                content = room.get_content()
-                asyncio.create_task(save_document_to_document_service(room.doc_id, content))
-                print(f"[cleanup] Saving doc={doc_id} before cleanup")
-            rooms.pop(doc_id, None)
-            print(f"[cleanup] Room for doc={doc_id} cleaned up")
-
-
-async def broadcast_to_room(room: DocumentRoom, payload: dict, exclude: Optional[WebSocket] = None):
-    """Рассылка сообщений всем клиентам комнаты"""
-    dead: Set[WebSocket] = set()
+        await leave_room(room, websocket)
+
+
+@app.websocket("/ws/documents/{doc_id}/mux")
+async def ws_document_mux_endpoint(websocket: WebSocket, doc_id: str):
+    """
+    Мультиплексированное соединение API Gateway: одно соединение на документ
+    несёт сессии всех клиентов гейтвея (формат кадров — см. MuxSession).
+    Рассылки уходят в соединение одним кадром bcast, гейтвей раздаёт их локально.
+    Вход в комнату (авторизация, загрузка документа) идёт в отдельной задаче на
+    сессию и не задерживает кадры остальных сессий.
+    """
+    await websocket.accept()
+    sessions: Dict[str, MuxSession] = {}
+    joins: Set[asyncio.Task] = set()
+
+    async def join(session: MuxSession, token: Optional[str], resume: bool):
+        room = None
+        try:
+            room = await join_room(session, doc_id, token, resume)
+            # Кадры, пришедшие во время входа, обрабатываются по порядку
+            while room is not None and session.backlog and not session.closed:
+                await handle_client_message(room, session, session.backlog.pop(0))
+        except Exception as e:
+            print(f"[mux join error] doc={doc_id}: {e}")
+            if room is not None:
+                await leave_room(room, session)
+            room = None
+
+        if room is None or session.closed:
+            if sessions.get(session.session_id) is session:
+                del sessions[session.session_id]
+            if room is not None:
+                await leave_room(room, session)
+            return
+        session.room = room
+
+    try:
+        while True:
+            frame = await websocket.receive_text()
+            header, _, payload = frame.partition("\n")
+            kind, _, session_id = header.partition(" ")
+
+            if kind == "open":
+                session = MuxSession(websocket, session_id)
+                params = parse_qs(payload)
+                token = params.get("token", [None])[0]
+                resume = params.get("resume", ["0"])[0].lower() in ("1", "true", "yes")
+                sessions[session_id] = session
+                task = asyncio.create_task(join(session, token, resume))
+                joins.add(task)
+                task.add_done_callback(joins.discard)
+            elif kind == "data":
+                session = sessions.get(session_id)
+                if session is None:
+                    continue
+                if session.room is not None:
+                    await handle_client_message(session.room, session, payload)
+                elif len(session.backlog) < MUX_JOIN_BACKLOG:
+                    session.backlog.append(payload)
+                else:
+                    del sessions[session_id]
+                    session.closed = True
+                    await session.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            elif kind == "close":
+                session = sessions.pop(session_id, None)
+                if session is None:
+                    continue
+                if session.room is not None:
+                    await leave_room(session.room, session)
+                else:
+                    # Задача входа сама выведет сессию из комнаты
+                    session.closed = True
+            else:
+                print(f"[mux] Unknown frame kind={kind!r} for doc={doc_id}")
+
+    except WebSocketDisconnect:
+        print(f"[mux disconnect] Gateway disconnected from doc={doc_id}, sessions={len(sessions)}")
+    except Exception as e:
+        print(f"[mux error] {e}")
+    finally:
+        for session in list(sessions.values()):
+            if session.room is not None:
+                await leave_room(session.room, session)
+            else:
+                session.closed = True
+        sessions.clear()
+
+
+async def broadcast_to_room(room: DocumentRoom, payload: dict, exclude: Optional[Any] = None):
+    """
+    Рассылка сообщений всем клиентам комнаты.
+    Сессиям одного мультиплексированного соединения гейтвея уходит один кадр bcast.
+    """
+    with span("hub.broadcast_to_room", doc_id=room.doc_id, clients=len(room.clients)) as current:
+        if current.context.sampled:
+            payload = {**payload, "traceparent": current.traceparent}
+        await _broadcast(room, payload, exclude, current.traceparent if current.context.sampled else None)
+
+
+async def _broadcast(room: DocumentRoom, payload: dict, exclude: Optional[Any], traceparent: Optional[str]):
+    dead: Set[Any] = set()
     data = json.dumps(payload)
+    mux_connections: Dict[WebSocket, list] = {}
     for ws in list(room.clients):
         if ws is exclude:
             continue
+        if isinstance(ws, MuxSession):
+            mux_connections.setdefault(ws.connection, []).append(ws)
+            continue
         try:
             if ws.application_state == WebSocketState.CONNECTED:
                 await ws.send_text(data)
@@ -329,23 +980,116 @@ async def broadcast_to_room(room: DocumentRoom, payload: dict, exclude: Optional
         except Exception as e:
             print(f"[broadcast error] {e}")
             dead.add(ws)
+
+    for connection, sessions in mux_connections.items():
+        excluded = "-"
+        if isinstance(exclude, MuxSession) and exclude.connection is connection:
+            excluded = exclude.session_id
+        try:
+            if connection.application_state == WebSocketState.CONNECTED:
+                header = f"bcast {excluded} {traceparent}" if traceparent else f"bcast {excluded}"
+                await connection.send_text(f"{header}\n{data}")
+            else:
+                dead.update(sessions)
+        except Exception as e:
+            print(f"[broadcast error] {e}")
+            dead.update(sessions)
+
     for d in dead:
         room.clients.discard(d)
 
 
+@app.on_event("startup")
+async def startup():
+    """Запуск фоновой записи сессий редактирования и прогрева комнат"""
+    session_writer.start()
+    asyncio.create_task(prewarm_rooms())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    Drain на случай остановки без POST /admin/drain. uvicorn к этому моменту уже
+    закрыл WebSocket-соединения, поэтому остаётся сохранить изменённые комнаты
+    """
+    await drain()
+
+
+@app.post("/admin/drain")
+async def admin_drain(request: Request, timeout: float = Query(DRAIN_TIMEOUT_SECONDS, gt=0)):
+    """
+    Подготовка к остановке (preStop): сохранить изменённые комнаты и отправить клиентов
+    переподключаться. Только с X-Internal-Token (см. internal_api.py).
+    После ответа процесс завершается сам: осушённый хаб не принимает входы и не должен
+    оставаться запущенным с /health = 503 (перезапуск — через restart policy).
+    """
+    require_internal(request)
+    summary = await drain(timeout)
+    return JSONResponse(summary, background=BackgroundTask(os.kill, os.getpid(), signal.SIGTERM))
+
+
+@app.post("/authz/prefetch")
+async def authz_prefetch(request: Request, request_data: dict):
+    """
+    Подгрузка прав пользователя на список документов одним запросом к Document Service
+    (фронтенд вызывает через гейтвей после загрузки дашборда, чтобы вход в документ не ждал проверки).
+    Тело: {"user": username, "document_ids": [...]}; только с X-Internal-Token.
+    """
+    require_internal(request)
+    user = request_data.get("user")
+    doc_ids = request_data.get("document_ids", [])
+    if not isinstance(user, str) or not user or not isinstance(doc_ids, list):
+        return JSONResponse({"error": "user and document_ids are required"}, status_code=400)
+    try:
+        permissions = await authorizer.prefetch(user, [str(doc_id) for doc_id in doc_ids])
+    except AuthUnavailable as e:
+        return JSONResponse({"error": f"Authorization unavailable: {e}"}, status_code=503)
+    return {"prefetched": len(permissions)}
+
+
+@app.post("/authz/invalidate")
+async def authz_invalidate(request: Request, request_data: dict):
+    """
+    Сброс кэша прав (Document Service вызывает после изменения соавторов или удаления документа).
+    Тело: {"document_id": ...}; подключённые к документу клиенты перепроверяются в фоне.
+    Только с X-Internal-Token.
+    """
+    require_internal(request)
+    doc_id = request_data.get("document_id")
+    removed = authorizer.invalidate(str(doc_id) if doc_id else None)
+    targets = [rooms[doc_id]] if doc_id in rooms else ([] if doc_id else list(rooms.values()))
+    for room in targets:
+        if room.sessions:
+            asyncio.create_task(recheck_room_permissions(room))
+    return {"invalidated": removed, "rooms_rechecked": len(targets)}
+
+
 @app.get("/health")
 async def health():
+    """200 только в состоянии ready: во время прогрева и drain — 503"""
     return JSONResponse({
-        "status": "ok",
+        "status": "ok" if hub_status == "ready" else hub_status,
         "rooms": len(rooms),
+        "dirty_rooms": sum(1 for room in rooms.values() if room.dirty),
         "crdt_enabled": True,
-        "message_broker_configured": bool(MESSAGE_BROKER_URL)
-    })
+        "message_broker_configured": bool(MESSAGE_BROKER_URL),
+        "editing_sessions": session_writer.stats(),
+        "authz": authorizer.stats(),
+    }, status_code=200 if hub_status == "ready" else 503)
+
+
+@app.get("/debug/traces")
+async def debug_traces(trace_id: Optional[str] = None, limit: int = 1000):
+    """Последние сэмплированные спаны хаба (для tools/trace_report.py; только при TRACE_DEBUG_ENDPOINT)"""
+    if not TRACE_DEBUG_ENDPOINT:
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return exporter.spans(trace_id, limit)
 
 
 @app.get("/rooms/{doc_id}/info")
-async def room_info(doc_id: str):
-    """Получить информацию о комнате документа"""
+async def room_info(doc_id: str, request: Request):
+    """Получить информацию о комнате документа (только с X-Internal-Token)"""
+    require_internal(request)
     room = rooms.get(doc_id)
     if not room:
         return JSONResponse({"error": "Room not found"}, status_code=404)
@@ -356,3 +1100,17 @@ async def room_info(doc_id: str):
         "content_length": len(room.get_content()),
         "initialized": room._initialized
     })
+
+
+@app.get("/rooms/{doc_id}/presence")
+async def room_presence(doc_id: str, request: Request):
+    """
+    Кто сейчас в документе — из памяти хаба, без обращения к БД.
+    Только с X-Internal-Token: права на документ проверяет гейтвей.
+    """
+    require_internal(request)
+    room = rooms.get(doc_id)
+    return JSONResponse({
+        "doc_id": doc_id,
+        "users": room.presence() if room else [],
+    })
@@ -1,3 +1,6 @@
+-- Нечёткий поиск по заголовкам
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- Создание таблицы пользователей
 CREATE TABLE IF NOT EXISTS users (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -12,6 +15,17 @@ CREATE TABLE IF NOT EXISTS documents (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     title VARCHAR(500) NOT NULL DEFAULT 'Без названия',
     content TEXT NOT NULL DEFAULT '',
+    -- Короткий текстовый фрагмент для списков документов (без HTML-разметки)
+    snippet VARCHAR(200) GENERATED ALWAYS AS (
+        left(btrim(regexp_replace(content, '<[^>]*>', ' ', 'g')), 200)
+    ) STORED,
+    -- Полнотекстовый индекс (русская и английская морфология), пересчитывается при каждом сохранении строки
+    search_vector TSVECTOR GENERATED ALWAYS AS (
+        setweight(to_tsvector('russian', title), 'A') ||
+        setweight(to_tsvector('english', title), 'A') ||
+        setweight(to_tsvector('russian', regexp_replace(content, '<[^>]*>', ' ', 'g')), 'B') ||
+        setweight(to_tsvector('english', regexp_replace(content, '<[^>]*>', ' ', 'g')), 'B')
+    ) STORED,
     owner_id UUID REFERENCES users(id) ON DELETE SET NULL,
     created_at TIMESTAMPTZ DEFAULT NOW(),
     updated_at TIMESTAMPTZ DEFAULT NOW()
@@ -27,11 +41,13 @@ CREATE TABLE IF NOT EXISTS document_collaborators (
 );
 
 -- Таблица для хранения истории изменений документов (для откатов и аудита)
+-- kind = 'keyframe': content хранит полный текст; kind = 'delta': дельту к предыдущей версии
 CREATE TABLE IF NOT EXISTS document_versions (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     document_id UUID REFERENCES documents(id) ON DELETE CASCADE,
     content TEXT NOT NULL,
     version_number INTEGER NOT NULL,
+    kind VARCHAR(10) NOT NULL DEFAULT 'keyframe' CHECK (kind IN ('keyframe', 'delta')),
     created_by UUID REFERENCES users(id),
     created_at TIMESTAMPTZ DEFAULT NOW()
 );
@@ -46,13 +62,31 @@ CREATE TABLE IF NOT EXISTS editing_sessions (
     last_activity TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Миграция баз, созданных до появления вычисляемых колонок:
+-- CREATE TABLE IF NOT EXISTS существующую таблицу не меняет
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS snippet VARCHAR(200) GENERATED ALWAYS AS (
+    left(btrim(regexp_replace(content, '<[^>]*>', ' ', 'g')), 200)
+) STORED;
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS search_vector TSVECTOR GENERATED ALWAYS AS (
+    setweight(to_tsvector('russian', title), 'A') ||
+    setweight(to_tsvector('english', title), 'A') ||
+    setweight(to_tsvector('russian', regexp_replace(content, '<[^>]*>', ' ', 'g')), 'B') ||
+    setweight(to_tsvector('english', regexp_replace(content, '<[^>]*>', ' ', 'g')), 'B')
+) STORED;
+ALTER TABLE document_versions ADD COLUMN IF NOT EXISTS kind VARCHAR(10) NOT NULL DEFAULT 'keyframe'
+    CHECK (kind IN ('keyframe', 'delta'));
+
 -- Индексы для производительности
 CREATE INDEX IF NOT EXISTS idx_document_versions_doc_id ON document_versions(document_id);
 CREATE INDEX IF NOT EXISTS idx_document_versions_created_at ON document_versions(created_at DESC);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_document_versions_doc_number ON document_versions(document_id, version_number DESC);
 CREATE INDEX IF NOT EXISTS idx_editing_sessions_doc_user ON editing_sessions(document_id, user_id);
 CREATE INDEX IF NOT EXISTS idx_editing_sessions_activity ON editing_sessions(last_activity);
 CREATE INDEX IF NOT EXISTS idx_documents_owner ON documents(owner_id);
 CREATE INDEX IF NOT EXISTS idx_documents_updated ON documents(updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_documents_owner_updated ON documents(owner_id, updated_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_documents_search ON documents USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS idx_documents_title_trgm ON documents USING GIN (title gin_trgm_ops);
 CREATE INDEX IF NOT EXISTS idx_collaborators_user ON document_collaborators(user_id);
 
 INSERT INTO users (id, email, username) VALUES 
@@ -1,29 +1,259 @@
+import asyncio
 import asyncpg
 import os
-from typing import List, Optional, Dict, Any
+import base64
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional, Dict, Any, Tuple
 import json
+import time
 from cache import cache
+from tracing import record_span
+
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 200
+PERMISSION_LEVELS = ('view', 'comment', 'edit')
+
+# Пулы соединений. Реплика (DATABASE_REPLICA_URL) необязательна: без неё всё идёт в primary
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_REPLICA_POOL_MIN_SIZE = int(os.getenv("DB_REPLICA_POOL_MIN_SIZE", str(DB_POOL_MIN_SIZE)))
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv("DB_REPLICA_POOL_MAX_SIZE", str(DB_POOL_MAX_SIZE)))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10.0"))
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME", "300.0"))
+# Кэш подготовленных выражений на соединение (0 — выключен, нужно за pgbouncer в transaction mode)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_MAX_CACHED_STATEMENT_LIFETIME = int(os.getenv("DB_MAX_CACHED_STATEMENT_LIFETIME", "300"))
+# Чтения уходят в primary, пока отставание реплики больше порога или реплика недоступна
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5.0"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "2.0"))
+
+# Ошибки получения соединения с репликой, после которых чтение повторяется в primary
+REPLICA_UNAVAILABLE_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+)
+
+# Отставание реплики: 0, если всё полученное WAL уже применено (primary простаивает)
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END::float8 AS lag
+"""
+
+
+def encode_cursor(updated_at: datetime, doc_id) -> str:
+    """Курсор keyset-пагинации: позиция (updated_at, id) последней строки страницы"""
+    raw = f"{updated_at.isoformat()}|{doc_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Разбор курсора; ValueError при некорректном значении"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        ts, doc_id = raw.split("|", 1)
+        return datetime.fromisoformat(ts), str(uuid.UUID(doc_id))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def _trace_query(record):
+    """Колбэк asyncpg: каждый запрос — спан db.query в текущей трассе (если она сэмплирована)"""
+    end = time.time()
+    record_span(
+        "db.query",
+        end - record.elapsed,
+        end,
+        query=" ".join(record.query.split())[:200],
+        error=repr(record.exception) if record.exception else None,
+    )
+
+
+async def _init_connection(conn):
+    conn.add_query_logger(_trace_query)
+
+
+class PoolStats:
+    """Время ожидания свободного соединения в пуле (секунды)"""
+
+    def __init__(self, window: int = 1000):
+        self.acquires = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent: deque = deque(maxlen=window)
+
+    def observe(self, waited: float):
+        self.acquires += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self._recent.append(waited)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self._recent:
+            return None
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def to_dict(self, pool) -> Dict[str, Any]:
+        return {
+            "size": pool.get_size() if pool else 0,
+            "idle": pool.get_idle_size() if pool else 0,
+            "max_size": pool.get_max_size() if pool else 0,
+            "acquires": self.acquires,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": self.total_wait / self.acquires * 1000 if self.acquires else None,
+            "wait_p50_ms": _ms(self.percentile(0.5)),
+            "wait_p99_ms": _ms(self.percentile(0.99)),
+            "wait_max_ms": self.max_wait * 1000,
+        }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return seconds * 1000 if seconds is not None else None
+
+
+async def create_pool(dsn: Optional[str], min_size: int, max_size: int):
+    return await asyncpg.create_pool(
+        dsn=dsn,
+        min_size=min_size,
+        max_size=max_size,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_cached_statement_lifetime=DB_MAX_CACHED_STATEMENT_LIFETIME,
+        init=_init_connection
+    )
+
 
 class Database:
     def __init__(self):
         self.pool = None
+        # Необязательная реплика для чтений, которые допускают небольшое отставание
+        self.replica_pool = None
+        self.replica_lag: Optional[float] = None
+        self.replica_healthy = False
+        self.replica_fallbacks = 0
+        self._replica_monitor: Optional[asyncio.Task] = None
+        self.primary_stats = PoolStats()
+        self.replica_stats = PoolStats()
 
-    async def connect(self):
-        """Установка соединения с PostgreSQL"""
-        self.pool = await asyncpg.create_pool(
-            dsn=os.getenv('DATABASE_URL'),
-            min_size=1,
-            max_size=10
+    async def connect(self, dsn: Optional[str] = None, replica_dsn: Optional[str] = None):
+        """Установка соединения с PostgreSQL (и с репликой, если задан DATABASE_REPLICA_URL)"""
+        self.pool = await create_pool(
+            dsn or os.getenv('DATABASE_URL'), DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE
         )
+        replica_dsn = replica_dsn or os.getenv('DATABASE_REPLICA_URL')
+        if replica_dsn:
+            try:
+                self.replica_pool = await create_pool(
+                    replica_dsn, DB_REPLICA_POOL_MIN_SIZE, DB_REPLICA_POOL_MAX_SIZE
+                )
+            except REPLICA_UNAVAILABLE_ERRORS as e:
+                print(f"[db] Replica unavailable at startup, reads go to primary: {e}")
+                return
+            await self.check_replica()
+            self._replica_monitor = asyncio.create_task(self._monitor_replica())
 
     async def close(self):
         """Закрытие соединения"""
+        if self._replica_monitor:
+            self._replica_monitor.cancel()
+        if self.replica_pool:
+            await self.replica_pool.close()
         if self.pool:
             await self.pool.close()
+
+    async def check_replica(self):
+        """Обновить отставание реплики; недоступная или отстающая реплика не получает чтения"""
+        try:
+            async with self._acquire(self.replica_pool, self.replica_stats) as conn:
+                self.replica_lag = await conn.fetchval(REPLICA_LAG_QUERY, timeout=DB_REPLICA_CHECK_INTERVAL)
+            healthy = self.replica_lag <= DB_REPLICA_MAX_LAG_SECONDS
+        except Exception as e:
+            self.replica_lag = None
+            healthy = False
+            if self.replica_healthy:
+                print(f"[db] Replica check failed, reads go to primary: {e}")
+        if healthy != self.replica_healthy:
+            print(f"[db] Replica {'enabled' if healthy else 'disabled'} for reads (lag={self.replica_lag})")
+        self.replica_healthy = healthy
+
+    async def _monitor_replica(self):
+        while True:
+            await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL)
+            await self.check_replica()
+
+    @asynccontextmanager
+    async def _acquire(self, pool, stats: PoolStats):
+        started = time.perf_counter()
+        try:
+            conn = await pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            raise
+        waited = time.perf_counter() - started
+        stats.observe(waited)
+        if waited >= 0.001:
+            end = time.time()
+            record_span("db.pool_wait", end - waited, end, replica=pool is self.replica_pool)
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    def acquire(self):
+        """Соединение с primary (записи и чтения, которым нужна актуальность)"""
+        return self._acquire(self.pool, self.primary_stats)
+
+    @asynccontextmanager
+    async def acquire_read(self):
+        """
+        Соединение для чтения: реплика, если она доступна и отстаёт не больше
+        DB_REPLICA_MAX_LAG_SECONDS, иначе primary. Ошибка получения соединения
+        с репликой переводит чтение (и следующие до проверки) на primary.
+        """
+        if self.replica_pool is not None and self.replica_healthy:
+            replica = self._acquire(self.replica_pool, self.replica_stats)
+            try:
+                conn = await replica.__aenter__()
+            except REPLICA_UNAVAILABLE_ERRORS as e:
+                print(f"[db] Replica acquire failed, falling back to primary: {e}")
+                self.replica_healthy = False
+                self.replica_fallbacks += 1
+            else:
+                try:
+                    yield conn
+                finally:
+                    await replica.__aexit__(None, None, None)
+                return
+
+        async with self.acquire() as conn:
+            yield conn
+
+    def stats(self) -> Dict[str, Any]:
+        result = {"primary": self.primary_stats.to_dict(self.pool)}
+        if self.replica_pool is not None:
+            result["replica"] = {
+                **self.replica_stats.to_dict(self.replica_pool),
+                "healthy": self.replica_healthy,
+                "lag_seconds": self.replica_lag,
+                "max_lag_seconds": DB_REPLICA_MAX_LAG_SECONDS,
+                "fallbacks": self.replica_fallbacks,
+            }
+        return result
     
-    async def get_user_by_username(self, username: str) -> Optional[Dict]:
-        """Получить пользователя по username"""
-        async with self.pool.acquire() as conn:
+    async def get_user_by_username(self, username: str, primary: bool = False) -> Optional[Dict]:
+        """Получить пользователя по username (primary=True — без отставания реплики)"""
+        async with (self.acquire() if primary else self.acquire_read()) as conn:
             row = await conn.fetchrow("""
                 SELECT id, email, username, created_at
                 FROM users 
@@ -32,32 +262,238 @@ class Database:
             return dict(row) if row else None
 
     async def get_documents(self) -> List[Dict]:
-        """Получить список всех документов"""
-        async with self.pool.acquire() as conn:
+        """Получить список всех документов (без содержимого)"""
+        async with self.acquire_read() as conn:
             rows = await conn.fetch("""
-                SELECT id, title, content, created_at, updated_at 
+                SELECT id, title, snippet, owner_id, created_at, updated_at 
                 FROM documents 
-                ORDER BY updated_at DESC
+                ORDER BY updated_at DESC, id DESC
             """)
             return [dict(row) for row in rows]
         
     async def get_user_documents(self, user_id: str) -> List[Dict]:
-        """Получить документы пользователя по owner_id"""
-        async with self.pool.acquire() as conn:
+        """Получить документы пользователя по owner_id (без содержимого)"""
+        async with self.acquire_read() as conn:
             rows = await conn.fetch("""
-                SELECT id, title, content, owner_id, created_at, updated_at 
+                SELECT id, title, snippet, owner_id, created_at, updated_at 
                 FROM documents 
                 WHERE owner_id = $1
-                ORDER BY updated_at DESC
+                ORDER BY updated_at DESC, id DESC
             """, user_id)
             return [dict(row) for row in rows]
+
+    async def get_shared_documents(self, user_id: str) -> List[Dict]:
+        """Получить документы, к которым пользователь имеет доступ через collaborator"""
+        async with self.acquire_read() as conn:
+            rows = await conn.fetch("""
+                SELECT d.id, d.title, d.snippet, d.owner_id, 
+                       d.created_at, d.updated_at,
+                       u.username as owner_username
+                FROM documents d
+                JOIN document_collaborators dc ON d.id = dc.document_id
+                LEFT JOIN users u ON d.owner_id = u.id
+                WHERE dc.user_id = $1
+                ORDER BY d.updated_at DESC, d.id DESC
+            """, user_id)
+            return [dict(row) for row in rows]
+
+    async def list_documents(
+        self,
+        owner_id: Optional[str] = None,
+        shared_with: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = LIST_DEFAULT_LIMIT,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Страница списка документов: только сводные поля и snippet.
+        Keyset-пагинация по (updated_at, id), фильтр по владельцу или соавтору.
+        Возвращает (документы, курсор следующей страницы или None).
+        """
+        limit = max(1, min(limit, LIST_MAX_LIMIT))
+        conditions = []
+        params: List[Any] = []
+        joins = "LEFT JOIN users u ON d.owner_id = u.id"
+        permission = "NULL::varchar AS permission_level"
+
+        if owner_id:
+            params.append(parse_uuid(owner_id, "owner_id"))
+            conditions.append(f"d.owner_id = ${len(params)}")
+        if shared_with:
+            params.append(parse_uuid(shared_with, "shared_with"))
+            joins += f" JOIN document_collaborators dc ON dc.document_id = d.id AND dc.user_id = ${len(params)}"
+            permission = "dc.permission_level"
+        if cursor:
+            cursor_ts, cursor_id = decode_cursor(cursor)
+            params.extend([cursor_ts, cursor_id])
+            conditions.append(f"(d.updated_at, d.id) < (${len(params) - 1}, ${len(params)}::uuid)")
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(limit + 1)
+
+        async with self.acquire_read() as conn:
+            rows = await conn.fetch(f"""
+                SELECT d.id, d.title, d.snippet, d.owner_id,
+                       d.created_at, d.updated_at,
+                       u.username AS owner_username,
+                       {permission}
+                FROM documents d
+                {joins}
+                {where}
+                ORDER BY d.updated_at DESC, d.id DESC
+                LIMIT ${len(params)}
+            """, *params)
+
+        documents = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = documents[-1]
+            next_cursor = encode_cursor(last["updated_at"], last["id"])
+        return documents, next_cursor
         
+    async def get_user_dashboard(
+        self,
+        username: str,
+        limit: int = LIST_DEFAULT_LIMIT,
+        my_cursor: Optional[str] = None,
+        shared_cursor: Optional[str] = None,
+        include_my: bool = True,
+        include_shared: bool = True,
+    ) -> Optional[Dict]:
+        """
+        Данные для страницы списка документов за один запрос к БД:
+        пользователь, его документы и документы, открытые ему соавторами.
+        Возвращает None, если пользователь не найден.
+        """
+        limit = max(1, min(limit, LIST_MAX_LIMIT))
+        my_ts, my_id = decode_cursor(my_cursor) if my_cursor else (None, None)
+        sh_ts, sh_id = decode_cursor(shared_cursor) if shared_cursor else (None, None)
+
+        async with self.acquire_read() as conn:
+            row = await conn.fetchrow("""
+                WITH u AS (
+                    SELECT id, email, username, created_at
+                    FROM users
+                    WHERE username = $1
+                ),
+                own AS (
+                    SELECT d.id, d.title, d.snippet, d.owner_id,
+                           d.created_at, d.updated_at,
+                           ARRAY(
+                               SELECT cu.username
+                               FROM document_collaborators c
+                               JOIN users cu ON cu.id = c.user_id
+                               WHERE c.document_id = d.id
+                           ) AS shared_to
+                    FROM documents d
+                    JOIN u ON d.owner_id = u.id
+                    WHERE $3::boolean
+                      AND ($4::timestamptz IS NULL OR (d.updated_at, d.id) < ($4, $5::uuid))
+                    ORDER BY d.updated_at DESC, d.id DESC
+                    LIMIT $2 + 1
+                ),
+                shared AS (
+                    SELECT d.id, d.title, d.snippet, d.owner_id,
+                           d.created_at, d.updated_at,
+                           ou.username AS owner_username,
+                           dc.permission_level
+                    FROM document_collaborators dc
+                    JOIN u ON dc.user_id = u.id
+                    JOIN documents d ON d.id = dc.document_id
+                    LEFT JOIN users ou ON ou.id = d.owner_id
+                    WHERE $6::boolean
+                      AND ($7::timestamptz IS NULL OR (d.updated_at, d.id) < ($7, $8::uuid))
+                    ORDER BY d.updated_at DESC, d.id DESC
+                    LIMIT $2 + 1
+                )
+                SELECT
+                    (SELECT row_to_json(u) FROM u) AS "user",
+                    COALESCE((SELECT json_agg(own ORDER BY own.updated_at DESC, own.id DESC) FROM own), '[]') AS my_docs,
+                    COALESCE((SELECT json_agg(shared ORDER BY shared.updated_at DESC, shared.id DESC) FROM shared), '[]') AS shared_docs
+            """, username, limit,
+                include_my, my_ts, my_id,
+                include_shared, sh_ts, sh_id)
+
+        if row is None or row["user"] is None:
+            return None
+
+        return {
+            "user": json.loads(row["user"]),
+            "my_docs": self._page_from_json(row["my_docs"], limit),
+            "shared_docs": self._page_from_json(row["shared_docs"], limit),
+        }
+
+    @staticmethod
+    def _page_from_json(data: str, limit: int) -> Dict:
+        """Страница {items, next_cursor} из json_agg (на одну строку больше limit)"""
+        rows = json.loads(data)
+        items = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = encode_cursor(datetime.fromisoformat(last["updated_at"]), last["id"])
+        return {"items": items, "next_cursor": next_cursor}
+
+    async def search_documents(self, user_id: str, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """
+        Полнотекстовый (russian + english) и нечёткий (pg_trgm по заголовку) поиск
+        среди документов, которыми пользователь владеет или к которым имеет доступ.
+        Результаты ранжированы; подсветка считается только для строк страницы.
+        """
+        async with self.acquire_read() as conn:
+            rows = await conn.fetch("""
+                WITH q AS (
+                    SELECT websearch_to_tsquery('russian', $2) || websearch_to_tsquery('english', $2) AS query
+                ),
+                page AS (
+                    SELECT d.id, d.title, d.content, d.owner_id, d.updated_at,
+                           ts_rank_cd(d.search_vector, q.query) + similarity(d.title, $2) AS rank
+                    FROM documents d, q
+                    WHERE (d.owner_id = $1 OR EXISTS (
+                              SELECT 1 FROM document_collaborators dc
+                              WHERE dc.document_id = d.id AND dc.user_id = $1
+                          ))
+                      AND (d.search_vector @@ q.query OR d.title % $2)
+                    ORDER BY rank DESC, d.updated_at DESC, d.id DESC
+                    LIMIT $3 OFFSET $4
+                )
+                SELECT page.id, page.owner_id, page.updated_at, page.rank,
+                       page.title,
+                       u.username AS owner_username,
+                       CASE WHEN strpos(ru.title_highlight, '<mark>') > 0 THEN ru.title_highlight
+                            ELSE ts_headline('english', esc.title, q.query,
+                                             'HighlightAll=true, StartSel=<mark>, StopSel=</mark>')
+                       END AS title_highlight,
+                       CASE WHEN strpos(ru.highlight, '<mark>') > 0 THEN ru.highlight
+                            ELSE ts_headline('english', esc.body, q.query,
+                                             'MaxFragments=2, MinWords=5, MaxWords=20, StartSel=<mark>, StopSel=</mark>')
+                       END AS highlight
+                FROM page
+                CROSS JOIN q
+                -- Текст экранируется до ts_headline: в подсветке размечены только <mark>
+                CROSS JOIN LATERAL (
+                    SELECT replace(replace(replace(replace(page.title,
+                               '&', '&amp;'), '<', '&lt;'), '>', '&gt;'), '"', '&quot;') AS title,
+                           replace(replace(replace(replace(regexp_replace(page.content, '<[^>]*>', ' ', 'g'),
+                               '&', '&amp;'), '<', '&lt;'), '>', '&gt;'), '"', '&quot;') AS body
+                ) esc
+                -- Сначала русская конфигурация; если она ничего не выделила — английская
+                CROSS JOIN LATERAL (
+                    SELECT ts_headline('russian', esc.title, q.query,
+                                       'HighlightAll=true, StartSel=<mark>, StopSel=</mark>') AS title_highlight,
+                           ts_headline('russian', esc.body, q.query,
+                                       'MaxFragments=2, MinWords=5, MaxWords=20, StartSel=<mark>, StopSel=</mark>') AS highlight
+                ) ru
+                LEFT JOIN users u ON u.id = page.owner_id
+                ORDER BY page.rank DESC, page.updated_at DESC, page.id DESC
+            """, user_id, query, limit, offset)
+            return [dict(row) for row in rows]
+
     async def get_document(self, doc_id: str) -> Optional[Dict]:
         # cached = await cache.get_document(doc_id)
         # if cached:
         #     return cached
 
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow("""
                 SELECT id, title, content, created_at, updated_at 
                 FROM documents 
@@ -72,7 +508,7 @@ class Database:
 
     async def create_document(self, title: str, content: str, owner_id: str) -> Dict:
         """Создать новый документ"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow("""
                 INSERT INTO documents (title, content, owner_id) 
                 VALUES ($1, $2, $3) 
@@ -80,14 +516,32 @@ class Database:
             """, title, content, owner_id)
             return dict(row)
 
-    async def update_document(self, doc_id: str, content: str) -> Optional[Dict]:
-        async with self.pool.acquire() as conn:
+    async def get_document_updated_at(self, doc_id: str) -> Optional[datetime]:
+        """Только updated_at документа (для проверки ETag без чтения content)"""
+        async with self.acquire() as conn:
+            return await conn.fetchval("""
+                SELECT updated_at FROM documents WHERE id = $1
+            """, doc_id)
+
+    async def update_document(
+        self,
+        doc_id: str,
+        content: str,
+        expected_updated_at: Optional[datetime] = None,
+    ) -> Optional[Dict]:
+        """
+        Обновить содержимое документа.
+        С expected_updated_at обновление выполняется только если документ
+        не менялся с этого момента (If-Match); иначе возвращается None.
+        """
+        async with self.acquire() as conn:
             row = await conn.fetchrow("""
                 UPDATE documents 
                 SET content = $1, updated_at = CURRENT_TIMESTAMP 
                 WHERE id = $2 
+                  AND ($3::timestamptz IS NULL OR updated_at = $3)
                 RETURNING id, title, content, created_at, updated_at
-            """, content, doc_id)
+            """, content, doc_id, expected_updated_at)
             
             if row:
                 document = dict(row)
@@ -96,7 +550,7 @@ class Database:
 
     async def delete_document(self, doc_id: str) -> bool:
         """Удалить документ"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             result = await conn.execute("""
                 DELETE FROM documents WHERE id = $1
             """, doc_id)
@@ -104,7 +558,7 @@ class Database:
 
     async def create_user(self, email: str, username: str) -> Dict:
         """Создать пользователя"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow("""
                 INSERT INTO users (email, username) 
                 VALUES ($1, $2) 
@@ -114,7 +568,7 @@ class Database:
 
     async def add_collaborator(self, doc_id: str, user_id: str, permission: str = 'edit') -> bool:
         """Добавить collaborator к документу"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             try:
                 await conn.execute("""
                     INSERT INTO document_collaborators (document_id, user_id, permission_level) 
@@ -124,4 +578,151 @@ class Database:
             except asyncpg.UniqueViolationError:
                 return False
 
+    async def upsert_collaborators(self, doc_id: str, grants: Dict[str, str]) -> Optional[Dict[str, str]]:
+        """
+        Добавить/обновить соавторов одним INSERT ... ON CONFLICT DO UPDATE.
+        grants: {user_id: permission_level}.
+        Возвращает {user_id: 'added' | 'updated'} для существующих пользователей
+        или None, если документ не найден.
+        """
+        user_ids = list(grants.keys())
+        permissions = [grants[user_id] for user_id in user_ids]
+        async with self.acquire() as conn:
+            try:
+                rows = await conn.fetch("""
+                    INSERT INTO document_collaborators (document_id, user_id, permission_level)
+                    SELECT $1, u.id, req.permission_level
+                    FROM unnest($2::uuid[], $3::varchar[]) AS req(user_id, permission_level)
+                    JOIN users u ON u.id = req.user_id
+                    ON CONFLICT (document_id, user_id)
+                    DO UPDATE SET permission_level = EXCLUDED.permission_level
+                    RETURNING user_id, (xmax = 0) AS inserted
+                """, doc_id, user_ids, permissions)
+            except asyncpg.ForeignKeyViolationError:
+                return None
+        return {str(row["user_id"]): "added" if row["inserted"] else "updated" for row in rows}
+
+    async def update_collaborator_permissions(self, doc_id: str, grants: Dict[str, str]) -> Dict[str, str]:
+        """
+        Изменить уровни доступа уже существующих соавторов одним UPDATE.
+        Возвращает {user_id: 'updated'} для затронутых строк.
+        """
+        user_ids = list(grants.keys())
+        permissions = [grants[user_id] for user_id in user_ids]
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                UPDATE document_collaborators dc
+                SET permission_level = req.permission_level
+                FROM unnest($2::uuid[], $3::varchar[]) AS req(user_id, permission_level)
+                WHERE dc.document_id = $1 AND dc.user_id = req.user_id
+                RETURNING dc.user_id
+            """, doc_id, user_ids, permissions)
+        return {str(row["user_id"]): "updated" for row in rows}
+
+    async def remove_collaborators(self, doc_id: str, user_ids: List[str]) -> Dict[str, str]:
+        """
+        Удалить соавторов одним DELETE.
+        Возвращает {user_id: 'removed'} для удалённых строк.
+        """
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                DELETE FROM document_collaborators
+                WHERE document_id = $1 AND user_id = ANY($2::uuid[])
+                RETURNING user_id
+            """, doc_id, user_ids)
+        return {str(row["user_id"]): "removed" for row in rows}
+
+    async def get_effective_permissions(self, user_id: str, doc_ids: List[str]) -> Dict[str, Optional[str]]:
+        """
+        Эффективные права пользователя на набор документов одним запросом.
+        Возвращает {doc_id: 'owner' | 'edit' | 'comment' | 'view' | None};
+        None — доступа нет или документ не существует.
+        """
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT d.id,
+                       CASE WHEN d.owner_id = $1 THEN 'owner'
+                            ELSE dc.permission_level
+                       END AS permission
+                FROM unnest($2::uuid[]) AS req(id)
+                JOIN documents d ON d.id = req.id
+                LEFT JOIN document_collaborators dc
+                       ON dc.document_id = d.id AND dc.user_id = $1
+            """, user_id, doc_ids)
+        permissions: Dict[str, Optional[str]] = {doc_id: None for doc_id in doc_ids}
+        for row in rows:
+            permissions[str(row["id"])] = row["permission"]
+        return permissions
+
+    async def upsert_editing_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        """
+        Пакетная запись сессий редактирования от Collaboration Hub одним INSERT ... ON CONFLICT.
+        sessions: [{id, document_id, username, started_at, last_activity, ended_at}].
+        last_activity только растёт, ended_at после закрытия сессии не сбрасывается.
+        Сессии удалённых документов пропускаются; возвращает число записанных строк.
+        """
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                INSERT INTO editing_sessions (id, document_id, user_id, started_at, last_activity, ended_at)
+                SELECT req.id, req.document_id, u.id, req.started_at, req.last_activity, req.ended_at
+                FROM unnest($1::uuid[], $2::uuid[], $3::varchar[],
+                            $4::timestamptz[], $5::timestamptz[], $6::timestamptz[])
+                     AS req(id, document_id, username, started_at, last_activity, ended_at)
+                JOIN documents d ON d.id = req.document_id
+                LEFT JOIN users u ON u.username = req.username
+                ON CONFLICT (id) DO UPDATE SET
+                    last_activity = GREATEST(editing_sessions.last_activity, EXCLUDED.last_activity),
+                    ended_at = COALESCE(EXCLUDED.ended_at, editing_sessions.ended_at)
+                RETURNING id
+            """,
+                [s["id"] for s in sessions],
+                [s["document_id"] for s in sessions],
+                [s["username"] for s in sessions],
+                [s["started_at"] for s in sessions],
+                [s["last_activity"] for s in sessions],
+                [s["ended_at"] for s in sessions],
+            )
+        return len(rows)
+
+    async def get_recently_edited_documents(self, limit: int, hours: float) -> List[Dict]:
+        """
+        Документы с самой свежей активностью в editing_sessions за последние hours часов
+        (для прогрева комнат Collaboration Hub), вместе с содержимым.
+        Читается primary: хаб инициализирует комнату этим содержимым, отставание недопустимо.
+        """
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT d.id, d.title, d.content, d.updated_at
+                FROM (
+                    SELECT document_id, MAX(last_activity) AS last_activity
+                    FROM editing_sessions
+                    WHERE last_activity > NOW() - $2::float8 * INTERVAL '1 hour'
+                    GROUP BY document_id
+                    ORDER BY last_activity DESC
+                    LIMIT $1
+                ) recent
+                JOIN documents d ON d.id = recent.document_id
+                ORDER BY recent.last_activity DESC
+            """, limit, hours)
+            return [dict(row) for row in rows]
+
+
+def normalize_uuids(values: List[Any]) -> Tuple[List[str], List[Any]]:
+    """Разделить значения на корректные UUID (без дублей, в исходном порядке) и невалидные"""
+    valid: Dict[str, None] = {}
+    invalid: List[Any] = []
+    for value in values:
+        try:
+            valid[str(uuid.UUID(str(value)))] = None
+        except ValueError:
+            invalid.append(value)
+    return list(valid), invalid
+
+def parse_uuid(value: Any, name: str) -> str:
+    """Нормализованный UUID параметра; ValueError вместо ошибки asyncpg на некорректном вводе"""
+    valid, _ = normalize_uuids([value])
+    if not valid:
+        raise ValueError(f"Invalid {name}")
+    return valid[0]
+
 db = Database()
\ No newline at end of file
@@ -1,11 +1,15 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import asyncio
 import httpx
-from typing import List, Dict, Any
+from datetime import datetime, timezone, timedelta
+from typing import List, Dict, Any, Optional
 
-from database import db
+from database import db, normalize_uuids, LIST_DEFAULT_LIMIT, LIST_MAX_LIMIT, PERMISSION_LEVELS
+from versions import versions
+from tracing import init_tracing, span, inject_headers, TracingMiddleware, exporter, TRACE_DEBUG_ENDPOINT
+from internal_api import internal_headers
 
 app = FastAPI(title="Document Service", version="1.0.0")
 
@@ -15,7 +19,68 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
+app.add_middleware(TracingMiddleware, name="documents.http")
+init_tracing("documents-service")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Collaboration Hub и API Gateway кэшируют права доступа: после изменения соавторов
+# кэш документа сбрасывается в обоих (API_GATEWAY_URL — один адрес: остальные реплики
+# гейтвея за балансировщиком узнают об изменении не позже чем через AUTH_CACHE_TTL)
+COLLAB_HUB_URL = os.getenv("COLLAB_HUB_URL", "http://localhost:8002")
+API_GATEWAY_URL = os.getenv("API_GATEWAY_URL", "http://localhost:8000")
+PERMISSION_CACHE_URLS = [url for url in (COLLAB_HUB_URL, API_GATEWAY_URL) if url]
+
+
+def document_etag(updated_at: datetime) -> str:
+    """Сильный ETag документа: updated_at в микросекундах"""
+    return f'"{(updated_at - EPOCH) // timedelta(microseconds=1)}"'
+
+
+def parse_etag(etag: str) -> Optional[datetime]:
+    """Обратное преобразование ETag в updated_at; None для чужих/слабых ETag"""
+    value = etag.strip()
+    if value.startswith("W/") or len(value) < 2 or value[0] != '"' or value[-1] != '"':
+        return None
+    try:
+        return EPOCH + timedelta(microseconds=int(value[1:-1]))
+    except ValueError:
+        return None
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Слабое сравнение ETag для If-None-Match (список через запятую или *)"""
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def notify_permissions_changed(doc_id: str):
+    """Сбросить кэш прав документа в Collaboration Hub и API Gateway (в фоне, ответ клиенту не ждёт)"""
+    for base_url in PERMISSION_CACHE_URLS:
+        asyncio.create_task(_post_permissions_changed(base_url, doc_id))
+
+
+async def _post_permissions_changed(base_url: str, doc_id: str):
+    try:
+        async with httpx.AsyncClient(timeout=3.0) as client:
+            r = await client.post(
+                f"{base_url.rstrip('/')}/authz/invalidate",
+                json={"document_id": doc_id},
+                headers=inject_headers(internal_headers()),
+            )
+            r.raise_for_status()
+    except Exception as e:
+        # Кэш всё равно истечёт через AUTH_CACHE_TTL
+        print(f"[authz] Failed to invalidate permission cache at {base_url} for doc {doc_id}: {e}")
+
 
 async def message_broker_poller():
     """Фоновый процесс для чтения событий из Message Broker"""
@@ -52,24 +117,37 @@ async def message_broker_poller():
             print(f"[Broker Poller Error] {e}")
             await asyncio.sleep(5)
 
+def queue_delay_ms(event: dict) -> Optional[float]:
+    """Время от публикации события (timestamp хаба) до обработки здесь"""
+    try:
+        published = datetime.fromisoformat(event["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    now = datetime.now(published.tzinfo) if published.tzinfo else datetime.now()
+    return round((now - published).total_seconds() * 1000, 3)
+
+
 async def process_broker_event(event: dict):
     """Обработка события из брокера"""
-    try:
-        doc_id = event.get("document_id")
-        content = event.get("content", "")
-        
-        if doc_id and content:
-            print(f"[Broker] Processing event for doc {doc_id}")
-            
-            result = await db.update_document(doc_id, content)
+    with span("documents.broker_event", parent=event.get("traceparent"),
+              doc_id=event.get("document_id"), event_type=event.get("event_type")) as current:
+        current.set_attribute("queue_delay_ms", queue_delay_ms(event))
+        try:
+            doc_id = event.get("document_id")
+            content = event.get("content", "")
             
-            if result:
-                print(f"[Broker] Document {doc_id} updated successfully")
-            else:
-                print(f"[Broker] Failed to update document {doc_id}")
+            if doc_id and content:
+                print(f"[Broker] Processing event for doc {doc_id}")
                 
-    except Exception as e:
-        print(f"[Broker Event Error] {e}")
+                result = await db.update_document(doc_id, content)
+                
+                if result:
+                    print(f"[Broker] Document {doc_id} updated successfully")
+                else:
+                    print(f"[Broker] Failed to update document {doc_id}")
+                    
+        except Exception as e:
+            print(f"[Broker Event Error] {e}")
 
 
 @app.on_event("startup")
@@ -82,6 +160,7 @@ async def startup():
 @app.on_event("shutdown")
 async def shutdown():
     """Отключение от БД при остановке"""
+    await versions.flush()
     await db.close()
 
 # API Endpoints
@@ -94,32 +173,85 @@ async def get_documents():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+@app.get("/documents/list")
+async def list_documents(
+    owner_id: Optional[str] = None,
+    shared_with: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+):
+    """
+    Лёгкий список документов (без content) с keyset-пагинацией.
+    Следующая страница запрашивается с cursor=next_cursor.
+    """
+    try:
+        documents, next_cursor = await db.list_documents(
+            owner_id=owner_id,
+            shared_with=shared_with,
+            cursor=cursor,
+            limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    return {"items": documents, "next_cursor": next_cursor}
+
+@app.get("/documents/search")
+async def search_documents(
+    user_id: str,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=LIST_MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+):
+    """
+    Поиск по документам пользователя (свои + общие) с ранжированием и подсветкой.
+    title_highlight и highlight — экранированный HTML, размечены только <mark>.
+    """
+    valid_user, _ = normalize_uuids([user_id])
+    if not valid_user:
+        raise HTTPException(status_code=400, detail="Invalid user id")
+
+    try:
+        results = await db.search_documents(valid_user[0], q, limit=limit, offset=offset)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    next_offset = offset + limit if len(results) == limit else None
+    return {"items": results, "next_offset": next_offset}
+
 @app.get("/documents/{doc_id}")
-async def get_document(doc_id: str):
-    """Получить документ по ID"""
+async def get_document(
+    doc_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
+    """Получить документ по ID (поддерживает If-None-Match -> 304)"""
+    doc_id = parse_document_id(doc_id)
+    if if_none_match:
+        # Дешёвая проверка без чтения content
+        updated_at = await db.get_document_updated_at(doc_id)
+        if updated_at is None:
+            raise HTTPException(status_code=404, detail="Document not found")
+        etag = document_etag(updated_at)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
     document = await db.get_document(doc_id)
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
+    response.headers["ETag"] = document_etag(document["updated_at"])
+    response.headers["Cache-Control"] = "private, no-cache"
     return document
 
 @app.get("/documents/shared/{user_id}")
 async def get_shared_documents(user_id: str):
     """Получить документы, к которым пользователь имеет доступ через collaborator"""
+    user_id = parse_user_id(user_id)
     try:
-        async with db.pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT d.id, d.title, d.content, d.owner_id, 
-                       d.created_at, d.updated_at,
-                       u.username as owner_username
-                FROM documents d
-                JOIN document_collaborators dc ON d.id = dc.document_id
-                JOIN users u ON d.owner_id = u.id
-                WHERE dc.user_id = $1
-                ORDER BY d.updated_at DESC
-            """, user_id)
-            
-            documents = [dict(row) for row in rows]
-            return documents
+        documents = await db.get_shared_documents(user_id)
+        return documents
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -131,9 +263,41 @@ async def get_user_by_username_endpoint(username: str):
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
+@app.get("/users/{username}/dashboard")
+async def get_user_dashboard(
+    username: str,
+    my_cursor: Optional[str] = None,
+    shared_cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    include: str = "my,shared",
+):
+    """
+    Пользователь + его документы + общие документы одним SQL-запросом.
+    include ограничивает набор секций (например, при подгрузке следующей страницы).
+    """
+    sections = {part.strip() for part in include.split(",")}
+    try:
+        dashboard = await db.get_user_dashboard(
+            username,
+            limit=limit,
+            my_cursor=my_cursor,
+            shared_cursor=shared_cursor,
+            include_my="my" in sections,
+            include_shared="shared" in sections,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    if dashboard is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return dashboard
+
 @app.get("/documents/user/{user_id}")
 async def get_user_documents(user_id: str):
     """Получить документы пользователя"""
+    user_id = parse_user_id(user_id)
     try:
         documents = await db.get_user_documents(user_id)
         return documents
@@ -150,7 +314,8 @@ async def create_document(document_data: dict):
     try:
         
         if username:
-            user = await db.get_user_by_username(username)
+            # primary: только что созданный пользователь может ещё не дойти до реплики
+            user = await db.get_user_by_username(username, primary=True)
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
             owner_id = user["id"]
@@ -162,59 +327,293 @@ async def create_document(document_data: dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create document: {str(e)}")
 
+def parse_document_id(doc_id: str) -> str:
+    """Нормализованный UUID документа; 400 для некорректного id (вместо ошибки asyncpg -> 500)"""
+    valid, _ = normalize_uuids([doc_id])
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid document id")
+    return valid[0]
+
+
+def parse_user_id(user_id: str) -> str:
+    """Нормализованный UUID пользователя; 400 для некорректного id"""
+    valid, _ = normalize_uuids([user_id])
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid user id")
+    return valid[0]
+
+
+def parse_collaborator_grants(request_data: dict) -> tuple:
+    """
+    Разбор тела запроса управления соавторами.
+    Поддерживает {"user_ids": [...], "permission": "edit"}
+    и {"collaborators": [{"user_id": ..., "permission": ...}, ...]}.
+    Возвращает (grants {user_id: permission}, невалидные user_id).
+    """
+    default_permission = request_data.get("permission", "edit")
+    entries = request_data.get("collaborators")
+    if entries is None:
+        entries = [{"user_id": user_id} for user_id in request_data.get("user_ids", [])]
+    if not entries:
+        raise HTTPException(status_code=400, detail="No users specified")
+
+    grants = {}
+    invalid = []
+    for entry in entries:
+        user_id = entry.get("user_id") if isinstance(entry, dict) else None
+        permission = entry.get("permission", default_permission) if isinstance(entry, dict) else None
+        if permission not in PERMISSION_LEVELS:
+            raise HTTPException(status_code=400, detail=f"Invalid permission: {permission}")
+        valid, bad = normalize_uuids([user_id])
+        invalid.extend(bad)
+        for normalized in valid:
+            grants[normalized] = permission
+    return grants, invalid
+
+
+def collaborator_results(requested: list, statuses: dict, invalid: list, missing: str) -> list:
+    """Результат по каждому пользователю в порядке запроса"""
+    results = [
+        {"user_id": user_id, "status": statuses.get(user_id, missing), "success": user_id in statuses}
+        for user_id in requested
+    ]
+    results.extend({"user_id": user_id, "status": "invalid", "success": False} for user_id in invalid)
+    return results
+
+
 @app.post("/documents/{doc_id}/collaborators")
 async def add_collaborators(doc_id: str, request_data: dict):
-    """Добавить collaborator к документу"""
+    """Добавить collaborators к документу (или обновить их права) одним запросом"""
+    doc_id = parse_document_id(doc_id)
+    grants, invalid = parse_collaborator_grants(request_data)
+
     try:
-        user_ids = request_data.get("user_ids", [])
-        permission = request_data.get("permission", "edit")
-        
-        if not user_ids:
-            raise HTTPException(status_code=400, detail="No users specified")
-        
-        results = []
-        for user_id in user_ids:
-            success = await db.add_collaborator(doc_id, user_id, permission)
-            results.append({
-                "user_id": user_id,
-                "success": success
-            })
-        
-        if any(r["success"] for r in results):
-            return {
-                "message": "Collaborators added successfully",
-                "results": results
-            }
-        else:
-            raise HTTPException(status_code=400, detail="Failed to add collaborators")
-            
+        # Без валидных пользователей upsert не выполняется, поэтому документ проверяется заранее
+        if await db.get_document_updated_at(doc_id) is None:
+            raise HTTPException(status_code=404, detail="Document not found")
+        statuses = await db.upsert_collaborators(doc_id, grants) if grants else {}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to add collaborators: {str(e)}")
 
+    if statuses is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    results = collaborator_results(list(grants), statuses, invalid, missing="user_not_found")
+    if not any(r["success"] for r in results):
+        raise HTTPException(status_code=400, detail="Failed to add collaborators")
+    notify_permissions_changed(doc_id)
+
+    return {
+        "message": "Collaborators added successfully",
+        "results": results
+    }
+
+@app.patch("/documents/{doc_id}/collaborators")
+async def update_collaborators(doc_id: str, request_data: dict):
+    """Изменить права существующих collaborators одним запросом"""
+    doc_id = parse_document_id(doc_id)
+    grants, invalid = parse_collaborator_grants(request_data)
+
+    try:
+        statuses = await db.update_collaborator_permissions(doc_id, grants) if grants else {}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to update collaborators: {str(e)}")
+    if statuses:
+        notify_permissions_changed(doc_id)
+
+    return {"results": collaborator_results(list(grants), statuses, invalid, missing="not_collaborator")}
+
+@app.delete("/documents/{doc_id}/collaborators")
+async def remove_collaborators(doc_id: str, request_data: dict):
+    """Удалить collaborators документа одним запросом"""
+    doc_id = parse_document_id(doc_id)
+    user_ids, invalid = normalize_uuids(request_data.get("user_ids", []))
+    if not user_ids and not invalid:
+        raise HTTPException(status_code=400, detail="No users specified")
+
+    try:
+        statuses = await db.remove_collaborators(doc_id, user_ids) if user_ids else {}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to remove collaborators: {str(e)}")
+    if statuses:
+        notify_permissions_changed(doc_id)
+
+    return {"results": collaborator_results(user_ids, statuses, invalid, missing="not_collaborator")}
+
+@app.post("/users/{user_id}/permissions")
+async def get_effective_permissions(user_id: str, request_data: dict):
+    """
+    Эффективные права пользователя на список документов (для авторизации в Collaboration Hub).
+    Тело: {"document_ids": [...]}; ответ: {"permissions": {doc_id: 'owner'|'edit'|'comment'|'view'|null}}
+    """
+    valid_user, _ = normalize_uuids([user_id])
+    if not valid_user:
+        raise HTTPException(status_code=400, detail="Invalid user id")
+
+    doc_ids, invalid = normalize_uuids(request_data.get("document_ids", []))
+    try:
+        permissions = await db.get_effective_permissions(valid_user[0], doc_ids) if doc_ids else {}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    for doc_id in invalid:
+        permissions[str(doc_id)] = None
+    return {"user_id": valid_user[0], "permissions": permissions}
+
 @app.put("/documents/{doc_id}")
-async def update_document(doc_id: str, document_data: dict):
-    """Обновить документ"""
+async def update_document(
+    doc_id: str,
+    document_data: dict,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+):
+    """Обновить документ (If-Match -> 412, если документ изменился с момента чтения)"""
     title = document_data.get("title")
     content = document_data.get("content")
     
     if title is None or content is None:
         raise HTTPException(status_code=400, detail="Title and content are required")
+    doc_id = parse_document_id(doc_id)
+
+    expected_updated_at = None
+    if if_match and if_match.strip() != "*":
+        expected_updated_at = parse_etag(if_match)
+        if expected_updated_at is None:
+            raise HTTPException(status_code=412, detail="Precondition failed")
     
-    document = await db.update_document(doc_id, content)
+    document = await db.update_document(doc_id, content, expected_updated_at)
     if not document:
+        current = await db.get_document_updated_at(doc_id) if expected_updated_at is not None else None
+        if current is not None:
+            # Актуальный ETag в ответе: клиент может повторить запрос без отдельного GET
+            raise HTTPException(
+                status_code=412,
+                detail="Document was modified concurrently",
+                headers={"ETag": document_etag(current)},
+            )
         raise HTTPException(status_code=404, detail="Document not found")
+    response.headers["ETag"] = document_etag(document["updated_at"])
+
+    # Версия пишется в фоне, сохранение её не ждёт; некорректный user_id -> версия без автора
+    created_by, _ = normalize_uuids([document_data.get("user_id")])
+    versions.record_async(doc_id, content, created_by[0] if created_by else None)
     
     return document
 
+@app.get("/documents/{doc_id}/versions")
+async def list_document_versions(
+    doc_id: str,
+    before: Optional[int] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+):
+    """Список версий документа (новые сверху); before — номер версии для следующей страницы"""
+    doc_id = parse_document_id(doc_id)
+    try:
+        return await versions.list_versions(doc_id, before=before, limit=limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+@app.get("/documents/{doc_id}/versions/{version_number}")
+async def get_document_version(doc_id: str, version_number: int):
+    """Содержимое версии документа"""
+    doc_id = parse_document_id(doc_id)
+    try:
+        version = await versions.get_version(doc_id, version_number)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if not version:
+        raise HTTPException(status_code=404, detail="Version not found")
+    return version
+
+@app.get("/documents/{doc_id}/versions/{from_version}/diff/{to_version}")
+async def diff_document_versions(doc_id: str, from_version: int, to_version: int):
+    """Дельта между двумя версиями документа"""
+    doc_id = parse_document_id(doc_id)
+    try:
+        diff = await versions.diff_versions(doc_id, from_version, to_version)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if not diff:
+        raise HTTPException(status_code=404, detail="Version not found")
+    return diff
+
 @app.delete("/documents/{doc_id}")
 async def delete_document(doc_id: str):
     """Удалить документ"""
+    doc_id = parse_document_id(doc_id)
     success = await db.delete_document(doc_id)
     if not success:
         raise HTTPException(status_code=404, detail="Document not found")
+    notify_permissions_changed(doc_id)
     
     return {"message": "Document deleted successfully"}
 
+def parse_editing_session(record: Any) -> Optional[Dict[str, Any]]:
+    """Запись сессии от Collaboration Hub -> параметры upsert; None для некорректных"""
+    if not isinstance(record, dict):
+        return None
+    ids, _ = normalize_uuids([record.get("id"), record.get("document_id")])
+    if len(ids) != 2:
+        return None
+    try:
+        started_at = datetime.fromisoformat(record["started_at"])
+        last_activity = datetime.fromisoformat(record["last_activity"])
+        ended_at = datetime.fromisoformat(record["ended_at"]) if record.get("ended_at") else None
+    except (KeyError, TypeError, ValueError):
+        return None
+    username = record.get("username")
+    return {
+        "id": ids[0],
+        "document_id": ids[1],
+        "username": username if isinstance(username, str) else None,
+        "started_at": started_at,
+        "last_activity": last_activity,
+        "ended_at": ended_at,
+    }
+
+@app.post("/editing-sessions")
+async def upsert_editing_sessions(request_data: dict):
+    """
+    Пакетная запись сессий редактирования (write-behind из Collaboration Hub).
+    Тело: {"sessions": [{id, document_id, username, started_at, last_activity, ended_at}]}
+    """
+    records = request_data.get("sessions", [])
+    if not isinstance(records, list):
+        raise HTTPException(status_code=400, detail="sessions must be a list")
+
+    sessions = [s for s in map(parse_editing_session, records) if s is not None]
+    try:
+        written = await db.upsert_editing_sessions(sessions) if sessions else 0
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    return {"written": written, "skipped": len(records) - written}
+
+@app.get("/editing-sessions/recent")
+async def get_recently_edited_documents(
+    limit: int = Query(20, ge=1, le=LIST_MAX_LIMIT),
+    hours: float = Query(24.0, gt=0),
+):
+    """Последние редактировавшиеся документы с содержимым (прогрев Collaboration Hub при запуске)"""
+    try:
+        return await db.get_recently_edited_documents(limit, hours)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+@app.get("/debug/traces")
+async def debug_traces(trace_id: Optional[str] = None, limit: int = 1000):
+    """Последние сэмплированные спаны сервиса (для tools/trace_report.py; только при TRACE_DEBUG_ENDPOINT)"""
+    if not TRACE_DEBUG_ENDPOINT:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return exporter.spans(trace_id, limit)
+
+@app.get("/metrics/db")
+async def db_metrics():
+    """Пулы соединений: размер, ожидание свободного соединения, отставание реплики"""
+    return db.stats()
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -0,0 +1,348 @@
+"""
+История версий документов в document_versions.
+
+Каждая версия хранится либо как keyframe (полный текст), либо как delta
+относительно предыдущей версии. Версия N восстанавливается применением
+дельт к ближайшему keyframe <= N.
+
+Формат дельты — компактный JSON-массив операций над предыдущим текстом:
+  положительное число  — оставить n символов,
+  отрицательное число  — удалить n символов,
+  строка               — вставить текст.
+Остаток исходного текста после последней операции сохраняется.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple, Any
+
+from database import db
+
+VERSION_KEYFRAME_INTERVAL = int(os.getenv("VERSION_KEYFRAME_INTERVAL", "20"))
+VERSION_MIN_INTERVAL_SECONDS = float(os.getenv("VERSION_MIN_INTERVAL_SECONDS", "30"))
+VERSION_RETENTION_DAYS = int(os.getenv("VERSION_RETENTION_DAYS", "90"))
+VERSION_THIN_AFTER_DAYS = int(os.getenv("VERSION_THIN_AFTER_DAYS", "7"))
+VERSION_HEAD_CACHE_SIZE = int(os.getenv("VERSION_HEAD_CACHE_SIZE", "256"))
+
+# Выше этого размера изменённый участок не сравнивается посимвольно,
+# а записывается как удаление + вставка (SequenceMatcher квадратичен)
+DIFF_MAX_MIDDLE = 4000
+
+
+def _common_prefix_len(a: str, b: str) -> int:
+    """Длина общего префикса (бинарный поиск по срезам, сравнение на стороне C)"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix_len(a: str, b: str, limit: int) -> int:
+    """Длина общего суффикса, не больше limit"""
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def compute_delta(old: str, new: str) -> List[Any]:
+    """Построить дельту, превращающую old в new"""
+    prefix = _common_prefix_len(old, new)
+    suffix = _common_suffix_len(old, new, min(len(old), len(new)) - prefix)
+    old_mid = old[prefix:len(old) - suffix]
+    new_mid = new[prefix:len(new) - suffix]
+
+    ops: List[Any] = []
+
+    def retain(n: int):
+        if n <= 0:
+            return
+        if ops and isinstance(ops[-1], int) and ops[-1] > 0:
+            ops[-1] += n
+        else:
+            ops.append(n)
+
+    def delete(n: int):
+        if n <= 0:
+            return
+        if ops and isinstance(ops[-1], int) and ops[-1] < 0:
+            ops[-1] -= n
+        else:
+            ops.append(-n)
+
+    def insert(text: str):
+        if not text:
+            return
+        if ops and isinstance(ops[-1], str):
+            ops[-1] += text
+        else:
+            ops.append(text)
+
+    retain(prefix)
+    if len(old_mid) <= DIFF_MAX_MIDDLE and len(new_mid) <= DIFF_MAX_MIDDLE:
+        matcher = SequenceMatcher(None, old_mid, new_mid, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                retain(i2 - i1)
+            else:
+                delete(i2 - i1)
+                insert(new_mid[j1:j2])
+    else:
+        delete(len(old_mid))
+        insert(new_mid)
+
+    # Хвостовой retain не храним: он подразумевается при применении
+    if ops and isinstance(ops[-1], int) and ops[-1] > 0:
+        ops.pop()
+    return ops
+
+
+def apply_delta(base: str, delta: List[Any]) -> str:
+    """Применить дельту к тексту"""
+    out: List[str] = []
+    pos = 0
+    for op in delta:
+        if isinstance(op, str):
+            out.append(op)
+        elif op > 0:
+            out.append(base[pos:pos + op])
+            pos += op
+        else:
+            pos -= op
+    out.append(base[pos:])
+    return "".join(out)
+
+
+def encode_delta(delta: List[Any]) -> str:
+    return json.dumps(delta, ensure_ascii=False, separators=(",", ":"))
+
+
+def delta_stats(delta: List[Any]) -> Dict[str, int]:
+    """Количество вставленных и удалённых символов"""
+    inserted = sum(len(op) for op in delta if isinstance(op, str))
+    deleted = sum(-op for op in delta if isinstance(op, int) and op < 0)
+    return {"inserted": inserted, "deleted": deleted}
+
+
+class VersionStore:
+    def __init__(self):
+        # doc_id -> (version_number, content) последней записанной версии
+        self._heads: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+        # doc_id -> (content, created_by), ожидающие записи
+        self._pending: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._last_recorded: Dict[str, float] = {}
+        # Взводится в flush: фоновые записи перестают выдерживать интервал
+        self._flushing = asyncio.Event()
+
+    def record_async(self, doc_id: str, content: str, created_by: Optional[str] = None):
+        """
+        Поставить версию в очередь на запись, не задерживая сохранение.
+        Частые сохранения одного документа склеиваются: не чаще
+        VERSION_MIN_INTERVAL_SECONDS записывается последнее содержимое.
+        """
+        self._pending[doc_id] = (content, created_by)
+        task = self._tasks.get(doc_id)
+        if task is None or task.done():
+            self._tasks[doc_id] = asyncio.create_task(self._record_loop(doc_id))
+
+    async def _record_loop(self, doc_id: str):
+        while doc_id in self._pending:
+            last = self._last_recorded.get(doc_id, 0.0)
+            wait = last + VERSION_MIN_INTERVAL_SECONDS - time.monotonic()
+            if wait > 0 and not self._flushing.is_set():
+                try:
+                    await asyncio.wait_for(self._flushing.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            pending = self._pending.pop(doc_id, None)
+            if pending is None:
+                break
+            content, created_by = pending
+            try:
+                await self.record(doc_id, content, created_by)
+            except Exception as e:
+                print(f"[versions] Failed to record version for doc {doc_id}: {e}")
+            self._last_recorded[doc_id] = time.monotonic()
+        self._tasks.pop(doc_id, None)
+
+    async def flush(self):
+        """
+        Немедленно записать все отложенные версии (при остановке сервиса).
+        Фоновые записи не отменяются: отменённая задача теряла бы уже
+        вынутое из очереди содержимое, поэтому их дожидаемся.
+        """
+        self._flushing.set()
+        try:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+        finally:
+            self._flushing.clear()
+        pending, self._pending = self._pending, {}
+        for doc_id, (content, created_by) in pending.items():
+            try:
+                await self.record(doc_id, content, created_by)
+            except Exception as e:
+                print(f"[versions] Failed to flush version for doc {doc_id}: {e}")
+
+    def _remember_head(self, doc_id: str, version_number: int, content: str):
+        self._heads[doc_id] = (version_number, content)
+        self._heads.move_to_end(doc_id)
+        while len(self._heads) > VERSION_HEAD_CACHE_SIZE:
+            self._heads.popitem(last=False)
+
+    async def record(self, doc_id: str, content: str, created_by: Optional[str] = None) -> Optional[int]:
+        """
+        Записать новую версию документа.
+        Возвращает номер версии или None, если содержимое не изменилось.
+        """
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                # Сериализуем запись версий одного документа между воркерами
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", doc_id)
+                row = await conn.fetchrow("""
+                    SELECT max(version_number) AS head,
+                           max(version_number) FILTER (WHERE kind = 'keyframe') AS keyframe
+                    FROM document_versions
+                    WHERE document_id = $1
+                """, doc_id)
+                head, keyframe = row["head"], row["keyframe"]
+
+                previous = None
+                if head is not None:
+                    cached = self._heads.get(doc_id)
+                    if cached and cached[0] == head:
+                        previous = cached[1]
+                    else:
+                        rebuilt = await self._rebuild(conn, doc_id, head)
+                        previous = rebuilt[0] if rebuilt else None
+
+                if previous == content:
+                    return None
+
+                version_number = (head or 0) + 1
+                kind, stored = "keyframe", content
+                if previous is not None and keyframe is not None \
+                        and version_number - keyframe < VERSION_KEYFRAME_INTERVAL:
+                    encoded = encode_delta(compute_delta(previous, content))
+                    if len(encoded) < len(content) // 2:
+                        kind, stored = "delta", encoded
+
+                # Неизвестный автор -> NULL: версия содержимого важнее подписи (FK на users)
+                await conn.execute("""
+                    INSERT INTO document_versions (document_id, content, version_number, kind, created_by)
+                    VALUES ($1, $2, $3, $4, (SELECT id FROM users WHERE id = $5::uuid))
+                """, doc_id, stored, version_number, kind, created_by)
+
+                if kind == "keyframe":
+                    await self._apply_retention(conn, doc_id)
+
+        self._remember_head(doc_id, version_number, content)
+        return version_number
+
+    async def _apply_retention(self, conn, doc_id: str):
+        """
+        Прореживание и срок хранения. Удаляются только строки старше
+        ближайшего подходящего keyframe, поэтому цепочки оставшихся версий целы.
+        """
+        if VERSION_THIN_AFTER_DAYS > 0:
+            # Для старой истории остаются только keyframe-снимки
+            await conn.execute("""
+                DELETE FROM document_versions
+                WHERE document_id = $1 AND kind = 'delta'
+                  AND version_number < (
+                      SELECT max(version_number) FROM document_versions
+                      WHERE document_id = $1 AND kind = 'keyframe'
+                        AND created_at < NOW() - make_interval(days => $2)
+                  )
+            """, doc_id, VERSION_THIN_AFTER_DAYS)
+        if VERSION_RETENTION_DAYS > 0:
+            await conn.execute("""
+                DELETE FROM document_versions
+                WHERE document_id = $1
+                  AND version_number < (
+                      SELECT max(version_number) FROM document_versions
+                      WHERE document_id = $1 AND kind = 'keyframe'
+                        AND created_at < NOW() - make_interval(days => $2)
+                  )
+            """, doc_id, VERSION_RETENTION_DAYS)
+
+    async def _rebuild(self, conn, doc_id: str, version_number: int) -> Optional[Tuple[str, Dict]]:
+        """Восстановить версию: ближайший keyframe + дельты одним запросом"""
+        rows = await conn.fetch("""
+            SELECT version_number, kind, content, created_by, created_at
+            FROM document_versions
+            WHERE document_id = $1
+              AND version_number <= $2
+              AND version_number >= (
+                  SELECT max(version_number) FROM document_versions
+                  WHERE document_id = $1 AND kind = 'keyframe' AND version_number <= $2
+              )
+            ORDER BY version_number
+        """, doc_id, version_number)
+        if not rows or rows[-1]["version_number"] != version_number:
+            return None
+
+        content = rows[0]["content"]
+        for row in rows[1:]:
+            content = apply_delta(content, json.loads(row["content"]))
+
+        last = rows[-1]
+        meta = {
+            "version_number": last["version_number"],
+            "kind": last["kind"],
+            "created_by": last["created_by"],
+            "created_at": last["created_at"],
+        }
+        return content, meta
+
+    async def get_version(self, doc_id: str, version_number: int) -> Optional[Dict]:
+        """Получить содержимое версии N"""
+        async with db.acquire() as conn:
+            rebuilt = await self._rebuild(conn, doc_id, version_number)
+        if rebuilt is None:
+            return None
+        content, meta = rebuilt
+        return {**meta, "content": content}
+
+    async def list_versions(self, doc_id: str, before: Optional[int] = None, limit: int = 50) -> List[Dict]:
+        """Список версий (без содержимого), новые сверху"""
+        async with db.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT version_number, kind, created_by, created_at,
+                       octet_length(content) AS stored_bytes
+                FROM document_versions
+                WHERE document_id = $1
+                  AND ($2::int IS NULL OR version_number < $2)
+                ORDER BY version_number DESC
+                LIMIT $3
+            """, doc_id, before, limit)
+            return [dict(row) for row in rows]
+
+    async def diff_versions(self, doc_id: str, from_version: int, to_version: int) -> Optional[Dict]:
+        """Дельта между двумя версиями"""
+        async with db.acquire() as conn:
+            old = await self._rebuild(conn, doc_id, from_version)
+            new = await self._rebuild(conn, doc_id, to_version)
+        if old is None or new is None:
+            return None
+        delta = compute_delta(old[0], new[0])
+        return {
+            "from_version": from_version,
+            "to_version": to_version,
+            "ops": delta,
+            **delta_stats(delta),
+        }
+
+
+versions = VersionStore()
@@ -0,0 +1,74 @@
+"""
+Сборка статики фронтенда: JS/CSS из static/ копируются в static/dist/
+с хэшем содержимого в имени (docview.3f2a9c1b.js) и сжимаются заранее
+(.gz всегда, .br если установлен пакет brotli).
+
+static/dist/manifest.json — соответствие исходного имени и собранного файла,
+по нему шаблоны получают URL через asset_url().
+
+Запуск: python build_assets.py (в Dockerfile — после сборки yjs.umd.js)
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него отдаётся gzip
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST_PATH = os.path.join(DIST_DIR, "manifest.json")
+
+ASSET_EXTENSIONS = (".js", ".css")
+HASH_LENGTH = 8
+# Мелкие файлы не сжимаем: выигрыш меньше накладных расходов
+MIN_COMPRESS_BYTES = 512
+
+
+def hashed_name(name: str, content: bytes) -> str:
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+
+def build():
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    os.makedirs(DIST_DIR)
+
+    manifest = {}
+    for name in sorted(os.listdir(STATIC_DIR)):
+        path = os.path.join(STATIC_DIR, name)
+        if not os.path.isfile(path) or not name.endswith(ASSET_EXTENSIONS):
+            continue
+
+        with open(path, "rb") as f:
+            content = f.read()
+
+        target = hashed_name(name, content)
+        with open(os.path.join(DIST_DIR, target), "wb") as f:
+            f.write(content)
+
+        if len(content) >= MIN_COMPRESS_BYTES:
+            # mtime=0: одинаковый вход даёт побайтно одинаковый .gz
+            with open(os.path.join(DIST_DIR, target + ".gz"), "wb") as f:
+                f.write(gzip.compress(content, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(os.path.join(DIST_DIR, target + ".br"), "wb") as f:
+                    f.write(brotli.compress(content, quality=11))
+
+        manifest[name] = target
+        print(f"[assets] {name} -> dist/{target}")
+
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == "__main__":
+    build()
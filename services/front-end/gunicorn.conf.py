@@ -0,0 +1,12 @@
+# Production-сервер фронтенда: gunicorn с gevent-воркерами.
+# gevent патчит сокеты, поэтому ожидание ответа API Gateway (requests)
+# не блокирует воркер и один процесс обслуживает много соединений.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gevent"
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "1000"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "30"))
+accesslog = "-"
@@ -1,8 +1,18 @@
-from flask import Flask, render_template, redirect, url_for, request, jsonify
+from flask import Flask, render_template, redirect, url_for, request, jsonify, send_from_directory, abort
 import json
+import mimetypes
+import os
 import requests
+from requests.adapters import HTTPAdapter
 
 API_GATEWAY_URL = "http://api-gateway:8000"
+DOCS_PAGE_SIZE = 50
+GATEWAY_TIMEOUT = 10
+
+# Общий пул keep-alive соединений к API Gateway вместо нового TCP на каждый запрос
+gateway = requests.Session()
+gateway.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+gateway.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
 
 app = Flask(
     __name__,
@@ -10,6 +20,83 @@ app = Flask(
     static_folder='static'
 )
 
+# Собранная статика (build_assets.py): имена с хэшем содержимого, .gz/.br рядом
+ASSETS_DIR = os.path.join(app.static_folder, "dist")
+ASSET_MANIFEST_PATH = os.path.join(ASSETS_DIR, "manifest.json")
+ASSET_MAX_AGE = 365 * 24 * 3600
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+
+def load_asset_manifest():
+    try:
+        with open(ASSET_MANIFEST_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+asset_manifest = load_asset_manifest()
+hashed_assets = set(asset_manifest.values())
+
+
+@app.context_processor
+def inject_asset_url():
+    def asset_url(name):
+        hashed = asset_manifest.get(name)
+        if hashed is None:
+            # Без сборки (локальная разработка) отдаётся исходный файл из static/
+            return url_for('static', filename=name)
+        return url_for('hashed_asset', filename=hashed)
+    return {"asset_url": asset_url}
+
+
+def accepted_encodings(header):
+    """Accept-Encoding -> {кодировка: q}; q=0 означает явный запрет, * задаёт q для неназванных"""
+    weights = {}
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+    if "*" in weights:
+        for candidate, _ in PRECOMPRESSED:
+            weights.setdefault(candidate, weights["*"])
+    return weights
+
+
+@app.route('/assets/<filename>')
+def hashed_asset(filename):
+    # Содержимое файла с хэшем в имени не меняется, поэтому кэш браузера — на год без ревалидации
+    if filename not in hashed_assets:
+        abort(404)
+
+    accepted = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+    path, encoding = filename, None
+    # Из допустимых (q > 0) — с наибольшим q; при равных предпочтение по порядку PRECOMPRESSED
+    for candidate, suffix in sorted(PRECOMPRESSED, key=lambda item: -accepted.get(item[0], 0.0)):
+        if accepted.get(candidate, 0.0) > 0 and os.path.isfile(os.path.join(ASSETS_DIR, filename + suffix)):
+            path, encoding = filename + suffix, candidate
+            break
+
+    response = send_from_directory(
+        ASSETS_DIR, path, mimetype=mimetypes.guess_type(filename)[0], max_age=ASSET_MAX_AGE
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+        response.headers.pop("Content-Disposition", None)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    return response
+
 
 @app.route('/')
 def login():
@@ -23,45 +110,57 @@ def account():
 
 @app.route('/api/userdocs/<username>')
 def get_user_docs(username):
-    
-    user_resp = requests.get(f"{API_GATEWAY_URL}/users/username/{username}")
-
-    if user_resp.status_code != 200:
+    # Курсоры приходят от doclist.js при подгрузке следующей страницы
+    my_cursor = request.args.get("my_cursor")
+    shared_cursor = request.args.get("shared_cursor")
+    sections = []
+    if shared_cursor is None or my_cursor is not None:
+        sections.append("my")
+    if my_cursor is None or shared_cursor is not None:
+        sections.append("shared")
+
+    dashboard_resp = gateway.get(
+        f"{API_GATEWAY_URL}/users/{username}/dashboard",
+        params={
+            "my_cursor": my_cursor,
+            "shared_cursor": shared_cursor,
+            "limit": DOCS_PAGE_SIZE,
+            "include": ",".join(sections)
+        },
+        timeout=GATEWAY_TIMEOUT
+    )
+
+    if dashboard_resp.status_code == 404:
         return jsonify({"my_docs": [], "shared_docs": []})
-    
-    user_data = user_resp.json()
-    user_id = user_data["id"]
-    
-    my_docs_resp = requests.get(f"{API_GATEWAY_URL}/documents/user/{user_id}")
-    if my_docs_resp.status_code != 200:
+    if dashboard_resp.status_code != 200:
         return jsonify({"error": "Failed to fetch documents"}), 500
-    my_docs = my_docs_resp.json()
 
-    shared_docs_resp = requests.get(f"{API_GATEWAY_URL}/documents/shared/{user_id}")
-    if shared_docs_resp.status_code != 200:
-        return jsonify({"error": "Failed to fetch documents"}), 500
-    shared_docs = shared_docs_resp.json()
+    dashboard = dashboard_resp.json()
+    my_page = dashboard.get("my_docs") or {}
+    shared_page = dashboard.get("shared_docs") or {}
 
     result = {
         "my_docs": [],
-        "shared_docs": []
+        "shared_docs": [],
+        "my_next_cursor": my_page.get("next_cursor"),
+        "shared_next_cursor": shared_page.get("next_cursor")
     }
 
-    for doc in my_docs:
+    for doc in my_page.get("items", []):
         result["my_docs"].append({
             "id": doc["id"],
             "title": doc["title"],
-            "content": doc["content"],
+            "snippet": doc.get("snippet") or "",
             "created_at": doc["created_at"],
             "modified_at": doc.get("updated_at"),
-            "shared_to": []
+            "shared_to": doc.get("shared_to") or []
         })
 
-    for doc in shared_docs:
+    for doc in shared_page.get("items", []):
         result["shared_docs"].append({
             "id": doc["id"],
             "title": doc["title"],
-            "content": doc["content"],
+            "snippet": doc.get("snippet") or "",
             "created_at": doc["created_at"],
             "modified_at": doc.get("updated_at"),
             "shared_from": doc.get("owner_username") or doc.get("owner_id")
@@ -0,0 +1,132 @@
+// services/front-end/measure_updates.js
+// =============================
+// Update bytes per keystroke for the editor -> Y.Text binding (diffStrings from docview.js)
+// - Types, deletes and replaces characters in a ~100 KB document (Cyrillic, Latin, emoji)
+// - Fails if an update grows with the document instead of the edit,
+//   if the text diverges, or if a diff splits a surrogate pair
+// - Runs in the Docker build after yjs.umd.js: node measure_updates.js [path/to/yjs.umd.js]
+// =============================
+
+const fs = require("fs");
+const path = require("path");
+
+const Y = require(path.resolve(process.argv[2] || path.join(__dirname, "static", "yjs.umd.js")));
+
+// The function under test is taken from docview.js as is
+const docviewSrc = fs.readFileSync(path.join(__dirname, "static", "docview.js"), "utf8");
+const diffStrings = new Function(`${docviewSrc.match(/function diffStrings[\s\S]*?\n}\n/)[0]}return diffStrings;`)();
+
+const DOC_SIZE = 100 * 1024;
+const KEYSTROKES = 500;
+// A keystroke update is a few dozen bytes; a full Y.Text rewrite of this document is ~100 KB
+const MAX_UPDATE_BYTES = 100;
+
+// Deterministic PRNG (mulberry32): the same keystrokes on every run
+let seed = 0x5eed;
+function random() {
+  seed = (seed + 0x6d2b79f5) | 0;
+  let t = Math.imul(seed ^ (seed >>> 15), 1 | seed);
+  t = (t + Math.imul(t ^ (t >>> 7), 61 | t)) ^ t;
+  return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+}
+
+const isHigh = (code) => (code & 0xfc00) === 0xd800;
+const isLow = (code) => (code & 0xfc00) === 0xdc00;
+
+// Caret positions never fall inside a surrogate pair (as in a real editor)
+function caret(text) {
+  let pos = Math.floor(random() * (text.length + 1));
+  if (pos > 0 && pos < text.length && isLow(text.charCodeAt(pos))) pos--;
+  return pos;
+}
+
+const KEYS = ["а", "б", "я", "e", "x", " ", "\n", "😀", "🎓"];
+const edits = [
+  // type a character
+  (text) => {
+    const pos = caret(text);
+    return text.slice(0, pos) + KEYS[Math.floor(random() * KEYS.length)] + text.slice(pos);
+  },
+  // backspace (a whole emoji at once)
+  (text) => {
+    const pos = caret(text);
+    if (pos === 0) return text;
+    const width = pos > 1 && isLow(text.charCodeAt(pos - 1)) ? 2 : 1;
+    return text.slice(0, pos - width) + text.slice(pos);
+  },
+  // replace an emoji with another one sharing its high surrogate (😀 -> 😃)
+  (text) => {
+    const pos = text.indexOf("😀", caret(text));
+    return pos < 0 ? text : text.slice(0, pos) + "😃" + text.slice(pos + 2);
+  },
+];
+
+function hasLoneSurrogate(str) {
+  for (let i = 0; i < str.length; i++) {
+    const code = str.charCodeAt(i);
+    if (isHigh(code)) {
+      if (!isLow(str.charCodeAt(i + 1))) return true;
+      i++;
+    } else if (isLow(code)) {
+      return true;
+    }
+  }
+  return false;
+}
+
+let base = "";
+while (base.length < DOC_SIZE) base += "Конспект лекции 😀 по алгебре: lemma 3, proof. ";
+base = base.slice(0, DOC_SIZE);
+if (isHigh(base.charCodeAt(base.length - 1))) base = base.slice(0, -1);
+
+const ydoc = new Y.Doc();
+const ytext = ydoc.getText("content");
+ytext.insert(0, base);
+
+const sizes = [];
+ydoc.on("update", (update) => sizes.push(update.length));
+
+const failures = [];
+let text = base;
+for (let i = 0; i < KEYSTROKES; i++) {
+  const next = edits[Math.floor(random() * edits.length)](text);
+  const { index, deleteCount, insert } = diffStrings(ytext.toString(), next);
+  const removed = text.slice(index, index + deleteCount);
+  if (hasLoneSurrogate(insert) || hasLoneSurrogate(removed)) {
+    failures.push(`keystroke ${i}: diff splits a surrogate pair at ${index}`);
+  }
+  ydoc.transact(() => {
+    if (deleteCount > 0) ytext.delete(index, deleteCount);
+    if (insert) ytext.insert(index, insert);
+  });
+  text = next;
+}
+if (ytext.toString() !== text) failures.push("Y.Text diverged from the editor text");
+
+// Updates must also decode on another client to the same text
+const replica = new Y.Doc();
+Y.applyUpdate(replica, Y.encodeStateAsUpdate(ydoc));
+if (replica.getText("content").toString() !== text) failures.push("replica diverged from the editor text");
+
+const updates = sizes.length;
+const max = Math.max(...sizes);
+const avg = sizes.reduce((a, b) => a + b, 0) / updates;
+
+// For reference: what the old "delete all + insert all" binding sent per keystroke
+let rewrite = 0;
+ydoc.on("update", (update) => { rewrite = update.length; });
+ydoc.transact(() => {
+  ytext.delete(0, ytext.length);
+  ytext.insert(0, text);
+});
+
+console.log(`document: ${(text.length / 1024).toFixed(1)} K UTF-16 units, updates: ${updates}`);
+console.log(`update bytes per keystroke: avg ${avg.toFixed(1)}, max ${max} (limit ${MAX_UPDATE_BYTES})`);
+console.log(`full rewrite update: ${rewrite} bytes`);
+
+if (max > MAX_UPDATE_BYTES) failures.push(`update of ${max} bytes exceeds ${MAX_UPDATE_BYTES}`);
+if (failures.length) {
+  failures.slice(0, 10).forEach((f) => console.error(`FAIL: ${f}`));
+  if (failures.length > 10) console.error(`FAIL: ... ${failures.length - 10} more`);
+  process.exit(1);
+}
@@ -13,18 +13,141 @@ if (parts[0] === "users" && parts[2] === "documents") {
 }
 document.getElementById("btn-username").innerHTML = `Выйти (${logged})`;
 
-fetch(`/api/userdocs/${logged}`)
-  .then(response => {
-    if (!response.ok) {
-      throw new Error("User not found");
-    }
-    return response.json();
-  })
-  .then(db => {
-    let myDocs = db.my_docs || [];
-    let sharedDocs = db.shared_docs || [];
-    let currentlySelected = null;
+// Gateway base (for REST). Can be overridden via template if desired.
+const GATEWAY_BASE = window.API_GATEWAY_URL || "http://localhost:8000";
+
+let currentlySelected = null;
+
+function renderMyDoc(doc) {
+  let docDiv = document.createElement("div");
+  docDiv.classList.add("doc-div");
+  docDiv.setAttribute("data-doc-id", doc.id);
+
+  docDiv.onclick = () => {
+      if (currentlySelected === doc.id) {
+          docDiv.classList.remove("doc-selected");
+          currentlySelected = null;
+      } else {
+          document.querySelectorAll(".doc-div").forEach((d) => {
+              d.classList.remove("doc-selected");
+          });
+          
+          docDiv.classList.add("doc-selected");
+          currentlySelected = doc.id;
+          document.getElementById("panel-buttons").classList.add("panel-buttons-visible");
+      }
+  };
+
+  docDiv.ondblclick = () => {
+    window.location.href = `/users/${logged}/documents/${doc.id}`;
+  };
+
+  let docTitle = document.createElement("p");
+  docTitle.classList.add("doc-p");
+  docTitle.innerHTML = doc.title;
+  docTitle.title = doc.snippet || "";
+
+  let innerDocDiv = document.createElement("div");
+  innerDocDiv.classList.add("inner-doc-div");
+  innerDocDiv.innerHTML = doc.shared_to.length > 0 ? "</p>есть общий доступ</p>" : "";
+
+  docDiv.appendChild(innerDocDiv);
+  docDiv.appendChild(docTitle);
+  document.getElementById("my-docs").appendChild(docDiv);
+}
+
+function renderSharedDoc(doc) {
+  let docDiv = document.createElement("div");
+  docDiv.classList.add("sh-doc-div");
+  docDiv.setAttribute("data-doc-id", doc.id);
+
+  docDiv.onclick = () => {
+    document.querySelectorAll(".doc-div, .sh-doc-div").forEach((d) => {
+        d.classList.remove("doc-selected");
+    });
+    
+    docDiv.classList.add("doc-selected");
+    currentlySelected = doc.id;
+  };
+
+  docDiv.ondblclick = () => {
+    window.location.href = `/users/${logged}/documents/${doc.id}`;
+  };
+
+  let docTitle = document.createElement("p");
+  docTitle.classList.add("sh-doc-p");
+  docTitle.innerHTML = doc.title;
+  docTitle.title = doc.snippet || "";
+
+  let innerDocDiv = document.createElement("div");
+  innerDocDiv.classList.add("sh-inner-doc-div");
+  innerDocDiv.innerHTML = `</p>автор <strong>${doc.shared_from}</strong></p>`;
+
+  docDiv.appendChild(innerDocDiv);
+  docDiv.appendChild(docTitle);
+  document.getElementById("shared-docs").appendChild(docDiv);
+}
+
+// Кнопка "показать ещё" для keyset-пагинации списка (cursorParam: my_cursor | shared_cursor)
+function renderMoreButton(listId, cursorParam, cursor) {
+  const buttonId = `${listId}-more`;
+  document.getElementById(buttonId)?.remove();
+  if (!cursor) return;
+
+  let moreBtn = document.createElement("button");
+  moreBtn.id = buttonId;
+  moreBtn.classList.add("panel-button");
+  moreBtn.innerHTML = "показать ещё";
+  moreBtn.onclick = () => {
+    moreBtn.disabled = true;
+    fetchUserDocs({ [cursorParam]: cursor })
+      .then(renderDocsPage)
+      .catch(err => {
+        moreBtn.disabled = false;
+        console.error(err);
+        alert("Ошибка загрузки документов.");
+      });
+  };
+  document.getElementById(listId).after(moreBtn);
+}
+
+function renderDocsPage(db) {
+  const myDocs = db.my_docs || [];
+  const sharedDocs = db.shared_docs || [];
+  const params = db.requested || {};
+
+  myDocs.forEach(renderMyDoc);
+  sharedDocs.forEach(renderSharedDoc);
+  prefetchPermissions([...myDocs, ...sharedDocs].map(doc => doc.id));
 
+  if (!params.shared_cursor) renderMoreButton("my-docs", "my_cursor", db.my_next_cursor);
+  if (!params.my_cursor) renderMoreButton("shared-docs", "shared_cursor", db.shared_next_cursor);
+}
+
+// Warm the hub's permission cache so opening a document doesn't wait for an access check
+function prefetchPermissions(docIds) {
+  if (!docIds.length) return;
+  fetch(`${GATEWAY_BASE}/authz/prefetch`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json", "X-User": logged },
+    body: JSON.stringify({ user: logged, document_ids: docIds })
+  }).catch(() => {});
+}
+
+function fetchUserDocs(params = {}) {
+  const query = new URLSearchParams(params).toString();
+  return fetch(`/api/userdocs/${logged}${query ? `?${query}` : ""}`)
+    .then(response => {
+      if (!response.ok) {
+        throw new Error("User not found");
+      }
+      return response.json();
+    })
+    .then(db => ({ ...db, requested: params }));
+}
+
+fetchUserDocs()
+  .then(db => {
     document.getElementById("panel-buttons").classList.add("panel-buttons-visible");
     
     const openDoc = () => {
@@ -101,72 +224,7 @@ fetch(`/api/userdocs/${logged}`)
     document.getElementById("create").onclick = createDoc;
     
     
-    for (const doc of myDocs) {
-      let docDiv = document.createElement("div");
-      docDiv.classList.add("doc-div");
-      docDiv.setAttribute("data-doc-id", doc.id);
-
-      docDiv.onclick = () => {
-          if (currentlySelected === doc.id) {
-              docDiv.classList.remove("doc-selected");
-              currentlySelected = null;
-          } else {
-              document.querySelectorAll(".doc-div").forEach((d) => {
-                  d.classList.remove("doc-selected");
-              });
-              
-              docDiv.classList.add("doc-selected");
-              currentlySelected = doc.id;
-              document.getElementById("panel-buttons").classList.add("panel-buttons-visible");
-          }
-      };
-
-      docDiv.ondblclick = () => {
-        window.location.href = `/users/${logged}/documents/${doc.id}`;
-      };
-
-      let docTitle = document.createElement("p");
-      docTitle.classList.add("doc-p");
-      docTitle.innerHTML = doc.title;
-
-      let innerDocDiv = document.createElement("div");
-      innerDocDiv.classList.add("inner-doc-div");
-      innerDocDiv.innerHTML = doc.shared_to.length > 0 ? "</p>есть общий доступ</p>" : "";
-
-      docDiv.appendChild(innerDocDiv);
-      docDiv.appendChild(docTitle);
-      document.getElementById("my-docs").appendChild(docDiv);
-    }
-    for (const doc of sharedDocs) {
-      let docDiv = document.createElement("div");
-      docDiv.classList.add("sh-doc-div");
-      docDiv.setAttribute("data-doc-id", doc.id);
-
-      docDiv.onclick = () => {
-        document.querySelectorAll(".doc-div, .sh-doc-div").forEach((d) => {
-            d.classList.remove("doc-selected");
-        });
-        
-        docDiv.classList.add("doc-selected");
-        currentlySelected = doc.id;
-      };
-
-      docDiv.ondblclick = () => {
-        window.location.href = `/users/${logged}/documents/${doc.id}`;
-      };
-
-      let docTitle = document.createElement("p");
-      docTitle.classList.add("sh-doc-p");
-      docTitle.innerHTML = doc.title;
-
-      let innerDocDiv = document.createElement("div");
-      innerDocDiv.classList.add("sh-inner-doc-div");
-      innerDocDiv.innerHTML = `</p>автор <strong>${doc.shared_from}</strong></p>`;
-
-      docDiv.appendChild(innerDocDiv);
-      docDiv.appendChild(docTitle);
-      document.getElementById("shared-docs").appendChild(docDiv);
-    }
+    renderDocsPage(db);
   })
   .catch(err => {
     console.error(err);
@@ -187,7 +245,7 @@ async function asyncCreateDoc(data) {
           content: "",
           username: loggedUser
         }
-        const resp = await fetch(`http://localhost:8000/documents`, {
+        const resp = await fetch(`${GATEWAY_BASE}/documents`, {
             method: "POST",
             headers: {
                 "Content-Type": "application/json"
@@ -215,10 +273,11 @@ async function asyncCreateDoc(data) {
 
 async function asyncDeleteDoc(data) {
     try {
-        const resp = await fetch(`http://localhost:8000/documents/${data.id}`, {
+        const resp = await fetch(`${GATEWAY_BASE}/documents/${data.id}`, {
             method: "DELETE",
             headers: {
-                "Content-Type": "application/json"
+                "Content-Type": "application/json",
+                "X-User": logged
             }
         });
         
@@ -244,7 +303,7 @@ async function asyncShareDoc(data) {
         
         const userIds = [];
         for (const username of usernames) {
-            const userResp = await fetch(`http://localhost:8000/users/username/${username}`);
+            const userResp = await fetch(`${GATEWAY_BASE}/users/username/${username}`);
             if (!userResp.ok) {
                 throw new Error(`Пользователь "${username}" не найден`);
             }
@@ -256,10 +315,11 @@ async function asyncShareDoc(data) {
           user_ids: userIds,
           permission: "edit"
         }
-        const resp = await fetch(`http://localhost:8000/documents/${docId}/collaborators`, {
+        const resp = await fetch(`${GATEWAY_BASE}/documents/${docId}/collaborators`, {
             method: "POST",
             headers: {
-                "Content-Type": "application/json"
+                "Content-Type": "application/json",
+                "X-User": logged
             },
             body: JSON.stringify(body)
         });
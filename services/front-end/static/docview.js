@@ -18,6 +18,7 @@ const boldBtn = document.getElementById("bold-btn");
 const italicBtn = document.getElementById("italic-btn");
 const colorPicker = document.getElementById("color-picker");
 const saveBack = document.getElementById("save-back");
+const presenceBox = document.getElementById("presence");
 
 // --- Formatting toolbar (kept) ---
 function toggleCommand(command) {
@@ -66,16 +67,21 @@ const docId = parts[3] || "";
 
 // Gateway base (for REST). Can be overridden via template if desired.
 const GATEWAY_BASE = window.API_GATEWAY_URL || "http://localhost:8000";
+// The gateway checks document permissions for this user
+const USER_HEADERS = { "X-User": currentUser };
 
 // --- REST: load & save (for initial paint + Save&Back) ---
 let currentTitle = "";
+let currentEtag = null;
 
 async function loadDocumentForInitialPaint() {
   if (!docId) return;
   try {
-    const resp = await fetch(`${GATEWAY_BASE}/documents/${encodeURIComponent(docId)}`);
+    // no-cache: browser revalidates its cached copy with If-None-Match and reuses it on 304
+    const resp = await fetch(`${GATEWAY_BASE}/documents/${encodeURIComponent(docId)}`, { cache: "no-cache", headers: USER_HEADERS });
     if (!resp.ok) throw new Error(`Не удалось загрузить документ (${resp.status})`);
 
+    currentEtag = resp.headers.get("ETag");
     const data = await resp.json();
     const doc = Array.isArray(data) ? data[0] : data;
 
@@ -88,6 +94,32 @@ async function loadDocumentForInitialPaint() {
   }
 }
 
+async function putDocument(body, etag) {
+  const headers = { ...USER_HEADERS, "Content-Type": "application/json" };
+  if (etag) headers["If-Match"] = etag;
+  return fetch(`${GATEWAY_BASE}/documents/${encodeURIComponent(docId)}`, {
+    method: "PUT",
+    headers,
+    body: JSON.stringify(body),
+  });
+}
+
+// Save conflict: one non-blocking banner instead of a confirm() per attempt
+const conflictBanner = document.getElementById("save-conflict");
+document.getElementById("conflict-overwrite")?.addEventListener("click", () => {
+  hideConflict();
+  saveAndBack();
+});
+document.getElementById("conflict-dismiss")?.addEventListener("click", hideConflict);
+
+function showConflict() {
+  if (conflictBanner) conflictBanner.hidden = false;
+}
+function hideConflict() {
+  if (conflictBanner) conflictBanner.hidden = true;
+}
+
+// Returns false when the save hit a conflict the user has to resolve
 async function saveDocument() {
   if (!docId) throw new Error("docId отсутствует в URL");
   const body = {
@@ -95,57 +127,388 @@ async function saveDocument() {
     content: editor?.innerHTML || ""
   };
 
-  const resp = await fetch(`${GATEWAY_BASE}/documents/${encodeURIComponent(docId)}`, {
-    method: "PUT",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(body),
-  });
+  const resp = await putDocument(body, currentEtag);
+
+  if (resp.status === 412) {
+    // 412 carries the current ETag: the next save (e.g. "overwrite" from the banner) uses it
+    currentEtag = resp.headers.get("ETag") || currentEtag;
+    // Usually it's the hub's own autosave of the same CRDT state — nothing to resolve then
+    const latest = await fetch(`${GATEWAY_BASE}/documents/${encodeURIComponent(docId)}`, { cache: "no-cache", headers: USER_HEADERS });
+    if (latest.ok) {
+      const doc = await latest.json();
+      currentEtag = latest.headers.get("ETag") || currentEtag;
+      if ((doc?.content || "") === body.content) return true;
+    }
+    showConflict();
+    return false;
+  }
 
   if (!resp.ok) {
     const txt = await resp.text().catch(() => "");
     throw new Error(`Не удалось сохранить документ (${resp.status}) ${txt}`);
   }
+  currentEtag = resp.headers.get("ETag");
+  return true;
 }
 
-saveBack?.addEventListener("click", () => {
+function saveAndBack() {
   saveDocument()
-    .then(() => (window.location.href = `/users/${encodeURIComponent(currentUser)}/documents`))
+    .then((saved) => {
+      if (saved) window.location.href = `/users/${encodeURIComponent(currentUser)}/documents`;
+    })
     .catch((err) => alert(err?.message || String(err)));
+}
+
+saveBack?.addEventListener("click", () => {
+  hideConflict();
+  saveAndBack();
 });
 
+// --- Local persistence (IndexedDB): Yjs state survives reloads and reconnects ---
+const LOCAL_DB_NAME = "conspektor";
+const LOCAL_STORE = "docs";
+let localDbPromise = null;
+
+function openLocalDb() {
+  if (!window.indexedDB) return Promise.resolve(null);
+  if (!localDbPromise) {
+    localDbPromise = new Promise((resolve) => {
+      const req = indexedDB.open(LOCAL_DB_NAME, 1);
+      req.onupgradeneeded = () => req.result.createObjectStore(LOCAL_STORE);
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => resolve(null); // private mode etc.: work without persistence
+    });
+  }
+  return localDbPromise;
+}
+
+async function loadLocalState(key) {
+  const db = await openLocalDb();
+  if (!db) return null;
+  return new Promise((resolve) => {
+    const req = db.transaction(LOCAL_STORE, "readonly").objectStore(LOCAL_STORE).get(key);
+    req.onsuccess = () => resolve(req.result || null);
+    req.onerror = () => resolve(null);
+  });
+}
+
+async function saveLocalState(key, record) {
+  const db = await openLocalDb();
+  if (!db) return;
+  db.transaction(LOCAL_STORE, "readwrite").objectStore(LOCAL_STORE).put(record, key);
+}
+
 // --- CRDT (Yjs) over custom WS protocol ---
 let ws = null;
-const ydoc = Y ? new Y.Doc() : null;
-const ytext = (Y && ydoc) ? ydoc.getText("content") : null;
+let ydoc = null;
+let ytext = null;
 
 let suppressSend = false;
-let sentSyncRequest = false;
 let editorDebounce = null;
+let persistDebounce = null;
+// Room epoch from the hub: our state vector is only meaningful within the same epoch
+let roomEpoch = null;
+// ydoc holds document state (from the hub or IndexedDB); editor edits may be applied
+let hasState = false;
+// Local edits made while the socket was closed (or before this connection's sync)
+let offlineEdits = false;
+// Text the hub last had from us and the Y.Text deltas made on top of it since:
+// after a room reset they are rebased onto the new hub state (see rebaseOfflineEdits)
+let syncedText = null;
+let offlineDeltas = [];
+// A new connection counts as offline until its first "sync" is applied
+let awaitingSync = true;
+let reconnectDelay = 1000;
+const RECONNECT_MAX_DELAY = 30000;
+
+function createYdoc() {
+  ydoc = new Y.Doc();
+  ytext = ydoc.getText("content");
+  ydoc.on("update", onYdocUpdate);
+  ytext.observe((event) => {
+    if (!suppressSend && isOffline()) offlineDeltas.push(event.delta);
+  });
+}
+
+function isOffline() {
+  return !ws || ws.readyState !== WebSocket.OPEN || awaitingSync;
+}
+
+// Remember what the hub has before local edits start piling up offline
+function markOffline() {
+  if (offlineEdits || !ytext) return;
+  syncedText = ytext.toString();
+  offlineDeltas = [];
+}
+
+function onYdocUpdate(update) {
+  schedulePersist();
+  if (suppressSend) return;
+  if (isOffline()) {
+    offlineEdits = true;
+    return;
+  }
+  const msg = { type: "update", update: bytesToHex(update) };
+  if (Math.random() < TRACE_SAMPLE_RATE) {
+    msg.traceparent = newTraceparent();
+    msg.sentAt = Date.now();
+  }
+  ws.send(JSON.stringify(msg));
+  window.conspektorStats.updatesSent += 1;
+  window.conspektorStats.updateBytesSent += update.length;
+}
+
+function schedulePersist() {
+  clearTimeout(persistDebounce);
+  persistDebounce = setTimeout(() => {
+    saveLocalState(docId, {
+      update: Y.encodeStateAsUpdate(ydoc),
+      epoch: roomEpoch,
+      unsynced: offlineEdits,
+      base: offlineEdits ? syncedText : null,
+      deltas: offlineEdits ? offlineDeltas : [],
+      title: currentTitle,
+      etag: currentEtag,
+    }).catch((err) => console.warn("IndexedDB save failed", err));
+  }, 500);
+}
+
+async function restoreLocalState() {
+  if (!docId || !ydoc) return false;
+  const record = await loadLocalState(docId).catch(() => null);
+  if (!record || !record.update) return false;
+
+  suppressSend = true;
+  Y.applyUpdate(ydoc, record.update);
+  suppressSend = false;
+
+  roomEpoch = record.epoch || null;
+  offlineEdits = !!record.unsynced;
+  syncedText = offlineEdits ? (record.base ?? null) : ytext.toString();
+  offlineDeltas = offlineEdits ? (record.deltas || []) : [];
+  currentTitle = record.title || "";
+  currentEtag = record.etag || null;
+  hasState = true;
+  renderFromYjs();
+  return true;
+}
 
 function getEditorText() {
   return editor?.innerHTML || "";
 }
-function setEditorText(text) {
-  const t = text || "";
-  if (!editor) return;
-  if ((editor.innerHTML || "") !== t) editor.innerHTML = t;
+
+// --- Minimal diff between two strings (one contiguous change) ---
+// Indexes are UTF-16 code units (as in Y.Text); the changed range never splits a surrogate pair,
+// otherwise a lone half of an emoji would be sent and decoded as U+FFFD by other clients.
+function diffStrings(prev, next) {
+  const maxPrefix = Math.min(prev.length, next.length);
+  let prefix = 0;
+  while (prefix < maxPrefix && prev.charCodeAt(prefix) === next.charCodeAt(prefix)) prefix++;
+  // Prefix ends on a high surrogate: the pair differs in its low half, take the whole pair
+  if (prefix > 0 && (prev.charCodeAt(prefix - 1) & 0xfc00) === 0xd800) prefix--;
+
+  const maxSuffix = maxPrefix - prefix;
+  let suffix = 0;
+  while (
+    suffix < maxSuffix &&
+    prev.charCodeAt(prev.length - 1 - suffix) === next.charCodeAt(next.length - 1 - suffix)
+  ) suffix++;
+  // Suffix starts on a low surrogate: the pair differs in its high half
+  if (suffix > 0 && (prev.charCodeAt(prev.length - suffix) & 0xfc00) === 0xdc00) suffix--;
+
+  return {
+    index: prefix,
+    deleteCount: prev.length - prefix - suffix,
+    insert: next.slice(prefix, next.length - suffix),
+  };
+}
+
+// --- Caret as a character offset in editor text (survives innerHTML re-render) ---
+function getCaretOffset() {
+  const sel = window.getSelection();
+  if (!sel || !sel.rangeCount || !editor.contains(sel.anchorNode)) return null;
+  const range = sel.getRangeAt(0);
+  const before = document.createRange();
+  before.selectNodeContents(editor);
+  before.setEnd(range.endContainer, range.endOffset);
+  return before.toString().length;
+}
+
+function setCaretOffset(offset) {
+  const walker = document.createTreeWalker(editor, NodeFilter.SHOW_TEXT);
+  let node = walker.nextNode();
+  let remaining = offset;
+  while (node) {
+    if (remaining <= node.length) {
+      const range = document.createRange();
+      range.setStart(node, remaining);
+      range.collapse(true);
+      const sel = window.getSelection();
+      sel.removeAllRanges();
+      sel.addRange(range);
+      return;
+    }
+    remaining -= node.length;
+    node = walker.nextNode();
+  }
 }
 
 function renderFromYjs() {
-  if (!ytext) return;
-  setEditorText(ytext.toString());
+  if (!ytext || !editor) return;
+  const next = ytext.toString();
+  if ((editor.innerHTML || "") === next) return;
+
+  const caret = getCaretOffset();
+  const prevText = editor.textContent || "";
+  editor.innerHTML = next;
+  if (caret === null) return;
+
+  // Remote change before the caret shifts it; a change after it does not
+  const change = diffStrings(prevText, editor.textContent || "");
+  let offset = caret;
+  if (change.index < caret) {
+    offset = caret <= change.index + change.deleteCount
+      ? change.index + change.insert.length
+      : caret - change.deleteCount + change.insert.length;
+  }
+  setCaretOffset(offset);
 }
 
-function overwriteYjsFromEditor() {
-  if (!ydoc || !ytext) return;
+// Editor -> Y.Text: apply only the changed range, so an update is the size of the edit
+function applyEditorDiffToYjs() {
+  if (!ydoc || !ytext || !hasState) return;
   const next = getEditorText();
   const prev = ytext.toString();
   if (next === prev) return;
 
+  const { index, deleteCount, insert } = diffStrings(prev, next);
   ydoc.transact(() => {
-    ytext.delete(0, ytext.length);
-    ytext.insert(0, next);
+    if (deleteCount > 0) ytext.delete(index, deleteCount);
+    if (insert) ytext.insert(index, insert);
+  });
+}
+
+// Push a pending (debounced) local edit before applying remote state over the editor
+function flushEditorInput() {
+  if (editorDebounce === null) return;
+  clearTimeout(editorDebounce);
+  editorDebounce = null;
+  applyEditorDiffToYjs();
+}
+
+// Update traffic counters, for measuring bytes per keystroke from the console
+window.conspektorStats = { updatesSent: 0, updateBytesSent: 0 };
+
+// --- Tracing: a sampled edit carries a W3C traceparent through gateway, hub, broker and DB ---
+const TRACE_SAMPLE_RATE = window.TRACE_SAMPLE_RATE ?? 0.01;
+
+function randomHex(bytes) {
+  return bytesToHex(crypto.getRandomValues(new Uint8Array(bytes)));
+}
+
+function newTraceparent() {
+  return `00-${randomHex(16)}-${randomHex(8)}-01`;
+}
+
+// Offline edits rebased onto the hub text, merged by Yjs itself: the last synced text is rebuilt
+// in a scratch doc, the hub's change and our recorded deltas are replayed on two forks of it as
+// concurrent edits, and the merge is returned as a delta against the hub text (null: nothing to apply)
+function rebaseOfflineEdits(base, deltas, hubText) {
+  const origin = new Y.Doc();
+  origin.getText("content").insert(0, base);
+  const start = Y.encodeStateAsUpdate(origin);
+
+  const remote = new Y.Doc();
+  Y.applyUpdate(remote, start);
+  const remoteText = remote.getText("content");
+  const { index, deleteCount, insert } = diffStrings(base, hubText);
+  remote.transact(() => {
+    if (deleteCount > 0) remoteText.delete(index, deleteCount);
+    if (insert) remoteText.insert(index, insert);
   });
+
+  const local = new Y.Doc();
+  Y.applyUpdate(local, start);
+  const localText = local.getText("content");
+  deltas.forEach((delta) => localText.applyDelta(delta));
+
+  let merged = null;
+  remoteText.observe((event) => { merged = event.delta; });
+  Y.applyUpdate(remote, Y.encodeStateAsUpdate(local, Y.encodeStateVector(origin)));
+  return merged;
+}
+
+function applySync(msg) {
+  flushEditorInput();
+  applyPermission(msg.permission);
+
+  if (msg.reset && hasState) {
+    // The hub reloaded the room: our CRDT history is from another epoch and can't be merged.
+    // Start from the hub state and rebase offline edits onto it, so remote edits made
+    // meanwhile are kept as well.
+    const keepLocal = offlineEdits;
+    const base = syncedText;
+    const deltas = offlineDeltas;
+    createYdoc();
+    suppressSend = true;
+    Y.applyUpdate(ydoc, hexToBytes(msg.update));
+    suppressSend = false;
+    roomEpoch = msg.epoch || null;
+    awaitingSync = false;
+    offlineEdits = false;
+    offlineDeltas = [];
+    if (keepLocal && base !== null) {
+      const delta = rebaseOfflineEdits(base, deltas, ytext.toString());
+      if (delta) ydoc.transact(() => ytext.applyDelta(delta));
+      renderFromYjs();
+    } else if (keepLocal) {
+      // No known base (state saved by an older version): the editor text wins
+      applyEditorDiffToYjs();
+    } else {
+      renderFromYjs();
+    }
+    schedulePersist();
+    return;
+  }
+
+  suppressSend = true;
+  Y.applyUpdate(ydoc, hexToBytes(msg.update));
+  suppressSend = false;
+  roomEpoch = msg.epoch || roomEpoch;
+  hasState = true;
+  renderFromYjs();
+
+  // Send what the hub is missing (edits made offline)
+  if (msg.stateVector) {
+    const missing = Y.encodeStateAsUpdate(ydoc, hexToBytes(msg.stateVector));
+    if (missing.length > 2) {
+      ws.send(JSON.stringify({ type: "update", update: bytesToHex(missing) }));
+    }
+  }
+  awaitingSync = false;
+  offlineEdits = false;
+  offlineDeltas = [];
+  schedulePersist();
+}
+
+// --- Presence: who else is in the document (hub broadcasts, throttled) ---
+function renderPresence(users) {
+  if (!presenceBox) return;
+  presenceBox.replaceChildren(...users.map((u) => {
+    const item = document.createElement("span");
+    item.className = u.active ? "presence-user active" : "presence-user";
+    item.textContent = u.connections > 1 ? `${u.user} (${u.connections})` : u.user;
+    item.title = u.active ? "редактирует" : "неактивен";
+    return item;
+  }));
+}
+
+// --- Access level: view/comment connections are read-only (the hub drops their updates) ---
+function applyPermission(permission) {
+  if (!permission || !editor) return;
+  const writable = permission === "owner" || permission === "edit";
+  editor.contentEditable = writable ? "true" : "false";
+  [boldBtn, italicBtn, colorPicker].forEach((el) => { if (el) el.disabled = !writable; });
 }
 
 function connectWs() {
@@ -165,14 +528,23 @@ function connectWs() {
 
   const gatewayUrl = new URL(GATEWAY_BASE); // например http://localhost:8000
   const wsProto = gatewayUrl.protocol === "https:" ? "wss:" : "ws:";
-  const wsUrl = `${wsProto}//${gatewayUrl.host}/ws/documents/${encodeURIComponent(docId)}?token=${token}`;
+  // resume: we already have state, so the hub skips the full sync and answers our sync_request with a diff
+  const resume = hasState;
+  const wsUrl = `${wsProto}//${gatewayUrl.host}/ws/documents/${encodeURIComponent(docId)}?token=${token}${resume ? "&resume=1" : ""}`;
 
 
+  markOffline();
+  awaitingSync = true;
   ws = new WebSocket(wsUrl);
 
   ws.onopen = () => {
     console.log("WS connected (CRDT)", wsUrl);
-    // Server should push "sync" as first message.
+    reconnectDelay = 1000;
+    if (resume) {
+      const sv = Y.encodeStateVector(ydoc);
+      ws.send(JSON.stringify({ type: "sync_request", stateVector: bytesToHex(sv), epoch: roomEpoch }));
+    }
+    // Otherwise the server pushes a full "sync" as the first message.
   };
 
   ws.onmessage = (ev) => {
@@ -180,22 +552,12 @@ function connectWs() {
     try { msg = JSON.parse(ev.data); } catch { return; }
 
     if (msg.type === "sync") {
-      const updateBytes = hexToBytes(msg.update);
-      suppressSend = true;
-      Y.applyUpdate(ydoc, updateBytes);
-      suppressSend = false;
-
-      renderFromYjs();
-
-      if (!sentSyncRequest) {
-        sentSyncRequest = true;
-        const sv = Y.encodeStateVector(ydoc);
-        ws.send(JSON.stringify({ type: "sync_request", stateVector: bytesToHex(sv) }));
-      }
+      applySync(msg);
       return;
     }
 
     if (msg.type === "update") {
+      flushEditorInput();
       const updateBytes = hexToBytes(msg.update);
       suppressSend = true;
       Y.applyUpdate(ydoc, updateBytes);
@@ -205,32 +567,47 @@ function connectWs() {
       return;
     }
 
+    if (msg.type === "permission") {
+      applyPermission(msg.permission);
+      return;
+    }
+
+    if (msg.type === "presence") {
+      renderPresence(msg.users || []);
+      return;
+    }
+
     if (msg.type === "error") {
       console.error("WS error:", msg.message || msg);
     }
   };
 
   ws.onerror = (e) => console.error("WS error", e);
-  ws.onclose = () => console.log("WS closed");
-
-  // Local Yjs updates -> send to server
-  ydoc.on("update", (update) => {
-    if (suppressSend) return;
-    if (!ws || ws.readyState !== WebSocket.OPEN) return;
-    ws.send(JSON.stringify({ type: "update", update: bytesToHex(update) }));
-  });
-
-  // Editor input -> overwrite Y.Text entirely (MVP)
-  editor.addEventListener("input", () => {
-    clearTimeout(editorDebounce);
-    editorDebounce = setTimeout(() => {
-      overwriteYjsFromEditor();
-    }, 100);
-  });
+  ws.onclose = (ev) => {
+    markOffline();
+    console.log("WS closed", ev.code);
+    // 1008: unauthorized / document not found — reconnecting won't help
+    if (ev.code === 1008) return;
+    // 1012: hub restart — spread reconnects so the new instance isn't hit all at once
+    setTimeout(connectWs, ev.code === 1012 ? Math.random() * reconnectDelay : reconnectDelay);
+    reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_DELAY);
+  };
 }
 
+// Editor input -> minimal insert/delete on Y.Text
+editor?.addEventListener("input", () => {
+  clearTimeout(editorDebounce);
+  editorDebounce = setTimeout(() => {
+    editorDebounce = null;
+    applyEditorDiffToYjs();
+  }, 100);
+});
+
 // --- Startup ---
 window.addEventListener("load", async () => {
-  await loadDocumentForInitialPaint();
+  if (Y) createYdoc();
+  // With local state the editor is painted from IndexedDB and the REST fetch is skipped
+  const restored = await restoreLocalState();
+  if (!restored) await loadDocumentForInitialPaint();
   connectWs();
 });
@@ -32,6 +32,8 @@ class Event(BaseModel):
     content: str = ""
     user_id: str = None
     timestamp: str = None
+    # Контекст трассировки публикующего сервиса (W3C traceparent), передаётся подписчикам
+    traceparent: str = None
 
 @app.post("/events")
 async def publish_event(event: Event):
@@ -0,0 +1,191 @@
+"""
+Авторизация доступа к документам (общая для Collaboration Hub и API Gateway).
+
+(пользователь, документ) -> уровень доступа: 'owner' | 'edit' | 'comment' | 'view' | None.
+Источник — Document Service (documents.owner_id и document_collaborators), ответы кэшируются
+в памяти процесса: положительные на AUTH_CACHE_TTL, отказы на AUTH_NEGATIVE_TTL.
+Права на список документов пользователя подгружаются одним запросом (prefetch),
+изменения соавторов сбрасывают кэш документа через POST /authz/invalidate.
+Document Service сбрасывает кэш и хаба, и гейтвея (API_GATEWAY_URL); если реплик
+гейтвея несколько, до остальных отзыв доступа доходит не позже чем через AUTH_CACHE_TTL.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+
+from tracing import span, inject_headers
+
+DOCUMENT_SERVICE_URL = os.getenv("DOCUMENT_SERVICE_URL", "http://localhost:8001")
+AUTH_ENABLED = os.getenv("AUTH_ENABLED", "true").lower() in ("1", "true", "yes")
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60.0"))
+# Отказ кэшируется короче: только что выданный доступ не должен долго не работать
+AUTH_NEGATIVE_TTL = float(os.getenv("AUTH_NEGATIVE_TTL", "10.0"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "50000"))
+AUTH_TIMEOUT = float(os.getenv("AUTH_TIMEOUT", "3.0"))
+AUTH_PREFETCH_MAX_DOCUMENTS = int(os.getenv("AUTH_PREFETCH_MAX_DOCUMENTS", "200"))
+
+# Уровни, которым разрешено менять документ; остальные подключаются только на чтение
+WRITE_LEVELS = ("owner", "edit")
+
+
+class AuthUnavailable(Exception):
+    """Document Service не ответил: доступ не подтверждён, но и не запрещён"""
+
+
+def can_write(permission: Optional[str]) -> bool:
+    return permission in WRITE_LEVELS
+
+
+class PermissionCache:
+    """LRU-кэш с TTL: ключ -> (значение, момент истечения)"""
+
+    def __init__(self, max_entries: int = AUTH_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()
+
+    def get(self, key) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def put(self, key, value):
+        ttl = AUTH_CACHE_TTL if value is not None else AUTH_NEGATIVE_TTL
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard_where(self, predicate) -> int:
+        keys = [key for key in self._entries if predicate(key)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Authorizer:
+    """
+    Разрешение прав с кэшем. Одновременные промахи по одной паре склеиваются в один запрос;
+    запрос, начатый до инвалидации, свой результат в кэш не кладёт.
+    """
+
+    def __init__(self, base_url: str = DOCUMENT_SERVICE_URL, enabled: bool = AUTH_ENABLED):
+        self.base_url = base_url.rstrip("/")
+        self.enabled = enabled
+        self.permissions = PermissionCache()
+        # username -> user_id (None — пользователя нет)
+        self.users = PermissionCache()
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    async def permission(self, username: str, doc_id: str) -> Optional[str]:
+        """Уровень доступа пользователя к документу; AuthUnavailable, если проверить нельзя"""
+        if not self.enabled:
+            return "edit"
+        key = (username, doc_id)
+        hit, permission = self.permissions.get(key)
+        if hit:
+            self.hits += 1
+            return permission
+
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._resolve(username, [doc_id]))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        permissions = await asyncio.shield(task)
+        return permissions.get(doc_id)
+
+    async def prefetch(self, username: str, doc_ids: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Права на список документов одним запросом (например, на документы из дашборда)"""
+        missing = [
+            doc_id for doc_id in dict.fromkeys(doc_ids)
+            if not self.permissions.get((username, doc_id))[0]
+        ][:AUTH_PREFETCH_MAX_DOCUMENTS]
+        if not self.enabled or not missing:
+            return {}
+        permissions = await self._resolve(username, missing)
+        self.prefetched += len(permissions)
+        return permissions
+
+    def invalidate(self, doc_id: Optional[str] = None, username: Optional[str] = None) -> int:
+        """Сбросить кэш документа и/или пользователя (без аргументов — весь кэш)"""
+        self._generation += 1
+        self.invalidations += 1
+        if username is not None and doc_id is None:
+            self.users.discard_where(lambda key: key == username)
+        return self.permissions.discard_where(
+            lambda key: (doc_id is None or key[1] == doc_id) and (username is None or key[0] == username)
+        )
+
+    async def _resolve(self, username: str, doc_ids: List[str]) -> Dict[str, Optional[str]]:
+        generation = self._generation
+        with span("authz.resolve", documents=len(doc_ids)):
+            async with httpx.AsyncClient(base_url=self.base_url, timeout=AUTH_TIMEOUT) as client:
+                try:
+                    user_id = await self._user_id(client, username)
+                    if user_id is None:
+                        permissions = {doc_id: None for doc_id in doc_ids}
+                    else:
+                        r = await client.post(
+                            f"/users/{user_id}/permissions",
+                            json={"document_ids": doc_ids},
+                            headers=inject_headers(),
+                        )
+                        r.raise_for_status()
+                        found = r.json().get("permissions", {})
+                        permissions = {doc_id: found.get(doc_id) for doc_id in doc_ids}
+                except httpx.HTTPError as e:
+                    self.errors += 1
+                    raise AuthUnavailable(str(e)) from e
+
+        if generation == self._generation:
+            for doc_id, permission in permissions.items():
+                self.permissions.put((username, doc_id), permission)
+        return permissions
+
+    async def _user_id(self, client: httpx.AsyncClient, username: str) -> Optional[str]:
+        hit, user_id = self.users.get(username)
+        if hit:
+            return user_id
+        r = await client.get(f"/users/username/{username}", headers=inject_headers())
+        if r.status_code == 404:
+            user_id = None
+        else:
+            r.raise_for_status()
+            user_id = str(r.json()["id"])
+        self.users.put(username, user_id)
+        return user_id
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.permissions),
+            "users": len(self.users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetched": self.prefetched,
+            "invalidations": self.invalidations,
+            "errors": self.errors,
+        }
+
+
+authorizer = Authorizer()
@@ -0,0 +1,36 @@
+"""
+Служебные HTTP-эндпоинты сервисов (drain, сброс кэшей, prefetch прав, присутствие в хабе).
+
+Сервисы подписывают такие запросы общим секретом INTERNAL_API_TOKEN в заголовке
+X-Internal-Token. Без настроенного секрета (локальный запуск) служебный эндпоинт
+принимает только запросы с loopback-адреса.
+
+Модуль общий для сервисов, как и tracing.py (additional_contexts: shared).
+"""
+import hmac
+import os
+from typing import Dict
+
+from fastapi import HTTPException, Request
+
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN", "")
+INTERNAL_TOKEN_HEADER = "X-Internal-Token"
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def internal_headers() -> Dict[str, str]:
+    """Заголовок для исходящего запроса к служебному эндпоинту другого сервиса"""
+    return {INTERNAL_TOKEN_HEADER: INTERNAL_API_TOKEN} if INTERNAL_API_TOKEN else {}
+
+
+def is_internal_request(request: Request) -> bool:
+    if INTERNAL_API_TOKEN:
+        token = request.headers.get(INTERNAL_TOKEN_HEADER, "")
+        return hmac.compare_digest(token.encode(), INTERNAL_API_TOKEN.encode())
+    return request.client is not None and request.client.host in LOOPBACK_HOSTS
+
+
+def require_internal(request: Request):
+    """403 для запроса к служебному эндпоинту без секрета"""
+    if not is_internal_request(request):
+        raise HTTPException(status_code=403, detail="Internal endpoint")
@@ -0,0 +1,222 @@
+"""
+Лёгкая распределённая трассировка без внешних зависимостей.
+
+Контекст передаётся в формате W3C traceparent (00-<trace_id>-<span_id>-<flags>):
+HTTP-заголовком, полем "traceparent" в WS-сообщениях и событиях брокера.
+Решение о сэмплировании принимается в корне трассы (TRACE_SAMPLE_RATE) и
+наследуется по цепочке; для несэмплированных трасс время не замеряется и
+ничего не экспортируется.
+
+Экспорт (TRACE_EXPORT):
+  memory — кольцевой буфер последних TRACE_MEMORY_SPANS спанов (GET /debug/traces);
+  file   — JSON lines в TRACE_FILE;
+  off    — трассировка выключена.
+GET /debug/traces отвечает только при TRACE_DEBUG_ENDPOINT=true, иначе 404.
+Отчёт по задержкам между сервисами: tools/trace_report.py.
+
+Модуль общий для сервисов: docker-compose.yml копирует его в образ каждого
+сервиса (additional_contexts: shared); при локальном запуске нужен
+PYTHONPATH=services/shared.
+"""
+import json
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "memory").lower()
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_MEMORY_SPANS = int(os.getenv("TRACE_MEMORY_SPANS", "10000"))
+# Отдавать спаны по HTTP (GET /debug/traces); по умолчанию выключено — эндпоинт без авторизации
+TRACE_DEBUG_ENDPOINT = os.getenv("TRACE_DEBUG_ENDPOINT", "false").lower() in ("1", "true", "yes")
+
+TRACEPARENT_HEADER = "traceparent"
+
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[SpanContext]:
+    if not value or not isinstance(value, str):
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2], bool(flags & 1))
+
+
+def format_traceparent(ctx: SpanContext) -> str:
+    return f"00-{ctx.trace_id}-{ctx.span_id}-{'01' if ctx.sampled else '00'}"
+
+
+_current: ContextVar[Optional[SpanContext]] = ContextVar("trace_context", default=None)
+_service_name = os.getenv("TRACE_SERVICE_NAME", "service")
+
+
+def init_tracing(service_name: str):
+    """Имя сервиса в экспортируемых спанах (переопределяется TRACE_SERVICE_NAME)"""
+    global _service_name
+    _service_name = os.getenv("TRACE_SERVICE_NAME", service_name)
+
+
+def current_traceparent() -> Optional[str]:
+    """traceparent текущего спана для передачи дальше (None вне трассы)"""
+    ctx = _current.get()
+    return format_traceparent(ctx) if ctx is not None else None
+
+
+def inject_headers(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    headers = dict(headers or {})
+    traceparent = current_traceparent()
+    if traceparent:
+        headers[TRACEPARENT_HEADER] = traceparent
+    return headers
+
+
+class Span:
+    __slots__ = ("name", "context", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, context: SpanContext, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def traceparent(self) -> str:
+        return format_traceparent(self.context)
+
+    def set_attribute(self, key: str, value: Any):
+        if self.context.sampled:
+            self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            "service": _service_name,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(((self.end or self.start) - self.start) * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def _child_context(parent: Any) -> Tuple[SpanContext, Optional[str]]:
+    if isinstance(parent, str):
+        parent = parse_traceparent(parent)
+    if parent is None:
+        parent = _current.get()
+    if parent is None:
+        sampled = TRACE_EXPORT != "off" and random.random() < TRACE_SAMPLE_RATE
+        return SpanContext(_new_id(128), _new_id(64), sampled), None
+    return SpanContext(parent.trace_id, _new_id(64), parent.sampled), parent.span_id
+
+
+@contextmanager
+def span(name: str, parent: Any = None, **attributes):
+    """
+    Спан вокруг блока кода. parent — traceparent-строка или SpanContext;
+    по умолчанию текущий спан, а без него начинается новая трасса.
+    """
+    context, parent_id = _child_context(parent)
+    current = Span(name, context, parent_id, attributes if context.sampled else {})
+    token = _current.set(context)
+    try:
+        yield current
+    except BaseException as e:
+        if context.sampled:
+            current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        if context.sampled:
+            current.end = time.time()
+            exporter.export(current.to_dict())
+
+
+def record_span(name: str, start: float, end: float, **attributes):
+    """Записать уже завершившуюся операцию (например, из колбэка) как дочерний спан текущего"""
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        return
+    finished = Span(name, SpanContext(parent.trace_id, _new_id(64), True), parent.span_id, attributes)
+    finished.start, finished.end = start, end
+    exporter.export(finished.to_dict())
+
+
+class TracingMiddleware:
+    """ASGI-middleware: спан на HTTP-запрос с родителем из заголовка traceparent"""
+
+    def __init__(self, app, name: str = "http"):
+        self.app = app
+        self.name = name
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+
+        with span(self.name, parent=traceparent, method=scope["method"], path=scope["path"]) as current:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start":
+                    current.set_attribute("status", message["status"])
+                await send(message)
+
+            await self.app(scope, receive, send_with_status)
+
+
+class MemoryExporter:
+    def __init__(self, size: int = TRACE_MEMORY_SPANS):
+        self._spans: deque = deque(maxlen=size)
+
+    def export(self, data: Dict[str, Any]):
+        self._spans.append(data)
+
+    def spans(self, trace_id: Optional[str] = None, limit: int = 1000) -> List[Dict[str, Any]]:
+        items = [s for s in self._spans if trace_id is None or s["trace_id"] == trace_id]
+        return items[-limit:]
+
+
+class FileExporter(MemoryExporter):
+    """Пишет спаны в файл (JSON lines) и держит последние в памяти для /debug/traces"""
+
+    def __init__(self, path: str = TRACE_FILE):
+        super().__init__()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", buffering=1)
+
+    def export(self, data: Dict[str, Any]):
+        super().export(data)
+        self._file.write(json.dumps(data, default=str) + "\n")
+
+
+exporter = FileExporter() if TRACE_EXPORT == "file" else MemoryExporter()
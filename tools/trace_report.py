@@ -0,0 +1,137 @@
+"""
+Отчёт о задержках по трассам Conspektor.
+
+Спаны берутся из файлов (TRACE_EXPORT=file, JSON lines) и/или из
+GET /debug/traces сервисов (TRACE_EXPORT=memory, TRACE_DEBUG_ENDPOINT=true).
+Отчёт показывает перцентили длительности по каждому хопу (сервис / спан),
+задержки, записанные атрибутами (клиент -> хаб, очередь брокера), и полную
+длительность трасс.
+
+Примеры:
+  python tools/trace_report.py traces/*.jsonl
+  python tools/trace_report.py --url http://localhost:8000/debug/traces \\
+      --url http://localhost:8001/debug/traces --url http://localhost:8002/debug/traces
+  python tools/trace_report.py traces/*.jsonl --trace <trace_id>
+"""
+import argparse
+import json
+import sys
+import urllib.request
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+# Атрибуты спанов, которые сами являются задержками хопов (мс)
+DELAY_ATTRIBUTES = ("client_to_hub_ms", "queue_delay_ms")
+
+
+def load_file(path: str) -> Iterable[dict]:
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def load_url(url: str, trace_id: Optional[str]) -> List[dict]:
+    if trace_id:
+        url += ("&" if "?" in url else "?") + f"trace_id={trace_id}"
+    with urllib.request.urlopen(url, timeout=10) as resp:
+        return json.load(resp)
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def summarize(values: List[float]) -> str:
+    return (
+        f"{len(values):>7} {percentile(values, 0.5):>10.2f} {percentile(values, 0.95):>10.2f} "
+        f"{percentile(values, 0.99):>10.2f} {max(values):>10.2f}"
+    )
+
+
+def print_table(title: str, rows: Dict[str, List[float]]):
+    if not rows:
+        return
+    width = max(len(key) for key in rows)
+    print(f"\n{title}")
+    print(f"{'':<{width}} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+    for key in sorted(rows, key=lambda k: -percentile(rows[k], 0.5)):
+        print(f"{key:<{width}} {summarize(rows[key])}")
+
+
+def print_trace(spans: List[dict]):
+    """Дерево одной трассы со смещением каждого спана от начала трассы"""
+    start = min(s["start"] for s in spans)
+    children = defaultdict(list)
+    ids = {s["span_id"] for s in spans}
+    for s in spans:
+        children[s["parent_id"] if s["parent_id"] in ids else None].append(s)
+
+    def walk(parent_id, depth):
+        for s in sorted(children[parent_id], key=lambda s: s["start"]):
+            offset = (s["start"] - start) * 1000
+            error = f"  ERROR {s['error']}" if s.get("error") else ""
+            print(f"{offset:>9.2f} ms  {'  ' * depth}{s['service']}/{s['name']} {s['duration_ms']:.2f} ms{error}")
+            walk(s["span_id"], depth + 1)
+
+    walk(None, 0)
+
+
+def report(spans: List[dict]):
+    traces: Dict[str, List[dict]] = defaultdict(list)
+    for s in spans:
+        traces[s["trace_id"]].append(s)
+
+    hops: Dict[str, List[float]] = defaultdict(list)
+    delays: Dict[str, List[float]] = defaultdict(list)
+    for s in spans:
+        hops[f"{s['service']}/{s['name']}"].append(s["duration_ms"])
+        for attribute in DELAY_ATTRIBUTES:
+            value = (s.get("attributes") or {}).get(attribute)
+            if isinstance(value, (int, float)):
+                delays[f"{s['service']}/{s['name']}.{attribute}"].append(value)
+
+    totals: Dict[str, List[float]] = defaultdict(list)
+    for trace_spans in traces.values():
+        root = min(trace_spans, key=lambda s: s["start"])
+        end = max(s["start"] + s["duration_ms"] / 1000 for s in trace_spans)
+        totals[f"{root['service']}/{root['name']}"].append((end - root["start"]) * 1000)
+
+    print(f"{len(spans)} spans in {len(traces)} traces")
+    print_table("Hop durations", hops)
+    print_table("Hop delays (from span attributes; cross-host values include clock skew)", delays)
+    print_table("End-to-end by trace root", totals)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency breakdown per hop from exported spans")
+    parser.add_argument("files", nargs="*", help="JSON lines files written with TRACE_EXPORT=file")
+    parser.add_argument("--url", action="append", default=[], help="service /debug/traces endpoint")
+    parser.add_argument("--trace", help="print the span tree of a single trace")
+    args = parser.parse_args(argv)
+
+    spans: List[dict] = []
+    for path in args.files:
+        spans.extend(load_file(path))
+    for url in args.url:
+        spans.extend(load_url(url, args.trace))
+
+    if args.trace:
+        spans = [s for s in spans if s["trace_id"] == args.trace]
+        if not spans:
+            print(f"trace {args.trace} not found", file=sys.stderr)
+            return 1
+        print_trace(spans)
+        return 0
+
+    if not spans:
+        print("no spans found", file=sys.stderr)
+        return 1
+    report(spans)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())